@@ -2,6 +2,7 @@
 try:
 	from julia_server import JuliaServer
 	from julia_client import julia_client
+	from result_cache import ResultCache
 	julia_server = JuliaServer() # create the julia server object
 	Islanding = True
 except ImportError:
@@ -10,22 +11,34 @@ except ImportError:
 try:
 	from packetized.virtual_battery import *
 	from packetized.vb_device import *
+	from packetized.device_snapshot import DeviceSnapshot
+	from packetized.vector_battery import VectorVirtualBattery
+	from packetized.request_generator import island_seed
+	from packetized.actuation import Actuator
+	from packetized.vb_recorder import VBRecorder
+	from packetized.arbitration import ArbitrationLog, ARBITRATION_POLICIES
+	from flexible_load import FlexibleLoad
+	VB_ENGINES = {'object':VirtualBattery, 'vector':VectorVirtualBattery}
 	print('Packetized module found, using virtual battery module for absorption.')
 	Packetizing = True
 except ImportError:
 	print('Packetized module not found, using thermal controls for absorption.')
 	Packetizing = False
 import data_post_process
+from object_catalog import ObjectCatalog
+from supernode_topology import SupernodeTopology, connected_components
+from baseline_matrix import BaselineMatrix
+from telemetry import TelemetryWriter
+from house_pool import HousePool
+from profiler import profiler
 
 # Other needed modules
 import os
 import re
-import csv
 import json
 import time
 import pandas as pd
 import numpy as np
-import random
 import warnings
 warnings.filterwarnings('ignore')
 
@@ -35,22 +48,49 @@ t_inc = 3 #minutes
 re_island = False
 islands = None
 all_devices = None
-islanded_devices = []
+islanded_devices = {} # device : island it belongs to
 islanded = False
 device_map = None
 load_per_house = {}
+baseline = None # baseline run loads and solar (BaselineMatrix), loaded once in on_init
+island_baseline = {} # island : baseline loads and solar sent with its island management requests
 Virtual_Battery = None
+vb_engine = 'object' # virtual battery engine (GLM global VB_ENGINE): object | vector
+vb_scheduled = False # object engine only visits the active devices: timer ended, EXIT state, exit band or PEM_ON (GLM global VB_SCHEDULED)
+vb_in_place = False # object engine devices transition in place instead of copying (GLM global VB_INPLACE)
+vb_arbitration = 'random' # power request arbitration policy of the virtual batteries (GLM global VB_ARBITRATION): random | lowest_soc
+arbitration_log = None # per-step tracking error and arbitration time of all virtual batteries, written to arbitration.csv
+vb_seed = None # seed of the VB power request generators (GLM global VB_SEED), each island's generator is seeded from it and its supernodes
+device_snapshot = None
+actuator = None # sends only the TurnOn/TurnOff effects that change a device's commanded state
+islanding_cache = None # islanding results by payload key (GLM globals ISLANDING_CACHE_SIZE, ISLANDING_CACHE_LOAD_QUANTUM, ISLANDING_CACHE_SOC_QUANTUM)
+islanding_cache_file = '' # pickle file the islanding cache is loaded from and saved to (GLM global ISLANDING_CACHE)
 setpoint = 600
 test_setpoint = False
-vb_data_out = False
+vb_data_out = False # record the virtual battery time series (GLM globals VB_DATA_OUT, VB_DATA_FILE)
+vb_recorder = None
+flexible_load = None # per supernode HVAC + water heater load from the device snapshot, published every commit
 faulted_nodes = []
 total_fault_count = 0
-houses_off = []
+house_pools = {} # island : HousePool of its connected and disconnected houses, kept with the island's virtual battery
 powerbal = {}
+battery_ratings = {} # battery inverter : (max discharge, max charge) rate [kW], cached at island formation
+catalog = None
+topology = None
+telemetry = None # buffered inverter P_Out setpoints (GLM globals TELEMETRY_FILE, INVERTER_P_OUT_FILES)
 
 packetize_baseline = False
 COMPILE = False
 
+def get_global(name,default=None):
+	'''
+	returns the value of GLM global name, or default if the global is not defined in the model
+	'''
+	value = gridlabd.get_global(name)
+	if value is None:
+		return default
+	return value
+
 def on_init(t):
 	'''
 	on_init code runs upon GLM model initialization
@@ -62,31 +102,93 @@ def on_init(t):
 		global Absorption
 		global swing_sn
 		global setpoint
+		global catalog
+		global topology
+		global device_map
+		global vb_engine
+		global vb_in_place
+		global vb_scheduled
+		global vb_seed
+		global vb_arbitration
+		global arbitration_log
+		global telemetry
+		global vb_data_out
 		Absorption = gridlabd.get_global("LOAD_CONTROL")=="TRUE"
 		Absorption = Islanding and Packetizing and Absorption
 		print('LOAD_CONTROL = {}'.format(Absorption))
 		print(' - Islanding = {}'.format(Islanding and Absorption))
 		print(' - Packetizing = {}'.format(Packetizing and Absorption))
 		print(' - testing VB setpoint tracking = {}'.format(test_setpoint))
+		vb_engine = get_global("VB_ENGINE",vb_engine).lower()
+		if Packetizing and (vb_engine not in VB_ENGINES):
+			print(' - unknown VB_ENGINE "{}", using the object virtual battery engine'.format(vb_engine))
+			vb_engine = 'object'
+		print(' - virtual battery engine = {}'.format(vb_engine))
+		vb_in_place = get_global("VB_INPLACE","FALSE")=="TRUE"
+		print(' - in-place device transitions = {}'.format(vb_in_place))
+		vb_scheduled = (get_global("VB_SCHEDULED","FALSE")=="TRUE") and (vb_engine=='object')
+		print(' - scheduled PEM evaluation = {}'.format(vb_scheduled))
+		vb_seed = int(get_global("VB_SEED",np.random.SeedSequence().entropy))
+		print(' - VB request seed = {}'.format(vb_seed))
+		vb_arbitration = get_global("VB_ARBITRATION",vb_arbitration).lower()
+		if Packetizing:
+			if vb_arbitration not in ARBITRATION_POLICIES:
+				print(' - unknown VB_ARBITRATION "{}", using random power request arbitration'.format(vb_arbitration))
+				vb_arbitration = 'random'
+			arbitration_log = ArbitrationLog()
+		print(' - VB power request arbitration = {}'.format(vb_arbitration))
+		vb_data_out = get_global("VB_DATA_OUT","TRUE" if vb_data_out else "FALSE")=="TRUE"
+		print(' - VB time series output = {}'.format(get_global("VB_DATA_FILE","virtual_battery_timeseries.csv") if vb_data_out else False))
+		if os.path.exists('flexible_load.csv'):
+			os.remove('flexible_load.csv') # written again at on_term by this run's FlexibleLoad
+		telemetry = TelemetryWriter(get_global("TELEMETRY_FILE","inverter_P_Out.csv"))
+		print(' - inverter P_Out telemetry = {}'.format(telemetry.filename))
+		if get_global("PHASE_PROFILE","FALSE")=="TRUE":
+			profiler.start(get_global("PHASE_PROFILE_FILE","phase_profile.csv"),client=julia_client if Islanding else None)
+		print(' - on_commit phase profile = {}'.format(profiler.filename if profiler.enabled else False))
 		if ((Absorption) & (Islanding)):
 			print("Initializing the Julia Server for Virtual Islanding optimization")
 			global julia_server
 			global t_start
-			if vb_data_out:
-				with open('virtual_battery_timeseries.csv', 'w', newline='') as vbcsv:
-					VBcsv_writer = csv.writer(vbcsv)
-					VBcsv_writer.writerow(['timestamp','VB_soc','VB_avgsoc','VB_load','VB_setpoint','hvac_avgsoc','wh_avgsoc','avg_hvac_temp','avg_wh_temp','avg_out_temp','hvac_load','wh_load','wh_wdemand','nf_shed'])
-			baseload = pd.read_csv(f'Loads_baseline.csv')
-			setpoint = baseload[[c for c in baseload.columns if (('hvac' in c) or ('wh' in c))]].sum(axis=1).max()*1.05
+			global baseline
+			baseline = BaselineMatrix().load('Loads_baseline.csv','Ps_baseline.csv')
+			setpoint = baseline.flexible_peak()*1.05
+			julia_payload = get_global("JULIA_PAYLOAD","text").lower()
+			try:
+				julia_client.set_payload_format(julia_payload)
+			except ValueError as err:
+				print(' - {}, using text payloads'.format(err))
+				julia_client.set_payload_format('text')
+			print(' - Julia payload format = {}'.format(julia_client.payload_format))
+			julia_client.timeout = float(get_global("JULIA_TIMEOUT","300"))
+			print(' - Julia request timeout = {} s'.format(julia_client.timeout))
+			julia_server.workers = int(get_global("JULIA_WORKERS","1"))
+			print(' - Julia workers = {}'.format(julia_server.workers))
+			julia_server.use_daemon = get_global("JULIA_DAEMON","FALSE")=="TRUE"
+			global islanding_cache
+			global islanding_cache_file
+			islanding_cache = ResultCache(max_entries=int(get_global("ISLANDING_CACHE_SIZE","128")),
+				quanta={'shunt_P':float(get_global("ISLANDING_CACHE_LOAD_QUANTUM","0.01")), # MW
+						'bat_soc':float(get_global("ISLANDING_CACHE_SOC_QUANTUM","0.05"))})
+			islanding_cache_file = get_global("ISLANDING_CACHE","")
+			if islanding_cache_file:
+				try:
+					print(' - islanding cache = {} ({} results loaded)'.format(islanding_cache_file,islanding_cache.load(islanding_cache_file)))
+				except Exception as err:
+					print(' - islanding cache {} not loaded ({}), starting empty'.format(islanding_cache_file,err))
+			print(' - islanding cache size = {}, quanta = {}'.format(islanding_cache.max_entries,islanding_cache.quanta))
 			try:
 				julia_server.start()
+				for line in julia_server.report():
+					print(' - '+line)
 			except:
 				print("Julia server couldn't start; turning off all Packetized Integration (Absorption)")
 				Absorption=False
 		t_start = t
-		nodestr = gridlabd.get_value("supernode_list","node_group").replace("'",'').replace(" ","")[2:-2]
-		supernodes = nodestr.split(',')
-		swing_sn = [int(sn.split('_')[1]) for sn in supernodes if gridlabd.get_value(sn,'bustype')=='SWING'][0]
+		catalog = ObjectCatalog(gridlabd).build()
+		topology = SupernodeTopology(gridlabd,catalog).build()
+		device_map = topology.device_map
+		swing_sn = topology.swing_id
 	return True
 
 def on_term(t):
@@ -97,17 +199,51 @@ def on_term(t):
 		if ((Absorption) & (Islanding)):
 			print("Shutting down the Julia Server")
 			global julia_server
+			for line in julia_server.report():
+				print(' - '+line)
 			julia_server.stop()
+			if islanding_cache is not None:
+				print(' - islanding cache: {entries} results, {hits} hits, {misses} misses, {evictions} evictions'.format(**islanding_cache.stats()))
+				if islanding_cache_file:
+					islanding_cache.save(islanding_cache_file)
+	if actuator is not None:
+		print('Device commands sent = {}, suppressed = {}'.format(actuator.sent,actuator.suppressed))
+		actuator.write('actuation.csv')
+	if ((arbitration_log is not None) and (arbitration_log.rows)):
+		print('Power request arbitration ({}): {steps} steps, {requests} requests, mean |tracking error| = {mean_abs_error:.1f} kW, {arbitration_sec:.3f} s'.format(vb_arbitration,**arbitration_log.summary()))
+		arbitration_log.write('arbitration.csv')
+	if flexible_load is not None:
+		flexible_load.write('flexible_load.csv')
+	if vb_recorder is not None:
+		vb_recorder.close()
+		print('Virtual battery time series rows = {} ({})'.format(vb_recorder.rows,vb_recorder.filename))
+	if profiler.enabled:
+		profiler.close()
+		print('on_commit phase profile ({}):'.format(profiler.filename))
+		for line in profiler.report():
+			print('  '+line)
+	if telemetry is not None:
+		telemetry.close()
+		print('Inverter P_Out setpoints written = {} ({})'.format(telemetry.rows,telemetry.filename))
+		if get_global("INVERTER_P_OUT_FILES","TRUE")=="TRUE":
+			telemetry.export('{}-P_Out.csv')
 	print(time.ctime())
 	return None
 
 def find(criteria):
 	'''
 	find() function takes in a criteria string as "key=value" as looks for objects in GLD that match that criteria
+		- class, supernode_name and parent criteria are answered from the object catalog built in on_init
+		- any other property falls back to scanning all objects in the model
 	'''
+	global catalog
 	finder = criteria.split("=")
 	if len(finder) < 2:
 		raise Exception("find(criteria='key=value'): criteria syntax error")
+	if finder[0] in ObjectCatalog.INDEXED:
+		if catalog is None:
+			catalog = ObjectCatalog(gridlabd).build()
+		return catalog.find(finder[0],finder[1])
 	objects = gridlabd.get("objects")
 	result = []
 	for name in objects:
@@ -120,13 +256,6 @@ def find(criteria):
 	return result
 
 ## GLD data communications functions for VI ##
-def convert(list):
-	'''
-	convert() converts integer list to string list and joins the list using join() (used to format data to send to Julia)
-	'''
-	res = " ".join(map(str, list))
-	return res
-
 def convert_power_units(str_val,in_unit,out_unit):
 	'''
 	convert_power_units() takes in args:
@@ -144,59 +273,37 @@ def convert_power_units(str_val,in_unit,out_unit):
 		val = float(str_val.strip(' '+in_unit))
 	return val * cnvrt[out_unit]/cnvrt[in_unit]
 
-def shutoff_loads(node):
+def shutoff_loads(*nodes):
 	'''
-	shutoff_loads(node) shuts down all loads at the given node:
-		- shuts down any generator inverters with "supernode_name"==node
-		- changes all triplex_meters with "supernode_name"==node to "OUT_OF_SERVICE"
-		- all water heaters with "supernode_name"==node will also be manually shut off
+	shutoff_loads(node,...) shuts down all loads at the given nodes in one pass over their cached device sets:
+		- shuts down any generator inverters with "supernode_name" in nodes
+		- changes all triplex_meters with "supernode_name" in nodes to "OUT_OF_SERVICE"
+		- all water heaters with "supernode_name" in nodes will also be manually shut off
 	'''
-	meters = find('class=triplex_meter')
-	inverters = find('class=inverter')
+	inverters = sorted(topology.devices(nodes,'inverters'))
+	if inverters:
+		clock = gridlabd.get_global("clock")
 	for inv in inverters:
-		if gridlabd.get_value(inv,"supernode_name")==node:
-			gridlabd.set_value(inv,"P_Out","0")
-			gridlabd.set_value(inv,"generator_status","OFFLINE")
-			with open(f'{inv}-P_Out.csv','a+') as file:
-				file.write(f'{gridlabd.get_global("clock")}, 0\n')
-	for m in meters:
-		if gridlabd.get_value(m,'supernode_name')==node:
-			gridlabd.set_value(m,'service_status',"OUT_OF_SERVICE")
-	if node in device_map:
-		for w in device_map[node]['waterheaters']:
-			gridlabd.set_value(w,'re_override',"OV_OFF")
+		gridlabd.set_value(inv,"P_Out","0")
+		gridlabd.set_value(inv,"generator_status","OFFLINE")
+		telemetry.record(clock,inv,0)
+	for m in sorted(topology.devices(nodes,'meters')):
+		gridlabd.set_value(m,'service_status',"OUT_OF_SERVICE")
+	waterheaters = sorted(topology.devices(nodes,'waterheaters'))
+	for w in waterheaters:
+		gridlabd.set_value(w,'re_override',"OV_OFF")
+	if actuator is not None:
+		actuator.forget(*waterheaters)
 	return True
 
 def shutoff_noislanding(faulted_node):
 	'''
 	takes in a supernode and shuts off all loads connected to it or downstream in the network in gridlabd
+		- walks the cached branch adjacency (closed branches only, from -> to), each node and branch is visited once
 	'''
-	branchkind = {'switch':'switch',
-				  'overhead_line':'fixed',
-				  'underground_line':'fixed'}
-	switchstat = {'CLOSED':True,'OPEN':False}
-	branches = []
-	for cl in branchkind:
-		branches += find('class={}'.format(cl))
-	openswitches = [br for br in branches if ((gridlabd.get_value(br,'to') == faulted_node) or gridlabd.get_value(br,'from') == faulted_node)]
-	turnoff = [faulted_node]
-	next = [faulted_node]
-	while next:
-		new_next = []
-		for node in next:
-			to_next = [br for br in branches if gridlabd.get_value(br,'from') == node]
-			next_nodes = []
-			for link in to_next:
-				if switchstat[gridlabd.get_value(link,'status')]:
-					next_nodes.append(gridlabd.get_value(link,'to'))
-			for n in next_nodes:
-				turnoff.append(n)
-			new_next += next_nodes
-		next = new_next
-	for node in turnoff:
-		shutoff_loads(node)
-
-	openswitches = [s for s in openswitches if (('solar' not in s) and ('battery' not in s) and (gridlabd.get_value(s,"status")=="CLOSED"))]
+	shutoff_loads(*topology.downstream_nodes(faulted_node))
+
+	openswitches = [s for s in topology.incident.get(faulted_node,[]) if (('solar' not in s) and ('battery' not in s) and (topology.closed[s]))]
 	return openswitches
 
 def toggle_switches(switchlist):
@@ -211,17 +318,17 @@ def toggle_switches(switchlist):
 		toggle_switches += switchlist[-1]
 	gridlabd.set_value("scheme_1", "armed", toggle_switches)
 	gridlabd.set_value("scheme_1", "status", "TOGGLE")
+	topology.toggle(switchlist)
 
+@profiler.phase('new_fault_detected')
 def new_fault_detected():
 	'''
 	check all supernodes in model to see if new faults have occurred
 	'''
 	global faulted_nodes
-	nodestr = gridlabd.get_value("supernode_list","node_group").replace("'",'').replace(" ","")[2:-2]
-	supernodes = nodestr.split(',')
 	faultchange = False
 	tobool = {"TRUE":True,"FALSE":False}
-	for sn in supernodes:
+	for sn in topology.supernodes:
 		# loop through supernodes getting fault status
 		faulted = tobool[gridlabd.get_value(sn,"supernode_fault")]
 		if faulted:
@@ -241,9 +348,6 @@ def get_islanding_data(faulted_nodes):
 	'''
 	loops through gridlabd objects to collect and structure data for absorption_ice julia server
 	'''
-	branchkind = {'switch':'switch',
-				  'overhead_line':'fixed',
-				  'underground_line':'fixed'}
 	switchstat = {'CLOSED':1,'OPEN':0}
 	genstat = {'OFFLINE':0,'ONLINE':1}
 	branchdata = {}
@@ -251,22 +355,20 @@ def get_islanding_data(faulted_nodes):
 	batdata = {}
 	shuntdata = {}
 	meter2bus = {}
-	# get branch data
-	for cl in branchkind:
-		branches = find('class={}'.format(cl))
-		for bid in branches:
-			branchdata[bid] = {}
-			branchdata[bid]['t'] = re.search(r'\d+',gridlabd.get_value(bid,'to')).group()
-			branchdata[bid]['f'] = re.search(r'\d+',gridlabd.get_value(bid,'from')).group()
-			branchdata[bid]['status'] = switchstat[gridlabd.get_value(bid,'status')]
-			branchdata[bid]['kind'] = branchkind[cl]
+	# get branch data (endpoints are static and come from the cached topology)
+	for bid,branch in topology.branches.items():
+		branchdata[bid] = {}
+		branchdata[bid]['t'] = branch['t']
+		branchdata[bid]['f'] = branch['f']
+		branchdata[bid]['status'] = switchstat[gridlabd.get_value(bid,'status')]
+		branchdata[bid]['kind'] = branch['kind']
 	# get load data
 	meters = find('class=meter')
 	tmeters = find('class=triplex_meter')
 	powerMW = {m:0 for m in meters}
 	for t in tmeters:
 		Pval = convert_power_units(gridlabd.get_value(t,'measured_real_power'),'W','MW')
-		snode = gridlabd.get_value(t,'supernode_name')
+		snode = catalog.get(t,'supernode_name')
 		powerMW[snode]+=Pval
 	for mid in powerMW:
 		shuntdata[mid] = {}
@@ -286,8 +388,7 @@ def get_islanding_data(faulted_nodes):
 	for bid in batteries:
 		batdata[bid] = {}
 		batdata[bid]['bus'] = re.search(r'\d+',bid).group()
-		b_dict = dict(gridlabd.get_object(bid))
-		inv = b_dict['parent']
+		inv = catalog.parent(bid)
 		Pmax = gridlabd.get_value(inv,'max_charge_rate')
 		batdata[bid]['Pmax'] = convert_power_units(Pmax,'W','MW')
 		soc = float(gridlabd.get_value(bid,'state_of_charge').split(' ')[0])
@@ -295,50 +396,42 @@ def get_islanding_data(faulted_nodes):
 		Emax = gridlabd.get_value(bid,'battery_capacity')
 		batdata[bid]['Emax'] = convert_power_units(Emax,'Wh','MWh')
 		batdata[bid]['status'] =  genstat[gridlabd.get_value(bid,'generator_status')]
-	nodestr = gridlabd.get_value("supernode_list","node_group").replace("'",'').replace(" ","")[2:-2]
-	supernodes = nodestr.split(',')
-	for sn in supernodes:
-		if gridlabd.get_value(sn,'bustype')=='SWING':
-			gendata['swing_'+sn] = {}
-			gendata['swing_'+sn]['bus'] = re.search(r'\d+',sn).group()
-			gendata['swing_'+sn]['Pmin'] = 0
-			gendata['swing_'+sn]['Pmax'] = 1000 # MW
-			gendata['swing_'+sn]['status'] = 1
-			gendata['swing_'+sn]['solar'] = 0
-
-	# reformat into dataframes
-	gen_df = pd.DataFrame(gendata).transpose()
-	bat_df = pd.DataFrame(batdata).transpose()
-	shunt_df = pd.DataFrame(shuntdata).transpose()
-	shunt_df = shunt_df.loc[shunt_df.P>0,:]
-	branch_df = pd.DataFrame(branchdata).transpose()
-	branch_df = branch_df.loc[branch_df.t!=branch_df.f,:]
-	branch_df['X'] = 0.1
-	branch_df['R'] = 0
-	branch_df['id'] = branch_df.index
-	buses = set(list(branch_df.t)+list(branch_df.f))
+	if topology.swing:
+		sn = topology.swing
+		gendata['swing_'+sn] = {}
+		gendata['swing_'+sn]['bus'] = topology.swing_id
+		gendata['swing_'+sn]['Pmin'] = 0
+		gendata['swing_'+sn]['Pmax'] = 1000 # MW
+		gendata['swing_'+sn]['status'] = 1
+		gendata['swing_'+sn]['solar'] = 0
+
+	# reformat into columns (branches connecting a bus to itself and shunts without load are dropped)
+	branch_ids = [bid for bid in branchdata if branchdata[bid]['t'] != branchdata[bid]['f']]
+	shunt_ids = [mid for mid in shuntdata if shuntdata[mid]['P'] > 0]
+	branch_t = np.array([branchdata[bid]['t'] for bid in branch_ids],dtype=np.int64)
+	branch_f = np.array([branchdata[bid]['f'] for bid in branch_ids],dtype=np.int64)
 	# create 1:nbus node indices for optimization
-	nbus = len(buses)
-	busids = list(range(1,nbus+1))
-	busmap = {int(b):i for i,b in zip(busids,sorted(list(buses)))}
-	branch_df.t = [busmap[int(t)] for t in branch_df.t]
-	branch_df.f = [busmap[int(f)] for f in branch_df.f]
-	gen_df.bus = [busmap[int(f)] for f in gen_df.bus]
-	bat_df.bus = [busmap[int(f)] for f in bat_df.bus]
-	shunt_df.bus  = [busmap[int(f)] for f in shunt_df.bus]
+	buses = np.unique(np.concatenate([branch_t,branch_f]))
+	busmap = {int(b):i+1 for i,b in enumerate(buses)}
 
 	# format into one datadump for zmq server
 	datadump = {'op':'islanding'}
-	for c in ['id','t','f','R','X','status','kind']:
-		datadump['branch_'+c] = convert(list(branch_df[c]))
-	for c in ['bus','Pmin','Pmax','status','solar']:
-		datadump['gen_'+c] = convert(list(gen_df[c]))
-	for c in ['bus','Pmax','status','Emax','soc']:
-		datadump['bat_'+c] = convert(list(bat_df[c]))
-	for c in ['bus','P']:
-		datadump['shunt_'+c] = convert(list(shunt_df[c]))
-	fnodes = [busmap[int(re.search(r'\d+',n).group())] for n in faulted_nodes]
-	datadump['faulted_nodes'] = convert(fnodes)
+	datadump['branch_id'] = branch_ids
+	datadump['branch_t'] = np.searchsorted(buses,branch_t)+1
+	datadump['branch_f'] = np.searchsorted(buses,branch_f)+1
+	datadump['branch_R'] = np.zeros(len(branch_ids))
+	datadump['branch_X'] = np.full(len(branch_ids),0.1)
+	datadump['branch_status'] = [branchdata[bid]['status'] for bid in branch_ids]
+	datadump['branch_kind'] = [branchdata[bid]['kind'] for bid in branch_ids]
+	for c in ['Pmin','Pmax','status','solar']:
+		datadump['gen_'+c] = [gendata[gid][c] for gid in gendata]
+	datadump['gen_bus'] = [busmap[int(gendata[gid]['bus'])] for gid in gendata]
+	for c in ['Pmax','status','Emax','soc']:
+		datadump['bat_'+c] = [batdata[bid][c] for bid in batdata]
+	datadump['bat_bus'] = [busmap[int(batdata[bid]['bus'])] for bid in batdata]
+	datadump['shunt_bus'] = [busmap[int(shuntdata[mid]['bus'])] for mid in shunt_ids]
+	datadump['shunt_P'] = [shuntdata[mid]['P'] for mid in shunt_ids]
+	datadump['faulted_nodes'] = [busmap[int(re.search(r'\d+',n).group())] for n in faulted_nodes]
 
 	# save bus map to map indices back to actual node names
 	mapback = {busmap[b]:b for b in busmap}
@@ -347,18 +440,24 @@ def get_islanding_data(faulted_nodes):
 ####
 
 ## virtual islanding functions ##
+@profiler.phase('islanding')
 def islanding(t,faulted_nodes):
 	'''
 	islanding takes in the list of faulted nodes and the time stamp,
 		collects the needed data from GLD using get_islanding_data,
-		sends the data through the julia server,
+		sends the data through the julia server, unless the islanding cache holds the result of an equivalent payload,
 		recieves back the results of branch statuses from the server,
 		and returns :
 					: branch results as a pandas df
 					: the list of bus ids with solar generators at them (for plotting purposes)
 	'''
 	VI_data,busmap = get_islanding_data(faulted_nodes)
-	res = julia_client.send_data(VI_data)
+	key = islanding_cache.key(VI_data) if islanding_cache is not None else None
+	res = islanding_cache.get(key) if key else None
+	if res is None:
+		res = julia_client.send_data(VI_data)
+		if key:
+			islanding_cache.put(key,res)
 	branch_results = json.loads(str(res)[2:-1])
 	results = pd.DataFrame(branch_results['columns'],
 				index = branch_results['colindex']['names']).transpose()
@@ -367,32 +466,7 @@ def islanding(t,faulted_nodes):
 	curr_stat = results.st1.astype(bool)
 	return results
 
-def get_components(graph):
-	'''
-	gets the connected components from a graph:
-	 	graph as dict: {node:{set of nodes node is connected to}}
-	'''
-	already_seen = set()
-	result = []
-	for node in graph:
-		if node not in already_seen:
-			connected_group, already_seen = get_connected_group(graph, node, already_seen)
-			result.append(connected_group)
-	return result
-
-def get_connected_group(graph, node, already_seen):
-	'''
-	gets connected group for node in graph, given a set of already visited nodes connected to root node
-	'''
-	result = []
-	nodes = set([node])
-	while nodes:
-		node = nodes.pop()
-		already_seen.add(node)
-		nodes.update(graph[node] - already_seen)
-		result.append(node)
-	return result, already_seen
-
+@profiler.phase('process_islands')
 def process_islands(t,results):
 	'''
 	takes in branch results and generators and performs switching operations to create islands in gridlabd
@@ -402,20 +476,15 @@ def process_islands(t,results):
 	switches_to_open = list(results.loc[results.st00!=results.st1,'id'])
 	toggle_switches(switches_to_open)
 
-	supernodes = set(list(results.t)+list(results.f))
-	# figure out if the network is islanded and get new_islands
-	links = [(results.loc[i,'t'],results.loc[i,'f']) for i in results.index if results.loc[i,'st1']]
-	net = {n:[[l[0],l[1]] for l in links if n in l] for n in supernodes}
-	net = {n:[[l for l in net[n][i] if l != n] for i in range(len(net[n]))] for n in supernodes}
-	net = {n:set([l[0] for l in net[n]]) for n in supernodes}
-	new_islands = get_components(net)
-	inverters = find('class=inverter')
+	# figure out if the network is islanded and get new_islands (connected components of the closed branches)
+	closed = results.st1.values.astype(bool)
+	new_islands = connected_components(results.f.values[closed],results.t.values[closed],
+		nodes=np.concatenate([results.t.values,results.f.values]))
 	virtual_islands = []
 	for island in new_islands:
 		if (swing_sn not in island):
-			for i in inverters:
-				if int(re.search(r'\d+',i).group()) in island:
-					gridlabd.set_value(i,'islanded_state','TRUE')
+			for i in topology.inverters(island):
+				gridlabd.set_value(i,'islanded_state','TRUE')
 		if ((swing_sn not in island) and ("supernode_{:03d}".format(island[0]) not in faulted_nodes)):
 			virtual_islands.append(island)
 
@@ -428,66 +497,102 @@ def temp_control_absorption(house_id,t):
 	turns on basic GLD temperature control logic, responding to air temp and heating and cooling set points for each household
 	'''
 	gridlabd.set_value(house_id,"thermostat_control","FULL")
+	if actuator is not None:
+		actuator.forget(house_id)
 	return True
 
 # virtual battery functions for packetized absorption #
 def map_devices_to_nodes():
 	'''
 	creates and returns a dict to map all houses and waterheaters to the supernodes they are connected to
+		(the map is cached by the supernode topology, this refreshes it from the object catalog)
 	'''
-	houses = find("class=house")
-	waterheaters = find("class=waterheater")
-	nodestr = gridlabd.get_value("supernode_list","node_group").replace("'",'').replace(" ","")[2:-2]
-	supernodes = nodestr.split(',')
-	device_map = {n:{} for n in supernodes}
-	for node in supernodes:
-		device_map[node]['houses'] = set([h for h in houses if gridlabd.get_value(h,"supernode_name") == node])
-		device_map[node]['waterheaters'] = set([w for w in waterheaters if gridlabd.get_value(w,"supernode_name") == node])
-	return device_map
+	topology.refresh_devices()
+	return topology.device_map
 
 def initialize_devices(t):
 	'''
 	intialized GLD / VB devices by creating device map and all virtual battery device objects for water heaters and hvac systems in GLD model
+		- all devices share one DeviceSnapshot, which reads their state from GLD once per commit
 	'''
 	global all_devices
 	global device_map
-	device_map = map_devices_to_nodes()
+	global device_snapshot
+	global actuator
+	global vb_recorder
+	device_map = topology.device_map
 	waterheaters = find('class=waterheater')
 	houses = find('class=house')
 	if ((Packetizing) and (Absorption)):
-		all_devices = {wh:vb_device(gldWaterHeater(wh,gridlabd),
-			state_ends_at=t-t_start) for wh in waterheaters}
-		all_devices.update({h:vb_device(gldHVAC(h,gridlabd),
-			state_ends_at=t-t_start) for h in houses})
-
+		record_VB = vb_data_out or test_setpoint # the setpoint tracking test always writes the VB time series
+		device_snapshot = DeviceSnapshot(gridlabd,waterheaters,houses,water_demand=record_VB).refresh(t)
+		actuator = Actuator()
+		all_devices = {wh:vb_device(gldWaterHeater(wh,gridlabd,snapshot=device_snapshot),
+			state_ends_at=t-t_start,in_place=vb_in_place) for wh in waterheaters}
+		all_devices.update({h:vb_device(gldHVAC(h,gridlabd,snapshot=device_snapshot),
+			state_ends_at=t-t_start,in_place=vb_in_place) for h in houses})
+		if record_VB:
+			vb_recorder = VBRecorder(device_snapshot,all_devices.values(),get_global("VB_DATA_FILE","virtual_battery_timeseries.csv"))
+
+@profiler.phase('update_VB')
 def update_VB(islands):
 	'''
-	recreate and returns new dict of Virtual Battery objects, one for each island of supernodes
+	updates the dict of Virtual Battery objects, one for each island of supernodes, to the new islands and returns it
+		- an island that didn't change keeps its virtual battery, house pool and power balance
+		- the devices of a new island move from the virtual batteries of the islands that split or merged into it with their current records (the soc moves with them), devices that weren't islanded join from all_devices
+		- houses shed in an island that split or merged stay disconnected in the island that takes them
+		- the per island entries (house pool, power balance, baseline data) of the islands that split or merged are dropped
 	'''
 	global islanded_devices
 	global device_map
+	global house_pools
+	global powerbal
+	global island_baseline
+	global load_per_house
 	if not device_map:
 		device_map = map_devices_to_nodes()
 
-	# get swing bus:
-	nodestr = gridlabd.get_value("supernode_list","node_group").replace("'",'').replace(" ","")[2:-2]
-	supernodes = nodestr.split(',')
+	old_Virtual_Battery = Virtual_Battery or {}
+	new_keys = set(tuple(island) for island in islands)
+	dissolved = [key for key in old_Virtual_Battery if key not in new_keys]
+	shed = set()
+	for key in dissolved:
+		for h in house_pools[key].disconnected:
+			shed.update([h,'waterheater_{}'.format(h.strip('house_'))])
 
 	new_Virtual_Battery = {}
-	islanded_devices = []
-	for i,island in enumerate(islands):
-		i_houses = set([])
-		i_waterheaters = set([])
-		for node in island:
-			i_houses.update(device_map['supernode_{:03d}'.format(node)]['houses'])
-			i_waterheaters.update(device_map['supernode_{:03d}'.format(node)]['waterheaters'])
-		devices = [all_devices[wh] for wh in i_waterheaters] + [all_devices[h] for h in i_houses]
-		islanded_devices += i_houses
-		islanded_devices += i_waterheaters
-		new_Virtual_Battery[tuple(island)] = VirtualBattery(devices=devices)
+	for island in islands:
+		key = tuple(island)
+		if key in old_Virtual_Battery:
+			new_Virtual_Battery[key] = old_Virtual_Battery[key]
+			continue
+		options = {'scheduled':True} if vb_scheduled else {}
+		VB = VB_ENGINES[vb_engine](seed=island_seed(vb_seed,island),arbitration=vb_arbitration,arbitration_log=arbitration_log,**options)
+		i_houses = sorted(topology.devices(island,'houses'))
+		i_waterheaters = sorted(topology.devices(island,'waterheaters'))
+		for dev in i_waterheaters + i_houses:
+			old_VB = old_Virtual_Battery.get(islanded_devices.get(dev))
+			if dev not in shed:
+				VB.add_device(old_VB.devices[dev] if ((old_VB is not None) and (dev in old_VB.devices)) else all_devices[dev])
+			islanded_devices[dev] = key
+		new_Virtual_Battery[key] = VB
+		house_pools[key] = HousePool([h for h in i_houses if h not in shed])
+		for h in i_houses:
+			if h in shed:
+				house_pools[key].disconnected.add(h)
+		powerbal[key] = {'solarP':0,'nfload':0,'battP':{},'VBload':device_snapshot.total_kw(VB.devices.keys())}
+	for key in dissolved:
+		for dev in topology.devices(key,'houses') | topology.devices(key,'waterheaters'):
+			if islanded_devices.get(dev) == key:
+				islanded_devices.pop(dev)
+		house_pools.pop(key)
+		powerbal.pop(key,None)
+		island_baseline.pop(key,None)
+		load_per_house.pop(key,None)
 	if len(new_Virtual_Battery.keys())==0 : return None
 	else : return new_Virtual_Battery
 
+@profiler.phase('packetize_island')
 def packetize_island(t,island):
 	'''
 	uses code from packetized module implement virtual batteries from all HVAC systems and water heaters in the model for a particular island
@@ -496,57 +601,47 @@ def packetize_island(t,island):
 	global Virtual_Battery
 	load = 0
 	i = tuple(island)
-	device_updates = [d.update() for d in Virtual_Battery[i].devices.values()]
+	device_updates = Virtual_Battery[i].device_updates()
 	effects, load = Virtual_Battery[i].next(
 					device_updates=device_updates,
 					setpoint=Virtual_Battery[i].setpoint,
 					time=t-t_start
 					)
-	for effect in effects.turn_on+effects.turn_off:
-		effect.send()
+	actuator.send(effects,t)
 
-	load = np.sum([d.gld_dev.update_from_gld().kw for d in Virtual_Battery[i].devices.values()])
+	load = device_snapshot.total_kw(Virtual_Battery[i].devices.keys())
 
 	return load
 
+@profiler.phase('get_island_baseline_data')
 def get_island_baseline_data(islands):
 	'''
-	gets baseline loads and solar generator power from Loads_baseline.csv and Ps_baseline.csv (generated in baseline run with function timeseries_persupernode() in data_post_process.py)
-	 	- parses these csv files to aggregate loads for each island that has formed in the circuit for island management optimization
+	aggregates the baseline loads and solar generator power (Loads_baseline.csv and Ps_baseline.csv generated in baseline run with function timeseries_persupernode() in data_post_process.py, loaded once in the baseline matrix)
+	 	- sums the supernode rows of each island that has formed in the circuit, the result is sent with the island's management requests
 	'''
+	global load_per_house
+	global island_baseline
+	online = {inv:(gridlabd.get_value(inv,'generator_status')=='ONLINE') for inv in set(baseline.solar_inverters)}
 	for island in islands:
-		global load_per_house
-		baseline_loads = pd.read_csv("Loads_baseline.csv")
-		island_loads = baseline_loads[['timestamp']]
-		island_loads.index = island_loads.timestamp
-		island_loads['f_baseline'] = 0
-		island_loads = island_loads.drop('timestamp',axis=1)
-		island_loads['nf_baseline'] = 0
-		for n in island:
-			if 'hvac_load_{:03d}[kW]'.format(n) in baseline_loads.columns:
-				island_loads.f_baseline += baseline_loads['hvac_load_{:03d}[kW]'.format(n)].values
-				island_loads.f_baseline += baseline_loads['wh_load_{:03d}[kW]'.format(n)].values
-				island_loads.nf_baseline += baseline_loads['total_load_{:03d}[kW]'.format(n)].values
+		f_baseline,total_baseline = baseline.island_loads(island)
 		nhouses = len(island)*60
-		load_per_house[tuple(island)] = island_loads.nf_baseline.mean()/nhouses
-		island_loads.nf_baseline = island_loads.nf_baseline - island_loads.f_baseline
-		baseline_solar = pd.read_csv("Ps_baseline.csv")
-		print(baseline_solar.max())
-		island_gens = baseline_solar[[c for c in baseline_solar.columns[1:] if ((int(re.search(r'\d+',c).group()) in island) and (gridlabd.get_value(c.split(':')[0].strip(' '),'generator_status')=='ONLINE'))]]
-		island_gens.index = baseline_loads.timestamp
-		island_str = "_".join(map(str, sorted(island)))
-		with open('load_baseline-{}.csv'.format(island_str), mode='w', newline='') as load_baseline_csv_file:
-			island_loads.to_csv(load_baseline_csv_file)
-		with open('solar_baseline-{}.csv'.format(island_str), mode='w', newline='') as solar_baseline_csv_file:
-			island_gens.to_csv(solar_baseline_csv_file)
+		load_per_house[tuple(island)] = total_baseline.mean()/nhouses
+		solar_columns,solar_baseline = baseline.island_solar(island,online)
+		island_baseline[tuple(island)] = {'baseline_timestamp':baseline.timestamps,
+										  'f_baseline':f_baseline,
+										  'nf_baseline':total_baseline-f_baseline,
+										  'solar_columns':solar_columns,
+										  'solar_baseline':solar_baseline.ravel()} # one inverter after the other
 		# disable reserve soc for batteries
 		batteries = find('class=inverter')
-		batteries = [b for b in batteries if ((int(re.search(r'\d+',gridlabd.get_value(b,'supernode_name')).group()) in island) and ('battery' in b))]
+		batteries = [b for b in batteries if ((int(re.search(r'\d+',catalog.get(b,'supernode_name')).group()) in island) and ('battery' in b))]
 		for b in batteries:
 			gridlabd.set_value(b,'four_quadrant_control_mode','CONSTANT_PQ')
 			gridlabd.set_value(b,'soc_reserve','0.0')
+			battery_ratings.pop(b,None)
+			battery_rating(b) # cached for check_power_balance
 		solar = find('class=inverter')
-		solar = [b for b in solar if ((int(re.search(r'\d+',gridlabd.get_value(b,'supernode_name')).group()) in island) and ('solar' in b))]
+		solar = [b for b in solar if ((int(re.search(r'\d+',catalog.get(b,'supernode_name')).group()) in island) and ('solar' in b))]
 		for s in solar:
 			print(s,gridlabd.get_value(s,'rated_power'))
 			gridlabd.set_value(s,'four_quadrant_control_mode','CONSTANT_PQ')
@@ -556,7 +651,7 @@ def get_island_baseline_data(islands):
 def get_island_management_data(island):
 	'''
 	retrieves and formats island management optimization data to send to julia server:
-	 	island  : island string to match to csv files for baseline loads and solar
+	 	island  : island string (supernode ids joined by _), names the VB setpoint in the results
 		t0 		: start time for optimization (from GLD clock)
 		t_inc	: global variable of time step of island management
 		solargens: list of online solar generators
@@ -568,49 +663,53 @@ def get_island_management_data(island):
 		Emax_virtualb: estimated max soc of VB (based on number of devices in island)
 		gens 	: list of non-solar generators (not implemented yet)
 		Pmax_gens: max power of non-solar generators (not implemented yet)
+		baseline_timestamp, f_baseline, nf_baseline: baseline flexible and nonflexible loads of the island
+		solar_columns, solar_baseline: baseline power of its online solar generators, one column after the other
 	'''
 	datadump = {'op':'management'}
 	island_str = "_".join(map(str, sorted(island)))
 	datadump['island'] = island_str
+	datadump.update(island_baseline[tuple(island)])
 	datadump['t0'] = gridlabd.get_global("clock")
 	datadump['t_inc'] = t_inc
-	batteries = [b for b in find('class=battery') if ((int(re.search(r'\d+',gridlabd.get_value(b,'supernode_name')).group()) in island) and (gridlabd.get_value(b,'generator_status')=='ONLINE'))]
-	solar = [s for s in find('class=solar') if ((int(re.search(r'\d+',gridlabd.get_value(s,'supernode_name')).group()) in island) and (gridlabd.get_value(s,'generator_status')=='ONLINE'))]
-	datadump['solargens'] = convert(solar)
+	batteries = [b for b in find('class=battery') if ((int(re.search(r'\d+',catalog.get(b,'supernode_name')).group()) in island) and (gridlabd.get_value(b,'generator_status')=='ONLINE'))]
+	solar = [s for s in find('class=solar') if ((int(re.search(r'\d+',catalog.get(s,'supernode_name')).group()) in island) and (gridlabd.get_value(s,'generator_status')=='ONLINE'))]
+	datadump['solargens'] = solar
 	E0_battery = []
 	Emax_battery = []
 	Pmax_battery = []
 	for b in batteries:# need to add check for if battery & solar are online
 		E0_battery.append(float(gridlabd.get_value(b,"state_of_charge").split(' ')[0])*convert_power_units(gridlabd.get_value(b,"battery_capacity"),'Wh','kW'))
 		Emax_battery.append(convert_power_units(gridlabd.get_value(b,"battery_capacity"),'Wh','kW'))
-		b_dict = dict(gridlabd.get_object(b))
-		inv = b_dict['parent']
+		inv = catalog.parent(b)
 		Pmax = gridlabd.get_value(inv,'max_charge_rate')
 		Pmax_battery.append(convert_power_units(Pmax,'W','kW'))
-	datadump['batteries'] = convert(batteries)
-	datadump['E0_battery'] = convert(E0_battery)
-	datadump['Emax_battery'] = convert(Emax_battery)
-	datadump['Pmax_battery'] = convert(Pmax_battery)
-	datadump['E0_virtualb'] = convert([Virtual_Battery[tuple(island)].soc])
+	datadump['batteries'] = batteries
+	datadump['E0_battery'] = E0_battery
+	datadump['Emax_battery'] = Emax_battery
+	datadump['Pmax_battery'] = Pmax_battery
+	datadump['E0_virtualb'] = [float(Virtual_Battery[tuple(island)].soc)]
 	ndev = len(Virtual_Battery[tuple(island)].devices.keys())
-	datadump['Emax_virtualb'] = convert(list([ndev*5]))
-	datadump['gens'] = convert([]) # would be where we add other types of generators if they exist in the network model
-	datadump['Pmax_gens'] = convert([])
+	datadump['Emax_virtualb'] = [ndev*5]
+	datadump['gens'] = [] # would be where we add other types of generators if they exist in the network model
+	datadump['Pmax_gens'] = []
 
 	return datadump
 
 def turn_off_house(island,h):
 	'''
 	turns off house h and water heater in house and removes both devices from the Virtual_Battery for given island
+		- a device that already left the VB (no effect in its last step) is still turned off in gridlabd
 	'''
 	wh = 'waterheater_{}'.format(h.strip('house_'))
-	try:
-		Virtual_Battery[tuple(island)].devices[h].gld_dev.turn_off()
-		Virtual_Battery[tuple(island)].devices.pop(h)
-		Virtual_Battery[tuple(island)].devices[wh].gld_dev.turn_off()
-		Virtual_Battery[tuple(island)].devices.pop(wh)
-	except:
-		print(h,' or ',wh, 'not found in VB devices...')
+	for dev in [h,wh]:
+		try:
+			device = Virtual_Battery[tuple(island)].remove_device(dev)
+		except KeyError:
+			device = all_devices.get(dev)
+		if device is not None:
+			device.gld_dev.turn_off()
+	actuator.forget(h,wh)
 	gridlabd.set_value('meter_{}'.format(h.split('_')[1]),'customer_interrupted','TRUE')
 
 def turn_on_house(island,h,t):
@@ -625,13 +724,15 @@ def turn_on_house(island,h,t):
 	Virtual_Battery[tuple(island)].add_device(all_devices[wh])
 	gridlabd.set_value('meter_{}'.format(h.split('_')[1]),'customer_interrupted','FALSE')
 
+@profiler.phase('island_management')
 def island_management(t):
 	'''
 	runs island management julia optimization for each island not attached to the SWING bus
+		- the requests of all islands are submitted before any result is awaited, results are collected with the JULIA_TIMEOUT deadline
+		- an island whose optimization doesn't answer in time keeps its current setpoints for this step
 	'''
-	global houses_off
 	global Virtual_Battery
-	global powerbal
+	requests = {}
 	for island in islands:
 		# aggregate load data from baseline
 		island_data = get_island_management_data(island)
@@ -639,110 +740,132 @@ def island_management(t):
 			island_data["test_out"]=1
 		else:
 			island_data["test_out"]=0
-		res = julia_client.send_data(island_data)
-		results = json.loads(str(res)[2:-1])
-		results = pd.DataFrame(results['columns'], index = results['colindex']['names']).transpose()
-		#print('DATA:',island_data)
-		#print('RESULTS:',results)
-		Pbal = {'solarP':0, 'nfload':results.nfload.values[0], 'battP':{}, 'VBload':0}
-		for c in sorted(results.columns,reverse=True):
-			if ('solar' in c):
-				Pout = float(results[c].values[0]) # kW
-				inv = c.split(":")[0].strip(' ')
-				gridlabd.set_value(inv, "P_Out", '{:.02f} kW'.format(Pout))
-				with open(f'{inv}-P_Out.csv','a+') as file:
-					file.write(f'{gridlabd.get_global("clock")}, {Pout}\n')
-				Pbal['solarP'] += Pout
-			elif ('shed' in c):
-				load_shed = float(results[c].values[0])
-				Pbal['nfload'] = Pbal['nfload']-load_shed
-				if load_shed>0:
-					if round(Virtual_Battery[tuple(island)].setpoint - load_shed) >= 0:
-						Virtual_Battery[tuple(island)].setpoint = Virtual_Battery[tuple(island)].setpoint - load_shed
-						disconnect_houses = 0
-					elif (bool(results["sh_all"].values[0]) and (round(Virtual_Battery[tuple(island)].setpoint)==0)):
-						disconnect_houses = np.sum([len(device_map['supernode_{:03d}'.format(n)]['houses']) for n in island])
-					else:
-						disconnect_houses = int(round(load_shed/load_per_house[tuple(island)]))
-					reconnect_houses = 0
-					if disconnect_houses >= len(houses_off):
-						disconnect_houses = disconnect_houses - len(houses_off)
-					elif disconnect_houses < len(houses_off):
-						reconnect_houses = len(houses_off) - disconnect_houses
-					for n in range(disconnect_houses):
-						i = np.random.choice([i for i in island if i >= 100])
-						if len([d for d in Virtual_Battery[tuple(island)].devices.keys() if 'house' in d]) > 0:
-							h = np.random.choice([d for d in Virtual_Battery[tuple(island)].devices.keys() if 'house' in d],size=1)[0]
-							turn_off_house(island,h)
-							houses_off.append(h)
-					for n in range(reconnect_houses):
-						h = np.random.choice(houses_off)
-						turn_on_house(island,h,t)
-						houses_off = [i for i in houses_off if i!=h]
-					print('disconnect houses:',disconnect_houses)
-					print('reconnect houses:',reconnect_houses)
-			elif ('i_' in c):
-				VB_load = float(results[c].values[0])
-				Virtual_Battery[tuple(island)].setpoint = VB_load
-				newVBload = packetize_island(t,island)
-				Pbal['VBload'] = newVBload
-			elif ('battery' in c):
-				b_dict = dict(gridlabd.get_object(c))
-				inv = b_dict['parent']
-				Pout = -float(results[c].values[0])
-				gridlabd.set_value(inv, "P_Out", '{:.02f} kW'.format(Pout))
-				with open(f'{inv}-P_Out.csv','a+') as file:
-					file.write(f'{gridlabd.get_global("clock")}, {Pout}\n')
-				Pbal['battP'][inv] = Pout
-		Pbal = check_power_balance(Pbal)
-		powerbal[tuple(island)] = Pbal
-		if vb_data_out:
-			save_VB_data(Pbal,island)
+		requests[tuple(island)] = julia_client.submit(island_data)
+	responses = julia_client.collect(list(requests.values()),timeout=julia_client.timeout)
+	for island in islands:
+		request_id = requests[tuple(island)]
+		if request_id in responses:
+			manage_island(t,island,responses[request_id])
+		else:
+			print('\n ** island management of island {} timed out, keeping current setpoints'.format(island))
+			Pbal = powerbal.get(tuple(island),{'solarP':0,'nfload':0,'battP':{},'VBload':0})
+			Pbal['VBload'] = packetize_island(t,island)
+			powerbal[tuple(island)] = check_power_balance(Pbal)
+			if vb_data_out:
+				save_VB_data(powerbal[tuple(island)],island)
 
 	return Virtual_Battery
+
+def manage_island(t,island,res):
+	'''
+	applies the island management optimization results res of one island (solar and battery dispatch, load shedding and VB setpoint)
+	'''
+	global Virtual_Battery
+	global powerbal
+	clock = gridlabd.get_global("clock")
+	results = json.loads(str(res)[2:-1])
+	results = pd.DataFrame(results['columns'], index = results['colindex']['names']).transpose()
+	#print('DATA:',island_data)
+	#print('RESULTS:',results)
+	Pbal = {'solarP':0, 'nfload':results.nfload.values[0], 'battP':{}, 'VBload':0}
+	for c in sorted(results.columns,reverse=True):
+		if ('solar' in c):
+			Pout = float(results[c].values[0]) # kW
+			inv = c.split(":")[0].strip(' ')
+			gridlabd.set_value(inv, "P_Out", '{:.02f} kW'.format(Pout))
+			telemetry.record(clock,inv,Pout)
+			Pbal['solarP'] += Pout
+		elif ('shed' in c):
+			load_shed = float(results[c].values[0])
+			Pbal['nfload'] = Pbal['nfload']-load_shed
+			if load_shed>0:
+				if round(Virtual_Battery[tuple(island)].setpoint - load_shed) >= 0:
+					Virtual_Battery[tuple(island)].setpoint = Virtual_Battery[tuple(island)].setpoint - load_shed
+					disconnect_houses = 0
+				elif (bool(results["sh_all"].values[0]) and (round(Virtual_Battery[tuple(island)].setpoint)==0)):
+					disconnect_houses = np.sum([len(device_map['supernode_{:03d}'.format(n)]['houses']) for n in island])
+				else:
+					disconnect_houses = int(round(load_shed/load_per_house[tuple(island)]))
+				pool = house_pools[tuple(island)]
+				houses_off = len(pool.disconnected)
+				reconnect_houses = 0
+				if disconnect_houses >= houses_off:
+					disconnect_houses = disconnect_houses - houses_off
+				elif disconnect_houses < houses_off:
+					reconnect_houses = houses_off - disconnect_houses
+				for h in pool.shed(disconnect_houses):
+					turn_off_house(island,h)
+				for h in pool.restore(reconnect_houses):
+					turn_on_house(island,h,t)
+				print('disconnect houses:',disconnect_houses)
+				print('reconnect houses:',reconnect_houses)
+		elif ('i_' in c):
+			VB_load = float(results[c].values[0])
+			Virtual_Battery[tuple(island)].setpoint = VB_load
+			newVBload = packetize_island(t,island)
+			Pbal['VBload'] = newVBload
+		elif ('battery' in c):
+			inv = catalog.parent(c)
+			Pout = -float(results[c].values[0])
+			gridlabd.set_value(inv, "P_Out", '{:.02f} kW'.format(Pout))
+			telemetry.record(clock,inv,Pout)
+			Pbal['battP'][inv] = Pout
+	Pbal = check_power_balance(Pbal)
+	powerbal[tuple(island)] = Pbal
+	if vb_data_out:
+		save_VB_data(Pbal,island)
 ####
 
+@profiler.phase('check_power_balance')
 def check_power_balance(powerbal):
 	'''
 	after island management is completed, this function checks that the final state of the island is balanced and uses the batteries to balance if not
+		- the imbalance is shared by all batteries of the island in proportion to their headroom (up to max discharge | max charge rate from battery_ratings)
 	'''
 	totload = powerbal['nfload']+powerbal['VBload']
-	batpwr = np.sum([powerbal['battP'][b] for b in powerbal['battP']])
+	batts = list(powerbal['battP'].keys())
+	battP = np.array([powerbal['battP'][b] for b in batts],dtype=float) # kW, GLD treats discharging as positive
+	batpwr = np.sum(battP)
 	solpwr = powerbal['solarP']
 	err = 15
-	batts = list(powerbal['battP'].keys())
 	if totload-err <= (solpwr + batpwr) <= totload+err:
 		pass
-	elif  (solpwr + batpwr) < totload-err: #too much load
-		diff = totload - (solpwr + batpwr)
-		random.shuffle(batts)
-		for b,kW in zip(batts,[powerbal['battP'][b] for b in batts]):
-			if ((kW <= convert_power_units(gridlabd.get_value(b,'max_discharge_rate'), 'W','kW')-diff) and (diff != 0)): # GLD treats discharging as positive
-				newkW = kW + diff
-				gridlabd.set_value(b,'P_Out','{:.02f} kW'.format(newkW))
-				with open(f'{b}-P_Out.csv','a+') as file:
-					file.write(f'{gridlabd.get_global("clock")}, {newkW}\n')
-				powerbal['battP'][b] = newkW
-				diff = 0
-		batpwr = np.sum([powerbal['battP'][b] for b in powerbal['battP']])
-	elif  (solpwr + batpwr) > totload-err: #too much power ouput
-		diff = (solpwr + batpwr) - totload
-		random.shuffle(batts)
-		for b,kW in zip(batts,[powerbal['battP'][b] for b in batts]):
-			if ((-convert_power_units(gridlabd.get_value(b,'max_charge_rate'), 'W','kW')+diff <= kW) and (diff != 0)): # GLD treats discharging as positive
-				newkW = kW - diff
-				gridlabd.set_value(b,'P_Out','{:.02f} kW'.format(newkW))
-				with open(f'{b}-P_Out.csv','a+') as file:
-					file.write(f'{gridlabd.get_global("clock")}, {newkW}\n')
-				powerbal['battP'][b] = newkW
-				diff = 0
-		batpwr = np.sum([powerbal['battP'][b] for b in powerbal['battP']])
-	if np.sum([convert_power_units(gridlabd.get_value(b,'P_Out'), 'VA','kW') for b in powerbal['battP']])>1000:
+	elif len(batts):
+		max_discharge,max_charge = np.array([battery_rating(b) for b in batts],dtype=float).T
+		if (solpwr + batpwr) < totload-err: #too much load
+			diff = totload - (solpwr + batpwr)
+			headroom = np.clip(max_discharge-battP,0,None)
+		else: #too much power ouput
+			diff = (solpwr + batpwr) - totload
+			headroom = -np.clip(battP+max_charge,0,None)
+		total = np.sum(np.abs(headroom))
+		if total > 0:
+			newP = battP + headroom*min(diff/total,1)
+			clock = gridlabd.get_global("clock")
+			for b,kW,newkW in zip(batts,battP.tolist(),newP.tolist()):
+				if newkW != kW:
+					gridlabd.set_value(b,'P_Out','{:.02f} kW'.format(newkW))
+					telemetry.record(clock,b,newkW)
+					powerbal['battP'][b] = newkW
+			battP = newP
+	if np.sum(battP)>1000:
 		print('Large battery P value(s):')
-		print([(b,gridlabd.get_value(b,'P_Out')) for b in powerbal['battP']])
+		print([(b,'{:.02f} kW'.format(powerbal['battP'][b])) for b in batts])
 	return powerbal
 
+def battery_rating(inv):
+	'''
+	returns the (max discharge, max charge) rate [kW] of battery inverter inv, read from GLD once and cached in battery_ratings
+	'''
+	if inv not in battery_ratings:
+		battery_ratings[inv] = (convert_power_units(gridlabd.get_value(inv,'max_discharge_rate'),'W','kW'),
+								convert_power_units(gridlabd.get_value(inv,'max_charge_rate'),'W','kW'))
+	return battery_ratings[inv]
+
 def update_flexible_load():
+	'''
+	sets the flexible_load of every supernode from GLD directly (runs without the packetized module, which publish it every commit through FlexibleLoad)
+	'''
 	for supernode in device_map:
 		flex_kWh = 0
 		for dev,prop in [('houses','hvac_load'), ('waterheaters','actual_load')]:
@@ -750,20 +873,16 @@ def update_flexible_load():
 				flex_kWh += float(gridlabd.get_value(dev_id,prop).split(' ')[0])
 		gridlabd.set_value(supernode,"flexible_load","{:0.1f}".format(flex_kWh)) #units?
 
+@profiler.phase('save_VB_data')
 def save_VB_data(powerbal,island):
-
-	with open('virtual_battery_timeseries.csv', 'a', newline='') as vbcsv:
-		VBcsv_writer = csv.writer(vbcsv)
-		# header row: 'timestamp','VB_soc','VB_avgsoc','VB_load','VB_setpoint','hvac_avgsoc','wh_avgsoc','avg_hvac_temp','avg_wh_temp','avg_out_temp','hvac_load','wh_load','wh_wdemand','nf_shed'
-		houses = [d.gld_dev.id for d in Virtual_Battery[tuple(island)].devices.values() if 'house' in d.gld_dev.id]
-		whs = [d.gld_dev.id for d in Virtual_Battery[tuple(island)].devices.values() if 'waterheater' in d.gld_dev.id]
-		whload = np.sum([convert_power_units(gridlabd.get_value(d,'actual_load'),'kW','kW') for d in whs])
-		hvacload = np.sum([convert_power_units(gridlabd.get_value(d,'hvac_load'),'kW','kW') for d in houses])
-		wh_demand = np.sum([float(gridlabd.get_value(d,'water_demand').strip(' gmp')) for d in whs])
-		VBcsv_writer.writerow([gridlabd.get_global('clock'), Virtual_Battery[tuple(island)].soc, np.mean([d.gld_dev.soc for d in Virtual_Battery[tuple(island)].devices.values()]), powerbal['VBload'], Virtual_Battery[tuple(island)].setpoint, np.mean([d.gld_dev.soc for d in Virtual_Battery[tuple(island)].devices.values() if 'house' in d.device_id]), np.mean([d.gld_dev.soc for d in Virtual_Battery[tuple(island)].devices.values()  if 'waterheater' in d.device_id]), np.mean([d.gld_dev.temperature for d in Virtual_Battery[tuple(island)].devices.values() if 'house' in d.device_id]), np.mean([d.gld_dev.temperature for d in Virtual_Battery[tuple(island)].devices.values() if 'waterheater' in d.device_id]), np.mean([d.gld_dev.outsideT for d in Virtual_Battery[tuple(island)].devices.values() if 'house' in d.device_id]), hvacload, whload, wh_demand, round(powerbal.get('nfload',0),2)])
+	'''
+	records the virtual battery time series row of the island (aggregated from the device snapshot by the VB recorder)
+	'''
+	vb_recorder.record(gridlabd.get_global('clock'),Virtual_Battery[tuple(island)],powerbal['VBload'],powerbal.get('nfload',0))
 
 
 ######### CODE THAT RUNS ON_COMMIT DURING GRIDLAB-D SIMULATION #########
+@profiler.commit
 def on_commit(t):
 	global t_start
 	global islands
@@ -772,31 +891,53 @@ def on_commit(t):
 	global Virtual_Battery
 	global device_map
 	global powerbal
+	global device_snapshot
+	global flexible_load
 	if t-t_start==0:
 		if ((Packetizing) and (Absorption)):
 			initialize_devices(t)
 		else:
-			device_map = map_devices_to_nodes()
+			device_map = topology.device_map
+			if Packetizing:
+				device_snapshot = DeviceSnapshot(gridlabd,find('class=waterheater'),find('class=house'),loads_only=True)
+		if device_snapshot is not None:
+			flexible_load = FlexibleLoad(device_snapshot,device_map)
+	if ((device_snapshot is not None) and (device_snapshot.time != t)):
+		device_snapshot.refresh(t) # one GLD read per device property per commit, shared by all packetized logic
+	if flexible_load is not None:
+		flexible_load.update(t,gridlabd.get_global("clock")).publish(gridlabd)
 
 	print('\r  t={}'.format(pd.Timestamp(gridlabd.get_global("clock"))),end='')
 
 	if new_fault_detected():
 		print('\n ** Faults detected at supernodes:',faulted_nodes)
+		if catalog.refresh_if_changed():
+			# objects were added or removed: re-read the supernodes, branches and device map from the new catalog
+			topology.refresh()
+			device_map = topology.device_map
+		topology.refresh_status('switch') # switches opened by the model or the fault since the last fault event
 		if Absorption:
 			if Islanding:
 				print('Islanding ...')
-				results = islanding(t,faulted_nodes)
-				new_islands = process_islands(t-t_start,results)
-				print(new_islands)
-				re_island = (new_islands != islands)
-				islands = new_islands.copy()
-				islanded = True
-				if ((not Virtual_Battery) and (re_island) and (Packetizing) and (Absorption)):
-					Virtual_Battery = update_VB(islands) # if sim is restarted and islands are present, need to initialize VB
-				houses = find("class=house")
-				for house_id in houses:
-					if house_id not in islanded_devices:
-						temp_control_absorption(house_id,t)
+				try:
+					results = islanding(t,faulted_nodes)
+				except TimeoutError as err:
+					# isolate the faulted nodes without islanding, the next fault change retries the optimization
+					print('\n ** {}, isolating the faulted nodes instead'.format(err))
+					toggle_switches([s for node in faulted_nodes for s in shutoff_noislanding(node)])
+					results = None
+				if results is not None:
+					new_islands = process_islands(t-t_start,results)
+					print(new_islands)
+					re_island = (new_islands != islands)
+					islands = new_islands.copy()
+					islanded = True
+					if ((not Virtual_Battery) and (re_island) and (Packetizing) and (Absorption)):
+						Virtual_Battery = update_VB(islands) # if sim is restarted and islands are present, need to initialize VB
+					houses = find("class=house")
+					for house_id in houses:
+						if house_id not in islanded_devices:
+							temp_control_absorption(house_id,t)
 		else:
 			# isolate faulted nodes and turn off loads connected
 			switches_to_open = []
@@ -822,7 +963,7 @@ def on_commit(t):
 					if vb_data_out:
 						save_VB_data(powerbal[tuple(island)],island)
 			elif ((not Virtual_Battery) and (packetize_baseline)):
-				islands = [[int(re.search(r'\d+',n).group()) for n in device_map if gridlabd.get_value(n,'bustype')!='SWING']]
+				islands = [[topology.ids[n] for n in device_map if n!=topology.swing]]
 				powerbal[tuple(islands[0])] = {}
 				Virtual_Battery = update_VB(islands)
 				powerbal[tuple(islands[0])]['VBload'] = packetize_island(t,islands[0])
@@ -837,7 +978,7 @@ def on_commit(t):
 				test_VB_setpoint_tracking(t)
 
 
-	if gridlabd.get_global("clock")[:-6] == gridlabd.get_global("stoptime")[:-6]:
+	if ((flexible_load is None) and (gridlabd.get_global("clock")[:-6] == gridlabd.get_global("stoptime")[:-6])):
 		update_flexible_load()
 
 	return True
@@ -0,0 +1,86 @@
+'''
+BaselineMatrix holds the baseline run's load and solar timeseries (Loads_baseline.csv and Ps_baseline.csv, written by
+timeseries_persupernode() in data_post_process.py) as supernode x time and inverter x time arrays, loaded once,
+so the baseline of any island is an indexed sum instead of a pass over the csv files
+'''
+import re
+import numpy as np
+import pandas as pd
+
+LOAD_COLUMN = re.compile(r'^(total|hvac|wh)_load_(\d+)\[kW\]$')
+
+class BaselineMatrix:
+	'''
+	timestamps	: baseline timestamps (strings, as written in the csv files)
+	supernodes	: supernode ids with baseline loads, row order of the load matrices
+	total, hvac, wh : supernode x time loads [kW]
+	solar_columns	: Ps_baseline.csv column names (inverter:property[unit]), row order of solar
+	solar_inverters	: inverter name of each solar column
+	solar_nodes		: supernode id of each solar column
+	solar		: inverter x time solar power [kW]
+	'''
+	def __init__(self):
+		self.timestamps = []
+		self.supernodes = np.zeros(0,dtype=np.int64)
+		self.row = {}
+		self.total = self.hvac = self.wh = np.zeros((0,0))
+		self.solar_columns = []
+		self.solar_inverters = []
+		self.solar_nodes = np.zeros(0,dtype=np.int64)
+		self.solar = np.zeros((0,0))
+
+	def load(self,loads_csv='Loads_baseline.csv',solar_csv='Ps_baseline.csv'):
+		'''
+		reads the baseline csv files, returns self
+		'''
+		loads = pd.read_csv(loads_csv)
+		self.timestamps = loads[loads.columns[0]].astype(str).tolist()
+		columns = {}
+		for c in loads.columns[1:]:
+			match = LOAD_COLUMN.match(c.strip())
+			if match:
+				columns[(match.group(1),int(match.group(2)))] = c
+		self.supernodes = np.array(sorted({n for kind,n in columns if all((k,n) in columns for k in ('total','hvac','wh'))}),dtype=np.int64)
+		self.row = {int(n):k for k,n in enumerate(self.supernodes)}
+		for kind in ('total','hvac','wh'):
+			names = [columns[(kind,int(n))] for n in self.supernodes]
+			setattr(self,kind,loads[names].to_numpy(dtype=float).T.copy() if names else np.zeros((0,len(self.timestamps))))
+		solar = pd.read_csv(solar_csv)
+		self.solar_columns = list(solar.columns[1:])
+		self.solar_inverters = [c.split(':')[0].strip(' ') for c in self.solar_columns]
+		self.solar_nodes = np.array([int(re.search(r'\d+',c).group()) for c in self.solar_columns],dtype=np.int64)
+		self.solar = solar[self.solar_columns].to_numpy(dtype=float).T.copy() if self.solar_columns else np.zeros((0,len(self.timestamps)))
+		return self
+
+	def rows(self,island):
+		'''
+		load matrix rows of the supernodes of island that have baseline loads
+		'''
+		return [self.row[n] for n in island if n in self.row]
+
+	def flexible_peak(self):
+		'''
+		peak of the total flexible (HVAC + water heater) baseline load [kW]
+		'''
+		if not len(self.timestamps):
+			return 0.0
+		return float((self.hvac.sum(axis=0)+self.wh.sum(axis=0)).max())
+
+	def island_loads(self,island):
+		'''
+		returns the flexible (HVAC + water heater) and total baseline loads of the island [kW], one value per timestamp
+		'''
+		rows = self.rows(island)
+		flexible = self.hvac[rows].sum(axis=0)+self.wh[rows].sum(axis=0)
+		total = self.total[rows].sum(axis=0)
+		return flexible,total
+
+	def island_solar(self,island,online=None):
+		'''
+		returns the solar columns of the island whose inverter is online ({inverter : bool}, all when None) and their inverter x time power [kW]
+		'''
+		keep = np.isin(self.solar_nodes,list(island))
+		if online is not None:
+			keep &= np.array([online.get(inv,False) for inv in self.solar_inverters],dtype=bool)
+		index = np.flatnonzero(keep)
+		return [self.solar_columns[k] for k in index],self.solar[index]
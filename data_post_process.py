@@ -39,12 +39,15 @@ def log_gen() :
 
 def timeseries_gen() :
 	print("Starting to produce the timeseries output files")
+	import bisect
 	import csv
+	import os
 	header = ['timestamp','generation_kW', 'total_load_kW', 'flexible_load_kW', 'unserved_energy_%', 'storage_power_kW','storage_energy_kWh']
 
 	gen_str_csv = 'timeseries_data_gen_strg.csv'
 	load_csv = 'total_load.csv'
-	flex_HVAC_csv = 'flexible_load_HVAC.csv'
+	flex_csv = 'flexible_load.csv' # written by absorption.py from the per-commit device snapshot
+	flex_HVAC_csv = 'flexible_load_HVAC.csv' # collector files of models that still record the flexible load
 	flex_WH_csv = 'flexible_load_WH.csv'
 	# unsrvd_csv = 'unserved_load.csv'
 	baseline_csv = 'baseline.csv'
@@ -81,26 +84,36 @@ def timeseries_gen() :
 					total_load.append(float(row[1].split(" ")[0]))
 	except FileNotFoundError:
 		print('Missing ', load_csv, ' file')
-	# compute the flexible HVAC load
-	try :
-		with open(flex_HVAC_csv, newline='',mode='r') as flex_HVAC_csvfile :
-			rd_flex_HVAC = csv.reader(flex_HVAC_csvfile, delimiter=',', quotechar='|')
-			for row in rd_flex_HVAC :
-				if '#' not in row[0] :
-					flexible_load_HVAC.append(float(row[1].split(" ")[0]))
-	except FileNotFoundError:
-		print('Missing ', flex_HVAC_csv, ' file')
-	# compute the flexible water heater load data
-	try :
-		with open(flex_WH_csv, newline='',mode='r') as flex_WH_csvfile :
-			rd_flex_WH = csv.reader(flex_WH_csvfile, delimiter=',', quotechar='|')
-			for row in rd_flex_WH :
-				if '#' not in row[0]  :
-					flexible_load_WH.append(float(row[1].split(" ")[0]))
-	except FileNotFoundError:
-		print('Missing ', flex_WH_csv, ' file')
-	# compute the total flexible load
-	flexible_load = [x + y for x, y in zip(flexible_load_HVAC, flexible_load_WH)]
+	# flexible load aggregated during the simulation (absorption.py), the value of the last commit at or before each timestamp
+	if os.path.exists(flex_csv) :
+		with open(flex_csv, newline='',mode='r') as flex_csvfile :
+			rd_flex = csv.reader(flex_csvfile, delimiter=',')
+			next(rd_flex, None)
+			flex_rows = sorted((row[0][:19].replace('T',' '),float(row[1])+float(row[2])) for row in rd_flex if row)
+		flex_times = [time for time,load in flex_rows]
+		for time in timeseries :
+			k = max(bisect.bisect_right(flex_times,time[:19].replace('T',' '))-1,0)
+			flexible_load.append(flex_rows[k][1] if flex_rows else 0.0)
+	# fallback for runs without flexible_load.csv: HVAC and water heater load collector files
+	else :
+		print('Missing ', flex_csv, ' file, reading ', flex_HVAC_csv, ' and ', flex_WH_csv)
+		try :
+			with open(flex_HVAC_csv, newline='',mode='r') as flex_HVAC_csvfile :
+				rd_flex_HVAC = csv.reader(flex_HVAC_csvfile, delimiter=',', quotechar='|')
+				for row in rd_flex_HVAC :
+					if '#' not in row[0] :
+						flexible_load_HVAC.append(float(row[1].split(" ")[0]))
+		except FileNotFoundError:
+			print('Missing ', flex_HVAC_csv, ' file')
+		try :
+			with open(flex_WH_csv, newline='',mode='r') as flex_WH_csvfile :
+				rd_flex_WH = csv.reader(flex_WH_csvfile, delimiter=',', quotechar='|')
+				for row in rd_flex_WH :
+					if '#' not in row[0]  :
+						flexible_load_WH.append(float(row[1].split(" ")[0]))
+		except FileNotFoundError:
+			print('Missing ', flex_WH_csv, ' file')
+		flexible_load = [x + y for x, y in zip(flexible_load_HVAC, flexible_load_WH)]
 	# compute the baseline load in energy (kWh)
 	try :
 		with open(baseline_csv, newline='',mode='r') as baseline_csv_file :
@@ -0,0 +1,65 @@
+'''
+FlexibleLoad sums the HVAC and water heater load of every supernode from the per-commit DeviceSnapshot
+(one segmented sum over the snapshot's kW array), publishes it as the supernodes' flexible_load property
+and keeps the time series that data_post_process.timeseries_gen() reads from flexible_load.csv
+'''
+import csv
+import numpy as np
+
+from packetized.device_snapshot import WATERHEATER
+
+class FlexibleLoad:
+	'''
+	supernodes	: supernode names, in the column order of the sums
+	hvac, wh	: HVAC and water heater load of each supernode [kW] at the last update()
+	'''
+	def __init__(self,snapshot,device_map):
+		self.snapshot = snapshot
+		self.supernodes = sorted(device_map)
+		group = np.full(len(snapshot),-1,dtype=np.intp)
+		for k,sn in enumerate(self.supernodes):
+			for dev in list(device_map[sn]['houses'])+list(device_map[sn]['waterheaters']):
+				if dev in snapshot.slot:
+					group[snapshot.slot[dev]] = k
+		self.slots = np.flatnonzero(group>=0)
+		# hvac sums go to bins [0,n), water heater sums to [n,2n)
+		n = len(self.supernodes)
+		self.bins = group[self.slots]+np.where(snapshot.kind[self.slots]==WATERHEATER,n,0)
+		self.hvac = np.zeros(n)
+		self.wh = np.zeros(n)
+		self.time = None
+		self.timestamps = []
+		self.rows = []
+
+	def update(self,time,timestamp):
+		'''
+		sums the snapshot loads by supernode and appends them to the time series (once per time)
+		'''
+		if self.time == time:
+			return self
+		n = len(self.supernodes)
+		sums = np.bincount(self.bins,weights=self.snapshot.kw[self.slots],minlength=2*n)
+		self.hvac = sums[:n]
+		self.wh = sums[n:]
+		self.time = time
+		self.timestamps.append(timestamp)
+		self.rows.append(sums)
+		return self
+
+	def publish(self,gridlabd):
+		'''
+		sets the flexible_load property of every supernode
+		'''
+		for sn,kW in zip(self.supernodes,self.hvac+self.wh):
+			gridlabd.set_value(sn,"flexible_load","{:0.1f}".format(kW))
+
+	def write(self,filename='flexible_load.csv'):
+		'''
+		writes the time series: total HVAC and water heater load, then the flexible load of each supernode [kW]
+		'''
+		n = len(self.supernodes)
+		with open(filename,mode='w',newline='') as file:
+			writer = csv.writer(file)
+			writer.writerow(['timestamp','flexible_load_HVAC[kW]','flexible_load_WH[kW]']+['flexible_load_{}[kW]'.format(sn) for sn in self.supernodes])
+			for timestamp,sums in zip(self.timestamps,self.rows):
+				writer.writerow([timestamp,sums[:n].sum(),sums[n:].sum()]+(sums[:n]+sums[n:]).tolist())
@@ -0,0 +1,80 @@
+'''
+HousePool keeps the houses of one island in two indexed pools, connected and disconnected, so that island
+management sheds and reconnects randomly drawn houses in O(1) per house instead of rebuilding house lists
+from the virtual battery devices on every draw
+'''
+import numpy as np
+
+class IndexedPool:
+	'''
+	items	: pool members, in no particular order
+	index	: position of each member in items
+	'''
+	def __init__(self,items=()):
+		self.items = []
+		self.index = {}
+		for item in items:
+			self.add(item)
+
+	def __len__(self):
+		return len(self.items)
+
+	def __contains__(self,item):
+		return item in self.index
+
+	def __iter__(self):
+		return iter(self.items)
+
+	def add(self,item):
+		'''
+		adds item to the pool (no-op if it is already there)
+		'''
+		if item not in self.index:
+			self.index[item] = len(self.items)
+			self.items.append(item)
+
+	def remove(self,item):
+		'''
+		removes item from the pool by moving the last member into its position
+		'''
+		k = self.index.pop(item)
+		last = self.items.pop()
+		if k < len(self.items):
+			self.items[k] = last
+			self.index[last] = k
+
+	def pop_random(self,random=np.random):
+		'''
+		removes and returns a uniformly drawn member
+		'''
+		item = self.items[random.randint(len(self.items))]
+		self.remove(item)
+		return item
+
+class HousePool:
+	'''
+	connected		: houses whose devices are in the island's virtual battery
+	disconnected	: houses shed by island management
+	'''
+	def __init__(self,houses=(),random=np.random):
+		self.connected = IndexedPool(houses)
+		self.disconnected = IndexedPool()
+		self.random = random
+
+	def shed(self,n):
+		'''
+		moves up to n randomly drawn houses from connected to disconnected, returns them
+		'''
+		houses = [self.connected.pop_random(self.random) for k in range(min(n,len(self.connected)))]
+		for h in houses:
+			self.disconnected.add(h)
+		return houses
+
+	def restore(self,n):
+		'''
+		moves up to n randomly drawn houses from disconnected back to connected, returns them
+		'''
+		houses = [self.disconnected.pop_random(self.random) for k in range(min(n,len(self.disconnected)))]
+		for h in houses:
+			self.connected.add(h)
+		return houses
@@ -1,33 +1,59 @@
 
+# element types of the binary payload columns (see julia_payload.py)
+const COLUMN_TYPES = Dict("i1"=>Int8, "i2"=>Int16, "i4"=>Int32, "i8"=>Int64, "f8"=>Float64)
+
+# decodes the column frames of a binary payload into msg[name]
+function read_columns!(msg, frames)
+    for (col, data) in zip(msg["columns"], frames)
+        name, dtype, count = col[1], col[2], col[3]
+        if haskey(COLUMN_TYPES, dtype)
+            msg[name] = ltoh.(copy(reinterpret(COLUMN_TYPES[dtype], data)))
+        else # "str" : NUL separated utf-8
+            msg[name] = count == 0 ? String[] : String.(split(String(data), '\0'))
+        end
+    end
+    return msg
+end
+
+# column name of msg as a Vector{T}, from a space separated text column or a decoded binary column
+function column(msg, name, T)
+    value = msg[name]
+    if value isa AbstractString
+        tokens = split(value)
+        return T <: AbstractString ? String.(tokens) : [parse(T, ss) for ss in tokens]
+    end
+    return isempty(value) ? T[] : convert(Vector{T}, value)
+end
+
 function read_VIpayload(msg)
 
     # get branch data
-    branch = [ss for ss in split(msg["branch_id"])]
-    T = [parse(Int, ss) for ss in split(msg["branch_t"])]
-    F = [parse(Int, ss) for ss in split(msg["branch_f"])]
-    R = [parse(Float64, ss) for ss in split(msg["branch_R"])]
-    X = [parse(Float64, ss) for ss in split(msg["branch_X"])]
-    br_st = [parse(Int, ss)==1 for ss in split(msg["branch_status"])]
-    switchable = [ss=="switch" for ss in split(msg["branch_kind"])]
+    branch = column(msg, "branch_id", String)
+    T = column(msg, "branch_t", Int)
+    F = column(msg, "branch_f", Int)
+    R = column(msg, "branch_R", Float64)
+    X = column(msg, "branch_X", Float64)
+    br_st = [st==1 for st in column(msg, "branch_status", Int)]
+    switchable = [kind=="switch" for kind in column(msg, "branch_kind", String)]
 
     # get generator data
-    G = [parse(Int, ss) for ss in split(msg["gen_bus"])]
-    Pg_min = [parse(Float64, ss) for ss in split(msg["gen_Pmin"])]
-    ge_st = [parse(Float64, ss) for ss in split(msg["gen_status"])].==1
-    Pg_max = [parse(Float64, ss) for ss in split(msg["gen_Pmax"])].*ge_st
-    solar = [parse(Int, ss) for ss in split(msg["gen_solar"])].==1
+    G = column(msg, "gen_bus", Int)
+    Pg_min = column(msg, "gen_Pmin", Float64)
+    ge_st = column(msg, "gen_status", Float64).==1
+    Pg_max = column(msg, "gen_Pmax", Float64).*ge_st
+    solar = column(msg, "gen_solar", Int).==1
 
     # get battery data
-    B = [parse(Int, ss) for ss in split(msg["bat_bus"])]
-    ba_st = [parse(Float64, ss) for ss in split(msg["bat_status"])].==1
-    Pb_max = [parse(Float64, ss) for ss in split(msg["bat_Pmax"])].*ba_st
-    Eb_max = [parse(Float64, ss) for ss in split(msg["bat_Emax"])].*ba_st
-    E0 = [parse(Float64, ss) for ss in split(msg["bat_soc"])].*Eb_max
+    B = column(msg, "bat_bus", Int)
+    ba_st = column(msg, "bat_status", Float64).==1
+    Pb_max = column(msg, "bat_Pmax", Float64).*ba_st
+    Eb_max = column(msg, "bat_Emax", Float64).*ba_st
+    E0 = column(msg, "bat_soc", Float64).*Eb_max
 
     # get load data
-    D = [parse(Float64, ss) for ss in split(msg["shunt_bus"])]
-    Pd0 = [parse(Float64, ss) for ss in split(msg["shunt_P"])]
-    faulted_nodes = [parse(Int, ss) for ss in split(msg["faulted_nodes"])]
+    D = column(msg, "shunt_bus", Float64)
+    Pd0 = column(msg, "shunt_P", Float64)
+    faulted_nodes = column(msg, "faulted_nodes", Int)
 
     return (branch,T,F,R,X,br_st,switchable,
                 G,Pg_min,Pg_max,ge_st,solar,
@@ -40,22 +66,35 @@ function read_IMpayload(msg)
     t0 = msg["t0"]
     t_inc = convert(Int64, msg["t_inc"])
     # get battery data
-    batteries = [ss for ss in split(msg["batteries"])]
-    E0_battery = [parse(Float64, ss) for ss in split(msg["E0_battery"])]
-    Emax_battery = [parse(Float64, ss) for ss in split(msg["Emax_battery"])]
-    Pmax_battery = [parse(Float64, ss) for ss in split(msg["Pmax_battery"])]
+    batteries = column(msg, "batteries", String)
+    E0_battery = column(msg, "E0_battery", Float64)
+    Emax_battery = column(msg, "Emax_battery", Float64)
+    Pmax_battery = column(msg, "Pmax_battery", Float64)
 
     # get virtual battery data
-    E0_virtualb = [parse(Float64, ss) for ss in split(msg["E0_virtualb"])]
-    Emax_virtualb = [parse(Float64, ss) for ss in split(msg["Emax_virtualb"])]
+    E0_virtualb = column(msg, "E0_virtualb", Float64)
+    Emax_virtualb = column(msg, "Emax_virtualb", Float64)
 
-    gens = [ss for ss in split(msg["gens"])]
-    Pmax_gens = [parse(Float64, ss) for ss in split(msg["Pmax_gens"])]
+    gens = column(msg, "gens", String)
+    Pmax_gens = column(msg, "Pmax_gens", Float64)
 
-    solargens = [ss for ss in split(msg["solargens"])]
+    solargens = column(msg, "solargens", String)
 
     return (island,t0,t_inc,
             batteries,E0_battery,Emax_battery,Pmax_battery,
             E0_virtualb,Emax_virtualb,
             gens,Pmax_gens,solargens)
 end
+
+# baseline loads and solar power of the island sent with a management request, as the DataFrames manage_island expects
+# solar_baseline holds the series of the solar_columns one after the other
+function read_baselines(msg)
+    timestamp = column(msg, "baseline_timestamp", String)
+    load_baseline = DataFrame([timestamp, column(msg, "f_baseline", Float64), column(msg, "nf_baseline", Float64)],
+                              [:timestamp, :f_baseline, :nf_baseline])
+    solar_columns = column(msg, "solar_columns", String)
+    solar = reshape(column(msg, "solar_baseline", Float64), length(timestamp), length(solar_columns))
+    Ps_baseline = DataFrame(vcat(Any[timestamp], [solar[:, k] for k in 1:length(solar_columns)]),
+                            vcat([:timestamp], Symbol.(solar_columns)))
+    return load_baseline, Ps_baseline
+end
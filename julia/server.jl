@@ -9,86 +9,176 @@ include("../packetized/island_management.jl")
 
 ctx = Context()
 
-connection_uri = ENV["SERVER_LISTEN_URI"]
+# worker of the JuliaServer pool (WORKER_CONNECT_URI is set): DEALER socket connected to the broker backend,
+# every request is prefixed with the id of the client to answer
+# single server: PAIR socket bound at SERVER_LISTEN_URI
+worker_uri = get(ENV, "WORKER_CONNECT_URI", "")
+if isempty(worker_uri)
+    connection_uri = ENV["SERVER_LISTEN_URI"]
+    receiver = Socket(ctx, PAIR)
+    ZMQ.bind(receiver, connection_uri)
+else
+    receiver = Socket(ctx, DEALER)
+    ZMQ.connect(receiver, worker_uri)
+end
+
+# answers msg, prefixed with the client id (pool workers) and its request_id when the client sent one
+# (julia_client.py matches responses by request_id)
+function reply(socket, envelope, msg, body)
+    if envelope !== nothing
+        send(socket, envelope; more=true)
+    end
+    if haskey(msg, "request_id")
+        send(socket, msg["request_id"]; more=true)
+    end
+    send(socket, body)
+end
+
+# VIRTUAL ISLANDING OPTIMIZATION, returns the branch results as JSON
+function islanding_op(msg)
+    (branch,T,F,R,X,br_st,switchable,
+        G,Pg_min,Pg_max,ge_st,solar,
+        B,Pb_max,Eb_max,E0,ba_st,
+        D,Pd0,faulted_nodes) = read_VIpayload(msg)
+    n_bus = size(unique(vcat(T,F)),1)
+    nbr = size(branch,1)
+    baseMVA = 1
+    br_st00 = copy(br_st) # get copy of original branch switch statuses
+    # outages $TODO need to edit isolate_nodes to work if not all branches are switches (current assumption)
+    br_failures = isolate_nodes(T,F,switchable,faulted_nodes)
+    gen_outages = []
+    bat_outages = []
+    for n in faulted_nodes
+        for i in findall(G.==n)
+            push!(gen_outages,i)
+        end
+        for i in findall(B.==n)
+            push!(bat_outages,i)
+        end
+    end
+    # implement line failures
+    switchable[br_failures] .= false
+    br_st[br_failures] .= false
+    ge_st[gen_outages] .= false
+    ba_st[bat_outages] .= false
+    # look in graph for cycles / loops
+    loops = find_cycles(T,F) # still need to test if working correctly
+    #print((n_bus,baseMVA, # general case data
+        #F,T,R,X,br_st,switchable,loops, # data about branches
+        #G,Pg_min,Pg_max,solar,B,Eb_max,E0,Pb_max,D,Pd0 # data about generators and loads
+        #))
+    (br_status) =
+        islanding_core((n_bus,baseMVA, # general case data
+        F,T,R,X,br_st,switchable,loops, # data about branches
+        G,Pg_min,Pg_max,solar,B,Eb_max,E0,Pb_max,D,Pd0 # data about generators and loads
+        )) #,R,Pd,dPd,Pg,dPg,flow,ud)
+    branch_results = DataFrame(id=branch, t=T, f=F, st00=br_st00, st0=br_st, st1=br_status)
+    return JSON.json(branch_results)
+end
 
-receiver = Socket(ctx, PAIR)
-ZMQ.bind(receiver, connection_uri)
+# ISLAND MANAGEMENT OPTIMIZATION, returns the setpoints as JSON
+# the baselines come with the request, payloads without them fall back to the island's csv files in msg["workdir"]
+function management_op(msg)
+    if ((msg["test_out"]==1) & (false))
+        testing=true
+    else
+        testing=false
+    end
+
+    (island,t0,t_inc,batteries,E0_battery,Emax_battery,Pmax_battery,
+     E0_virtualb,Emax_virtualb,gens,Pmax_gens, solargens) = read_IMpayload(msg)
+    if haskey(msg, "f_baseline")
+        load_baseline, Ps_baseline = read_baselines(msg)
+    else
+        workdir = get(msg, "workdir", "")
+        load_baseline = CSV.read(joinpath(workdir, "load_baseline-$island.csv"))
+        Ps_baseline = CSV.read(joinpath(workdir, "solar_baseline-$island.csv"))
+    end
+    setpoint_results = manage_island((
+                    t0, t_inc, island,
+                    load_baseline,Ps_baseline,
+                    gens,Pmax_gens,
+                    batteries,Pmax_battery,E0_battery,Emax_battery,
+                    E0_virtualb,Emax_virtualb
+                    );testing=testing)
+    return JSON.json(setpoint_results)
+end
+
+# runs a synthetic islanding and management optimization so JuMP / Cbc / DataFrames / JSON are compiled
+# before the first real request, returns the seconds it took
+function warmup()
+    started = time()
+    # 4 bus feeder: swing 1 - 2 - 3 - 4 with a battery at 4, fault at 2
+    islanding_msg = Dict{String,Any}(
+        "branch_id"=>"switch_12 switch_23 switch_34",
+        "branch_t"=>"2 3 4", "branch_f"=>"1 2 3",
+        "branch_R"=>"0 0 0", "branch_X"=>"0.1 0.1 0.1",
+        "branch_status"=>"1 1 1", "branch_kind"=>"switch switch switch",
+        "gen_bus"=>"1 3", "gen_Pmin"=>"0 0", "gen_Pmax"=>"1000 20", "gen_status"=>"1 1", "gen_solar"=>"0 1",
+        "bat_bus"=>"4", "bat_Pmax"=>"50", "bat_Emax"=>"200", "bat_soc"=>"0.8", "bat_status"=>"1",
+        "shunt_bus"=>"2 3 4", "shunt_P"=>"10 20 30",
+        "faulted_nodes"=>"2")
+    # 20 steps of 3 min
+    stamps = [Dates.format(DateTime(2020,1,30) + Minute(3*k), "yyyy-mm-ddTHH:MM:SS") * "-05:00" for k in 0:19]
+    management_msg = Dict{String,Any}(
+        "island"=>"3_4", "t0"=>stamps[1], "t_inc"=>3, "test_out"=>0,
+        "batteries"=>"battery_supernode_4", "E0_battery"=>"160", "Emax_battery"=>"200", "Pmax_battery"=>"50",
+        "E0_virtualb"=>"40", "Emax_virtualb"=>"50", "gens"=>"", "Pmax_gens"=>"", "solargens"=>"solar_supernode_3",
+        "baseline_timestamp"=>stamps, "f_baseline"=>fill(20.0,20), "nf_baseline"=>fill(30.0,20),
+        "solar_columns"=>["inv_supernode_3_solar:VA_Out.real[kW]"], "solar_baseline"=>fill(15.0,20))
+    try
+        islanding_op(islanding_msg)
+        management_op(management_msg)
+    catch err
+        println("Julia warmup failed: $err")
+    end
+    return time() - started
+end
+
+warmup_seconds = nothing
+if get(ENV, "JULIA_WARMUP", "0") == "1"
+    warmup_seconds = warmup()
+    println("Julia warmup took $(round(warmup_seconds; digits=1)) s")
+end
+
+if !isempty(worker_uri)
+    send(receiver, "READY"; more=true)
+    send(receiver, get(ENV, "WORKER_NAME", "worker"); more=true)
+    send(receiver, JSON.json(Dict("warmup"=>warmup_seconds)))
+end
 
 println("Julia ready . . .")
 # set up virtual battery, define water heater models
 while true
+    envelope = isempty(worker_uri) ? nothing : recv(receiver, Vector{UInt8})
     raw_msq = recv(receiver, String)
     msg = JSON.parse(raw_msq)
+    # binary payloads carry one frame per column after the JSON header
+    if receiver.rcvmore
+        frames = Vector{Vector{UInt8}}()
+        while receiver.rcvmore
+            push!(frames, recv(receiver, Vector{UInt8}))
+        end
+        read_columns!(msg, frames)
+    end
     # Do work here
     sent_at = msg["at"]
     message = msg["message"]
-    # VIRTUAL ISLANDING OPTIMIZATION
     if haskey(msg,"op")
-    if msg["op"]=="islanding"
-        (branch,T,F,R,X,br_st,switchable,
-            G,Pg_min,Pg_max,ge_st,solar,
-            B,Pb_max,Eb_max,E0,ba_st,
-            D,Pd0,faulted_nodes) = read_VIpayload(msg)
-        n_bus = size(unique(vcat(T,F)),1)
-        nbr = size(branch,1)
-        baseMVA = 1
-        br_st00 = copy(br_st) # get copy of original branch switch statuses
-        # outages $TODO need to edit isolate_nodes to work if not all branches are switches (current assumption)
-        br_failures = isolate_nodes(T,F,switchable,faulted_nodes)
-        gen_outages = []
-        bat_outages = []
-        for n in faulted_nodes
-            for i in findall(G.==n)
-                push!(gen_outages,i)
-            end
-            for i in findall(B.==n)
-                push!(bat_outages,i)
-            end
+        if msg["op"]=="islanding"
+            reply(receiver, envelope, msg, islanding_op(msg))
+            print("ISLANDING OPTIMIZATION COMPLETE\n")
+            continue
         end
-        # implement line failures
-        switchable[br_failures] .= false
-        br_st[br_failures] .= false
-        ge_st[gen_outages] .= false
-        ba_st[bat_outages] .= false
-        # look in graph for cycles / loops
-        loops = find_cycles(T,F) # still need to test if working correctly
-        #print((n_bus,baseMVA, # general case data
-            #F,T,R,X,br_st,switchable,loops, # data about branches
-            #G,Pg_min,Pg_max,solar,B,Eb_max,E0,Pb_max,D,Pd0 # data about generators and loads
-            #))
-        (br_status) =
-            islanding_core((n_bus,baseMVA, # general case data
-            F,T,R,X,br_st,switchable,loops, # data about branches
-            G,Pg_min,Pg_max,solar,B,Eb_max,E0,Pb_max,D,Pd0 # data about generators and loads
-            )) #,R,Pd,dPd,Pg,dPg,flow,ud)
-        branch_results = DataFrame(id=branch, t=T, f=F, st00=br_st00, st0=br_st, st1=br_status)
-        send(receiver, JSON.json(branch_results))
-        print("ISLANDING OPTIMIZATION COMPLETE\n")
-        continue
-    end
-    # ISLAND MANAGEMENT OPTIMIZATION
-    if msg["op"]=="management"
-        if ((msg["test_out"]==1) & (false))
-            testing=true
-        else
-            testing=false
+        if msg["op"]=="management"
+            reply(receiver, envelope, msg, management_op(msg))
+            continue
+        end
+        if msg["op"]=="warmup"
+            reply(receiver, envelope, msg, JSON.json(Dict("warmup"=>warmup())))
+            continue
         end
-
-        (island,t0,t_inc,batteries,E0_battery,Emax_battery,Pmax_battery,
-         E0_virtualb,Emax_virtualb,gens,Pmax_gens, solargens) = read_IMpayload(msg)
-         load_baseline = CSV.read("load_baseline-$island.csv")
-         Ps_baseline = CSV.read("solar_baseline-$island.csv")
-        setpoint_results = manage_island((
-                        t0, t_inc, island,
-                        load_baseline,Ps_baseline,
-                        gens,Pmax_gens,
-                        batteries,Pmax_battery,E0_battery,Emax_battery,
-                        E0_virtualb,Emax_virtualb
-                        );testing=testing)
-         send(receiver, JSON.json(setpoint_results))
-         continue
-    end
     end
-    send(receiver, "Recieved message sent at '$(sent_at)'")
+    reply(receiver, envelope, msg, "Recieved message sent at '$(sent_at)'")
     #println("$(sent_at): $(message)")
 end
@@ -7,38 +7,136 @@ import subprocess
 import time
 import asyncio
 
+from julia_payload import FORMATS, encode_text, encode_binary
+
 # launch the python talker
 CLIENT_CONNECT_URI = os.environ.get('CLIENT_CONNECT_URI')
+DEFAULT_TIMEOUT = object() # use JuliaClient.timeout
 
 class JuliaClient:
-    def __init__(self, connection_uri=CLIENT_CONNECT_URI):
+    '''
+    Client of the Julia optimization server.
+        Every request carries a request_id and the server answers with a [request_id, response] multipart message,
+        so several requests can be in flight at once: submit() sends without waiting and collect() gathers the
+        responses until a deadline. send() / send_data() are the blocking submit + collect of a single request and
+        raise TimeoutError if the answer doesn't arrive within the timeout (None waits forever).
+        Responses to requests that timed out are dropped when they arrive.
+        first_solve is the latency [s] of the first optimization ('op') request, which includes Julia's compilation on a cold server.
+        requests, bytes_sent and bytes_received count the requests submitted and the payload bytes of the messages sent and received.
+    '''
+    def __init__(self, connection_uri=CLIENT_CONNECT_URI, payload_format='text', timeout=None):
         self._connection_uri = connection_uri
+        self.payload_format = payload_format
+        self.timeout = timeout
         self._context = zmq.Context()
         self._socket = self._context.socket(zmq.PAIR)
+        self._poller = zmq.Poller()
+        self._poller.register(self._socket, zmq.POLLIN)
+        self._next_id = 0
+        self._pending = set()
+        self._responses = {}
+        self._first_op = None
+        self.first_solve = None
         self.connected = False
+        self.requests = 0
+        self.bytes_sent = 0
+        self.bytes_received = 0
+
+    def set_socket_type(self, socket_type):
+        '''zmq.PAIR to talk to a single julia server | zmq.DEALER to talk to the JuliaServer worker pool broker'''
+        if self._socket.socket_type == socket_type:
+            return
+        if self.connected:
+            raise RuntimeError('JuliaClient: cannot change the socket type of a connected client')
+        self._poller.unregister(self._socket)
+        self._socket.close()
+        self._socket = self._context.socket(socket_type)
+        self._poller.register(self._socket, zmq.POLLIN)
 
     def connect(self):
         if self.connected: return
         self._socket.connect(self._connection_uri)
         self.connected = True
 
-    def send(self, message):
-        timestamp = time.ctime()
-        self._socket.send_string(json_dumps({
-            'message': message,
-            'at': timestamp,
-        }))
-        response = self._socket.recv()
-        return response
-
-    def send_data(self, dict):
-        timestamp = time.ctime()
-        dict.update({'message':'data collected',
-                            'at':timestamp})
-        self._socket.send_string(json_dumps(
-            dict
-        ))
-        response = self._socket.recv()
-        return response
+    def disconnect(self):
+        '''drops the connection and the requests in flight, the client can connect() again'''
+        socket_type = self._socket.socket_type
+        self._poller.unregister(self._socket)
+        self._socket.close(linger=0)
+        self._socket = self._context.socket(socket_type)
+        self._poller.register(self._socket, zmq.POLLIN)
+        self._pending.clear()
+        self._responses.clear()
+        self.connected = False
+
+    def set_payload_format(self, payload_format):
+        '''text (space separated JSON columns) | binary (JSON header + one little-endian frame per column)'''
+        if payload_format not in FORMATS:
+            raise ValueError("JuliaClient: unknown payload format '{}' (expected one of {})".format(payload_format, FORMATS))
+        self.payload_format = payload_format
+
+    def submit(self, dict, message='data collected'):
+        '''sends a request without waiting for the response, returns its request_id'''
+        self._next_id += 1
+        request_id = str(self._next_id)
+        dict.update({'message':message,
+                     'at':time.ctime(),
+                     'request_id':request_id})
+        if self.payload_format == 'binary':
+            frames = encode_binary(dict)
+            self._socket.send_multipart(frames, copy=False)
+            self.bytes_sent += sum(memoryview(frame).nbytes for frame in frames)
+        else:
+            data = encode_text(dict).encode('utf-8')
+            self._socket.send(data)
+            self.bytes_sent += len(data)
+        self.requests += 1
+        self._pending.add(request_id)
+        if ('op' in dict) and (self.first_solve is None) and (self._first_op is None):
+            self._first_op = (request_id, time.monotonic())
+        return request_id
+
+    def collect(self, request_ids, timeout=None):
+        '''
+        waits until the responses of all request_ids arrived or the timeout [s] expired (None waits forever)
+        returns {request_id : response} of the responses received; the missing requests are abandoned
+        '''
+        wanted = set(request_ids)
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while not wanted.issubset(self._responses):
+            wait = None if deadline is None else max(0, deadline - time.monotonic())
+            if not self._poller.poll(None if wait is None else int(wait * 1000)):
+                break
+            self._receive()
+        received = {request_id:self._responses.pop(request_id) for request_id in request_ids if request_id in self._responses}
+        self._pending.difference_update(wanted)
+        return received
+
+    def _receive(self):
+        frames = self._socket.recv_multipart()
+        self.bytes_received += sum(len(frame) for frame in frames)
+        if len(frames) < 2:
+            return # reply of a server without request ids
+        request_id = frames[0].decode('utf-8')
+        if request_id in self._pending:
+            self._responses[request_id] = frames[1]
+        if self._first_op and (self._first_op[0] == request_id):
+            self.first_solve = time.monotonic() - self._first_op[1]
+            self._first_op = None
+
+    def request(self, dict, message='data collected', timeout=DEFAULT_TIMEOUT):
+        '''sends one request and waits for its response, raises TimeoutError after timeout [s] (default: self.timeout)'''
+        timeout = self.timeout if timeout is DEFAULT_TIMEOUT else timeout
+        request_id = self.submit(dict, message=message)
+        received = self.collect([request_id], timeout=timeout)
+        if request_id not in received:
+            raise TimeoutError("Julia server did not answer request {} within {} s".format(request_id, timeout))
+        return received[request_id]
+
+    def send(self, message, timeout=DEFAULT_TIMEOUT):
+        return self.request({}, message=message, timeout=timeout)
+
+    def send_data(self, dict, timeout=DEFAULT_TIMEOUT):
+        return self.request(dict, timeout=timeout)
 
 julia_client = JuliaClient()
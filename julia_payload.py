@@ -0,0 +1,83 @@
+'''
+Wire formats of the payloads sent to the Julia server.
+    text   : one JSON message, every column joined into a space separated string (parsed token by token in julia/read_payload.jl),
+             except string columns holding whitespace (e.g. timestamps) that stay JSON arrays
+    binary : a multipart message, a JSON header followed by one frame per column holding the raw little-endian array
+             (the narrowest of int8/16/32/64 "i1".."i8" that holds an integer column | float64 "f8" | NUL separated utf-8 "str"),
+             decoded in julia/read_payload.jl with reinterpret
+Any list, tuple or numpy array value of a payload dict is a column, all other values travel in the JSON header.
+The format is selected in the GLM with `global char32 JULIA_PAYLOAD binary;` (text by default).
+'''
+from json import dumps as json_dumps, loads as json_loads
+import numpy as np
+
+FORMATS = ('text','binary')
+
+DTYPES = {'i1':np.dtype('<i1'),
+          'i2':np.dtype('<i2'),
+          'i4':np.dtype('<i4'),
+          'i8':np.dtype('<i8'),
+          'f8':np.dtype('<f8')}
+INTEGER_DTYPES = ('i1','i2','i4','i8')
+
+def is_column(value):
+    return isinstance(value,(list,tuple,np.ndarray))
+
+def text_column(values):
+    '''
+    joins the column values into one space separated string, or returns them as a list if a value holds whitespace
+    '''
+    tokens = list(map(str, values))
+    if any(len(token.split()) != 1 for token in tokens):
+        return tokens
+    return " ".join(tokens)
+
+def column_array(values):
+    '''
+    returns the wire dtype name and contiguous little-endian array (or utf-8 bytes) of a column
+    '''
+    array = np.asarray(values)
+    if array.dtype.kind in 'biu':
+        lo, hi = (int(array.min()), int(array.max())) if array.size else (0, 0)
+        for dtype in INTEGER_DTYPES:
+            info = np.iinfo(DTYPES[dtype])
+            if info.min <= lo and hi <= info.max:
+                return dtype, np.ascontiguousarray(array,dtype=DTYPES[dtype])
+    if array.dtype.kind == 'f':
+        return 'f8', np.ascontiguousarray(array,dtype=DTYPES['f8'])
+    return 'str', '\0'.join(map(str,array.tolist())).encode('utf-8')
+
+def encode_text(payload):
+    '''
+    encodes the payload as one JSON string with space separated columns
+    '''
+    return json_dumps({key:(text_column(value) if is_column(value) else value) for key,value in payload.items()})
+
+def encode_binary(payload):
+    '''
+    encodes the payload as a list of frames: the JSON header then the buffer of each column listed in header['columns']
+    '''
+    header = {}
+    columns = []
+    frames = []
+    for key,value in payload.items():
+        if is_column(value):
+            dtype,data = column_array(value)
+            columns.append([key,dtype,len(value)])
+            frames.append(data if isinstance(data,bytes) else memoryview(data))
+        else:
+            header[key] = value
+    header['columns'] = columns
+    return [json_dumps(header).encode('utf-8')] + frames
+
+def decode_binary(frames):
+    '''
+    decodes the frames of a binary payload back into a dict of scalars and numpy arrays / lists of strings
+    '''
+    payload = json_loads(bytes(frames[0]).decode('utf-8'))
+    for (key,dtype,count),data in zip(payload.pop('columns'),frames[1:]):
+        if dtype in DTYPES:
+            payload[key] = np.frombuffer(bytes(data),dtype=DTYPES[dtype],count=count)
+        else:
+            payload[key] = bytes(data).decode('utf-8').split('\0') if count else []
+    return payload
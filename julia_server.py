@@ -1,12 +1,55 @@
 from julia_client import julia_client
+from collections import deque
+import argparse
+import json
 import os
+import re
+import signal
 import subprocess
+import sys
+import tempfile
+import threading
 import time
+import zmq
+
+SERVER_LISTEN_URI = os.environ.get('SERVER_LISTEN_URI')
+WORKER_URI = os.environ.get('WORKER_URI', 'ipc:///tmp/julia_workers_{}'.format(os.getpid()))
+PIDFILE = os.environ.get('JULIA_SERVER_PIDFILE',
+    os.path.join(tempfile.gettempdir(), 'julia_server_{}.pid'.format(re.sub(r'\W+', '_', SERVER_LISTEN_URI or 'default').strip('_'))))
 
 class JuliaServer:
-    def __init__(self, path_to_julia_server = 'julia/server.jl'):
+    '''
+    Runs the Julia optimization server.
+        workers=1 : one `julia julia/server.jl` process bound at SERVER_LISTEN_URI (PAIR socket)
+        workers>1 : a pool of julia worker processes behind a load-balancing broker thread:
+                    the broker's ROUTER frontend is bound at SERVER_LISTEN_URI (julia_client connects a DEALER socket to it)
+                    and its ROUTER backend at WORKER_URI, where every worker connects a DEALER socket and announces itself with READY.
+                    Each request goes to the least recently used idle worker, dead workers are restarted and
+                    utilization() reports the requests served and the busy fraction of each worker.
+        daemon    : `python julia_server.py start` runs a brokered pool (even of one worker) that outlives the simulations,
+                    its workers are warmed up with a synthetic islanding and management optimization before they announce themselves.
+                    start() attaches to a running daemon instead of launching Julia when the daemon's pidfile names a live
+                    process or use_daemon is set (it then asks CLIENT_CONNECT_URI for the broker status, waiting up to
+                    discovery_timeout); stop() leaves the daemon running.
+    '''
+    def __init__(self, path_to_julia_server = 'julia/server.jl', startup_timeout = None, workers = 1):
         self._path_to_julia_server = path_to_julia_server
+        self.startup_timeout = startup_timeout # [s] to wait for the first ping (None: wait for Julia to compile)
+        self.discovery_timeout = 0.5 # [s] to wait for the status of a running daemon
+        self.use_daemon = False # look for a daemon even without a live pidfile (e.g. a daemon on another host)
+        self.pidfile = PIDFILE
+        self.workers = workers
+        self.warmup = False # warm the workers up before they announce themselves (daemon)
+        self.daemon = None # status of the daemon start() attached to
+        self.startup_time = None # [s] spent in start()
         self._server_process = None
+        self._worker_processes = {}
+        self._launched = {}
+        self._broker = None
+        self._running = False
+        self._stats = {}
+        self._started_at = None
+        self._stop_requested = threading.Event()
 
     def __enter__(self):
         self.start()
@@ -16,19 +59,294 @@ class JuliaServer:
         self.stop()
 
     def start(self):
-        server_process = subprocess.Popen([
-            'julia',
-            self._path_to_julia_server,
-        ])
+        started = time.monotonic()
         try:
-            julia_client.connect()
-            res = julia_client.send('ping')
-            self._server_process = server_process
-        except Exception as err:
-            server_process.kill()
-            raise err
+            if (self.use_daemon or (_read_pid(self.pidfile) is not None)) and self.attach():
+                return
+            if self.workers > 1:
+                return self._start_pool()
+            julia_client.set_socket_type(zmq.PAIR)
+            server_process = subprocess.Popen([
+                'julia',
+                self._path_to_julia_server,
+            ])
+            try:
+                julia_client.connect()
+                res = julia_client.send('ping', timeout=self.startup_timeout)
+                self._server_process = server_process
+            except Exception as err:
+                server_process.kill()
+                raise err
+        finally:
+            self.startup_time = time.monotonic() - started
+
+    def attach(self):
+        '''connects julia_client to the daemon answering at CLIENT_CONNECT_URI, returns False if there is none'''
+        julia_client.set_socket_type(zmq.DEALER)
+        julia_client.connect()
+        try:
+            self.daemon = json.loads(julia_client.send('status', timeout=self.discovery_timeout))
+        except (TimeoutError, ValueError):
+            self.daemon = None
+        if not isinstance(self.daemon, dict):
+            self.daemon = None
+            julia_client.disconnect()
+            return False
+        res = julia_client.send('ping', timeout=self.startup_timeout) # answered once a worker is ready
+        return True
 
     def stop(self):
+        if self.daemon:
+            print(' - leaving the Julia daemon (pid {}) running'.format(self.daemon['pid']))
+            julia_client.disconnect()
+            self.daemon = None
         if self._server_process:
             self._server_process.kill()
         self._server_process = None
+        if self._broker:
+            self._running = False
+            self._broker.join()
+            self._broker = None
+            for name, process in self._worker_processes.items():
+                process.kill()
+            self._worker_processes = {}
+            for name, stats in self.utilization().items():
+                print(' - julia {}: {} requests, {:.0%} busy'.format(name, stats['requests'], stats['utilization']))
+
+    def report(self):
+        '''startup and time to first solve of this run, and of the daemon when attached to one'''
+        lines = []
+        if self.startup_time is not None:
+            lines.append('Julia server startup = {:.1f} s{}'.format(self.startup_time,
+                ' (attached to daemon pid {})'.format(self.daemon['pid']) if self.daemon else ''))
+        if julia_client.first_solve is not None:
+            lines.append('Julia time to first solve = {:.1f} s'.format(julia_client.first_solve))
+        if self.daemon:
+            for name, stats in sorted(self.daemon['workers'].items()):
+                lines.append('Julia daemon {}: startup = {} s, warmup solve = {} s, {} requests served'.format(
+                    name, _seconds(stats['startup']), _seconds(stats['first_solve']), stats['requests']))
+        return lines
+
+    def serve(self, pidfile=PIDFILE):
+        '''runs the brokered pool until SIGTERM / SIGINT (the daemon of `python julia_server.py serve`)'''
+        self.warmup = True
+        for signum in (signal.SIGTERM, signal.SIGINT):
+            signal.signal(signum, lambda signum, frame: self._stop_requested.set())
+        self._start_pool(ping=False)
+        with open(pidfile, 'w') as file:
+            file.write('{}\n'.format(os.getpid()))
+        print('Julia daemon (pid {}) listening at {} with {} workers'.format(os.getpid(), SERVER_LISTEN_URI, self.workers), flush=True)
+        try:
+            while not self._stop_requested.wait(1):
+                pass
+        finally:
+            self.stop()
+            if _read_pid(pidfile) == os.getpid():
+                os.remove(pidfile)
+
+    def _start_pool(self, ping=True):
+        self._running = True
+        self._started_at = time.monotonic()
+        ready = threading.Event()
+        self._broker = threading.Thread(target=self._broker_loop, args=(ready,), daemon=True)
+        self._broker.start()
+        ready.wait()
+        for k in range(self.workers):
+            self._start_worker('worker_{}'.format(k + 1))
+        if not ping:
+            return
+        try:
+            julia_client.set_socket_type(zmq.DEALER)
+            julia_client.connect()
+            res = julia_client.send('ping', timeout=self.startup_timeout)
+        except Exception as err:
+            self.stop()
+            raise err
+
+    def _start_worker(self, name):
+        env = dict(os.environ, WORKER_CONNECT_URI=WORKER_URI, WORKER_NAME=name, JULIA_WARMUP='1' if self.warmup else '0')
+        self._worker_processes[name] = subprocess.Popen(['julia', self._path_to_julia_server], env=env)
+        self._launched[name] = time.monotonic()
+        self._stats.setdefault(name, {'requests': 0, 'busy': 0.0, 'restarts': -1, 'startup': None, 'first_solve': None})
+        self._stats[name]['restarts'] += 1
+
+    def _restart_dead_workers(self, idle, busy, names):
+        for name, process in list(self._worker_processes.items()):
+            if process.poll() is not None:
+                print('\n ** julia {} exited with code {}, restarting it'.format(name, process.returncode))
+                for worker_id in [w for w, n in names.items() if n == name]:
+                    if worker_id in idle:
+                        idle.remove(worker_id)
+                    busy.pop(worker_id, None) # its request is lost, the client's deadline handles it
+                    names.pop(worker_id)
+                self._start_worker(name)
+
+    def _register(self, name, frames):
+        '''READY [name, {"warmup": seconds of the warmup optimizations}] of a worker'''
+        stats = self._stats.setdefault(name, {'requests': 0, 'busy': 0.0, 'restarts': 0, 'startup': None, 'first_solve': None})
+        if name in self._launched:
+            stats['startup'] = time.monotonic() - self._launched[name]
+        try:
+            stats['first_solve'] = json.loads(frames[0])['warmup'] if frames else None
+        except (ValueError, KeyError, TypeError):
+            stats['first_solve'] = None
+
+    def _status_request(self, frames):
+        '''returns (True, request_id) for a status request the broker answers itself, (False, None) for a worker request'''
+        if len(frames) != 2 or len(frames[1]) > 1024:
+            return False, None
+        try:
+            msg = json.loads(frames[1])
+        except ValueError:
+            return False, None
+        if isinstance(msg, dict) and (msg.get('message') == 'status') and ('op' not in msg):
+            return True, msg.get('request_id')
+        return False, None
+
+    def status(self, ready=0):
+        return {'pid': os.getpid(),
+                'uri': SERVER_LISTEN_URI,
+                'uptime': time.monotonic() - self._started_at,
+                'ready': ready,
+                'workers': self.utilization()}
+
+    def _broker_loop(self, ready):
+        context = zmq.Context.instance()
+        frontend = context.socket(zmq.ROUTER)
+        frontend.bind(SERVER_LISTEN_URI)
+        backend = context.socket(zmq.ROUTER)
+        backend.bind(WORKER_URI)
+        ready.set()
+        idle = [] # worker ids, least recently used first
+        busy = {} # worker id : time the current request was dispatched
+        names = {} # worker id : worker name
+        queued = deque() # requests waiting for an idle worker
+        poller = zmq.Poller()
+        poller.register(backend, zmq.POLLIN)
+        poller.register(frontend, zmq.POLLIN)
+        last_check = time.monotonic()
+        while self._running:
+            events = dict(poller.poll(100))
+            if backend in events:
+                frames = backend.recv_multipart()
+                worker_id = frames[0]
+                if frames[1] == b'READY':
+                    names[worker_id] = frames[2].decode('utf-8') if len(frames) > 2 else worker_id.hex()
+                    self._register(names[worker_id], frames[3:])
+                else: # [worker id, client id, request id, response]
+                    name = names.get(worker_id)
+                    if (worker_id in busy) and name:
+                        self._stats[name]['busy'] += time.monotonic() - busy.pop(worker_id)
+                        self._stats[name]['requests'] += 1
+                    frontend.send_multipart(frames[1:])
+                if worker_id in names:
+                    idle.append(worker_id)
+            if frontend in events:
+                frames = frontend.recv_multipart() # [client id, payload frames...]
+                is_status, request_id = self._status_request(frames)
+                if is_status:
+                    body = json.dumps(self.status(ready=len(names))).encode('utf-8')
+                    frontend.send_multipart([frames[0]] + ([request_id.encode('utf-8')] if request_id else []) + [body])
+                else:
+                    queued.append(frames)
+            while queued and idle:
+                worker_id = idle.pop(0)
+                busy[worker_id] = time.monotonic()
+                backend.send_multipart([worker_id] + queued.popleft())
+            if time.monotonic() - last_check > 1:
+                self._restart_dead_workers(idle, busy, names)
+                last_check = time.monotonic()
+        frontend.close(linger=0)
+        backend.close(linger=0)
+
+    def utilization(self):
+        '''{worker name : {'requests', 'busy' [s], 'utilization' (busy fraction since start), 'restarts', 'startup' [s], 'first_solve' [s]}}'''
+        uptime = max(time.monotonic() - self._started_at, 1e-9) if self._started_at else 1e-9
+        return {name: dict(stats, utilization=stats['busy'] / uptime) for name, stats in self._stats.items()}
+
+def _seconds(value):
+    return '-' if value is None else '{:.1f}'.format(value)
+
+def _read_pid(pidfile):
+    '''pid of the daemon of pidfile, None if it isn't running'''
+    try:
+        with open(pidfile) as file:
+            pid = int(file.read().strip())
+        os.kill(pid, 0)
+        return pid
+    except (OSError, ValueError):
+        return None
+
+def _daemon_status(timeout):
+    '''status of the daemon answering at CLIENT_CONNECT_URI, None if none answers within timeout [s]'''
+    julia_client.set_socket_type(zmq.DEALER)
+    julia_client.connect()
+    try:
+        return json.loads(julia_client.send('status', timeout=timeout))
+    except (TimeoutError, ValueError):
+        return None
+    finally:
+        julia_client.disconnect()
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Julia optimization server daemon, reused by the simulations of this host')
+    parser.add_argument('command', choices=['start', 'serve', 'stop', 'status'],
+        help='start: launch the daemon in the background and wait until it is warm | serve: run it in the foreground | stop | status')
+    parser.add_argument('--workers', type=int, default=int(os.environ.get('JULIA_WORKERS', '1')), help='number of julia worker processes')
+    parser.add_argument('--pidfile', default=PIDFILE)
+    parser.add_argument('--timeout', type=float, default=1800, help='[s] start waits for the daemon to be warm')
+    parser.add_argument('--log', default=None, help='output of the daemon started with start (default: next to the pidfile)')
+    args = parser.parse_args(argv)
+    if args.log is None:
+        args.log = os.path.splitext(args.pidfile)[0] + '.log'
+
+    if args.command == 'serve':
+        JuliaServer(workers=args.workers).serve(args.pidfile)
+    elif args.command == 'start':
+        pid = _read_pid(args.pidfile)
+        if pid:
+            print('Julia daemon already running (pid {})'.format(pid))
+            return 0
+        started = time.monotonic()
+        with open(args.log, 'a') as log:
+            process = subprocess.Popen([sys.executable, '-u', os.path.abspath(__file__), 'serve',
+                '--workers', str(args.workers), '--pidfile', args.pidfile],
+                stdin=subprocess.DEVNULL, stdout=log, stderr=subprocess.STDOUT, start_new_session=True)
+        while time.monotonic() - started < args.timeout:
+            if process.poll() is not None:
+                print('Julia daemon exited with code {}, see {}'.format(process.returncode, args.log))
+                return 1
+            status = _daemon_status(timeout=1)
+            if status and status['ready'] > 0:
+                print('Julia daemon (pid {}) warm after {:.1f} s'.format(status['pid'], time.monotonic() - started))
+                for name, stats in sorted(status['workers'].items()):
+                    print(' - {}: startup = {} s, warmup solve = {} s'.format(name, _seconds(stats['startup']), _seconds(stats['first_solve'])))
+                return 0
+            time.sleep(1)
+        print('Julia daemon not warm after {} s, stopping it'.format(args.timeout))
+        process.terminate()
+        return 1
+    elif args.command == 'stop':
+        pid = _read_pid(args.pidfile)
+        if not pid:
+            print('Julia daemon not running')
+            return 0
+        os.kill(pid, signal.SIGTERM)
+        deadline = time.monotonic() + 30
+        while _read_pid(args.pidfile) == pid:
+            if time.monotonic() > deadline:
+                os.kill(pid, signal.SIGKILL)
+                os.remove(args.pidfile)
+                break
+            time.sleep(0.1)
+        print('Julia daemon (pid {}) stopped'.format(pid))
+    elif args.command == 'status':
+        status = _daemon_status(timeout=2)
+        if status is None:
+            print('no Julia daemon answering at {}'.format(julia_client._connection_uri))
+            return 1
+        print(json.dumps(status, indent=2))
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
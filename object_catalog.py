@@ -0,0 +1,92 @@
+'''
+ObjectCatalog indexes the objects of the loaded GridLAB-D model once, so find() style lookups
+by class, supernode_name or parent are dict lookups instead of a scan over every object in the model
+'''
+
+class ObjectCatalog:
+	'''
+	index of all GLD objects by the (static) properties used to search the model:
+		INDEXED : property names that are indexed (class | supernode_name | parent)
+		objects : {object name : {indexed property : value}}
+		index   : {indexed property : {value : [object names]}}
+	the catalog is built once (normally in on_init) and only needs rebuilding if objects are added to or removed from the model
+	'''
+	INDEXED = ('class','supernode_name','parent')
+
+	def __init__(self,gridlabd):
+		self.gld = gridlabd
+		self.objects = {}
+		self.index = {key:{} for key in self.INDEXED}
+		self.nobjects = 0
+		self.names = [] # object names of the model the catalog was built from
+		self.valid = False
+
+	def build(self):
+		'''
+		scans the GLD model once and indexes every object by class, supernode_name and parent
+		'''
+		names = self.gld.get("objects")
+		self.objects = {}
+		self.index = {key:{} for key in self.INDEXED}
+		for name in names:
+			item = self.gld.get_object(name)
+			if "name" in item.keys():
+				oname = item['name']
+			else:
+				oname = "{}_{}".format(item['class'],item['id'])
+			self.objects[oname] = {key:item[key] for key in self.INDEXED if key in item}
+			for key in self.objects[oname]:
+				self.index[key].setdefault(self.objects[oname][key],[]).append(oname)
+		self.nobjects = len(names)
+		self.names = list(names)
+		self.valid = True
+		return self
+
+	def invalidate(self):
+		'''
+		marks the catalog as stale, the next lookup rebuilds it
+		'''
+		self.valid = False
+
+	def refresh_if_changed(self):
+		'''
+		rebuilds the catalog only if the objects of the GLD model changed since it was built (compares the object names,
+		so an object replaced by another one is detected even though the count is the same)
+		returns True if the catalog was rebuilt
+		'''
+		if (not self.valid) or (list(self.gld.get("objects")) != self.names):
+			self.build()
+			return True
+		return False
+
+	def find(self,key,value):
+		'''
+		returns the list of object names with property key==value (key must be one of INDEXED)
+		'''
+		if key not in self.INDEXED:
+			raise KeyError("ObjectCatalog.find(): property '{}' is not indexed".format(key))
+		if not self.valid:
+			self.build()
+		return list(self.index[key].get(value,[]))
+
+	def members(self,cls,key,value):
+		'''
+		returns the list of objects of class cls with indexed property key==value, e.g. members('inverter','supernode_name','supernode_101')
+		'''
+		if not self.valid:
+			self.build()
+		return [name for name in self.index[key].get(value,[]) if self.objects[name].get('class') == cls]
+
+	def get(self,name,key,default=None):
+		'''
+		returns the cached value of indexed property key for object name
+		'''
+		if not self.valid:
+			self.build()
+		return self.objects.get(name,{}).get(key,default)
+
+	def parent(self,name):
+		'''
+		returns the parent of object name (or None if it has no parent)
+		'''
+		return self.get(name,'parent')
@@ -31,6 +31,10 @@ cp -r $OPENFIDO_INPUT/* .
 input_glm=`ls -1 $OPENFIDO_INPUT/*.glm | sed 's#.*/##'`
 echo "Input GLM: $input_glm"
 
+echo "Starting the Julia daemon shared by the runs below"
+trap 'python3 -u julia_server.py stop || true' EXIT
+python3 -u julia_server.py start --workers ${JULIA_WORKERS:-1} || echo "Julia daemon not started, each run starts its own Julia server"
+
 echo "Running GridLabD"
 
 python3 -u run_gridlabd_main.py -B \
@@ -0,0 +1,57 @@
+import csv
+
+
+class Actuator:
+    '''
+    Sends the TurnOn / TurnOff effects of the virtual batteries to gridlabd, only for real transitions.
+        commanded : {device id : last command sent} (TurnOn / TurnOff .command(), e.g. 'OFF' or ('ON','COOL'))
+        An effect is sent only if its command differs from the one last sent to the device, and only the last
+        effect per device of a send() call is considered (same final state as sending them all in order).
+        Per-step sent / suppressed counts are kept in steps {time : [sent, suppressed]}.
+        Code that changes a device in gridlabd outside the actuator must call forget() so the next command goes out.
+    '''
+    def __init__(self):
+        self.commanded = {}
+        self.steps = {}
+        self.sent = 0
+        self.suppressed = 0
+
+    def send(self, effects, time=None):
+        '''sends the turn_on + turn_off effects of one VB step, returns the number of effects sent'''
+        commands = effects.turn_on + effects.turn_off
+        latest = {}
+        for effect in commands:
+            latest[effect.gld.id] = effect
+        suppressed = len(commands) - len(latest)
+        sent = 0
+        for device_id, effect in latest.items():
+            command = effect.command()
+            if self.commanded.get(device_id) == command:
+                suppressed += 1
+                continue
+            effect.send()
+            self.commanded[device_id] = command
+            sent += 1
+        step = self.steps.setdefault(time, [0, 0])
+        step[0] += sent
+        step[1] += suppressed
+        self.sent += sent
+        self.suppressed += suppressed
+        return sent
+
+    def forget(self, *device_ids):
+        '''the devices were changed outside the actuator, their next command is always sent'''
+        for device_id in device_ids:
+            self.commanded.pop(device_id, None)
+
+    def step_counts(self, time):
+        '''[sent, suppressed] effects of the step at time'''
+        return self.steps.get(time, [0, 0])
+
+    def write(self, filename):
+        '''writes the per-step sent / suppressed counts to a csv file'''
+        with open(filename, mode='w', newline='') as file:
+            writer = csv.writer(file)
+            writer.writerow(['time', 'sent', 'suppressed'])
+            for time, (sent, suppressed) in self.steps.items():
+                writer.writerow([time, sent, suppressed])
@@ -0,0 +1,135 @@
+import csv
+import time as _time
+
+import numpy as np
+
+
+def greedy_accept(kw, budget):
+    '''
+    Accepts requests in order while they move the total closer to the setpoint (|x+kw-s| <= |x-s|, i.e. x+kw/2 <= s),
+    skipping requests that don't fit, exactly like the original VirtualBattery.handle_power_requests loop.
+    Runs whole accepted stretches as one prefix-sum comparison.
+        kw     : request kW in arbitration order
+        budget : setpoint - current total kW
+    returns the boolean acceptance mask
+    '''
+    accepted = np.zeros(len(kw), dtype=bool)
+    pos = 0
+    while pos < len(kw):
+        rest = kw[pos:]
+        fits = (np.cumsum(rest) - rest / 2) <= budget
+        n = len(rest) if fits.all() else int(np.argmin(fits))
+        accepted[pos:pos + n] = True
+        budget -= float(np.sum(rest[:n]))
+        pos += n
+        if pos >= len(kw):
+            break
+        # skip to the next request that fits on its own
+        single = kw[pos:] / 2 <= budget
+        if not single.any():
+            break
+        pos += int(np.argmax(single))
+    return accepted
+
+def random_order(generator, kw, soc):
+    '''requests in random arrival order (the original shuffle), drawn from the VB's RequestGenerator'''
+    return generator.permutation(len(kw))
+
+def lowest_soc_first(generator, kw, soc):
+    '''
+    requests of the devices with the lowest soc first (the order a min-heap keyed by soc is drained in),
+    ties in random arrival order
+    '''
+    order = generator.permutation(len(kw))
+    return order[np.argsort(soc[order], kind='stable')]
+
+ARBITRATION_POLICIES = {
+    'random': random_order,
+    'lowest_soc': lowest_soc_first,
+}
+
+LOG_COLUMNS = ['time', 'policy', 'setpoint', 'load', 'tracking_error', 'requests', 'accepted', 'arbitration_sec']
+
+
+class ArbitrationLog:
+    '''
+    Per-step arbitration rows (LOG_COLUMNS) of any number of virtual batteries, to compare policies on
+    tracking error (load - setpoint after the step) and arbitration cost
+    '''
+    def __init__(self):
+        self.rows = []
+
+    def record(self, *row):
+        self.rows.append(row)
+
+    def summary(self):
+        '''mean and rms absolute tracking error [kW], requests handled and total arbitration time [s]'''
+        if not self.rows:
+            return {'steps': 0, 'mean_abs_error': 0.0, 'rms_error': 0.0, 'requests': 0, 'arbitration_sec': 0.0}
+        error = np.array([row[4] for row in self.rows], dtype=float)
+        return {'steps': len(self.rows),
+                'mean_abs_error': float(np.mean(np.abs(error))),
+                'rms_error': float(np.sqrt(np.mean(error ** 2))),
+                'requests': int(sum(row[5] for row in self.rows)),
+                'arbitration_sec': float(sum(row[7] for row in self.rows))}
+
+    def write(self, filename):
+        '''writes the per-step rows to a csv file'''
+        with open(filename, mode='w', newline='') as file:
+            writer = csv.writer(file)
+            writer.writerow(LOG_COLUMNS)
+            writer.writerows(self.rows)
+
+
+class Arbiter:
+    '''
+    Decides which power requests of a virtual battery step are accepted.
+        policy    : name in ARBITRATION_POLICIES, orders the requests
+        generator : the VB's RequestGenerator, random draws of the policies
+        log       : ArbitrationLog the step rows go to (none kept if None)
+        The ordered requests are accepted with greedy_accept (prefix sums of the ordered kW against the setpoint).
+    '''
+    def __init__(self, policy='random', generator=None, log=None):
+        if policy not in ARBITRATION_POLICIES:
+            raise ValueError('unknown arbitration policy "{}", expected one of {}'.format(policy, ', '.join(ARBITRATION_POLICIES)))
+        self.policy = policy
+        self.order = ARBITRATION_POLICIES[policy]
+        self.generator = generator
+        self.log = log
+        self._requests = 0
+        self._accepted = 0
+        self._accepted_kw = 0.0
+        self._seconds = 0.0
+
+    def arbitrate(self, kw, soc, setpoint, totalkw):
+        '''
+        kw, soc  : arrays of the requests' kW and device soc
+        totalkw  : VB load before the requests
+        returns the indices of the accepted requests (in acceptance order) and the new total kW
+        '''
+        start = _time.perf_counter()
+        kw = np.asarray(kw, dtype=float)
+        order = self.order(self.generator, kw, np.asarray(soc, dtype=float))
+        accept = greedy_accept(kw[order], setpoint - totalkw)
+        accepted = order[accept]
+        accepted_kw = float(np.sum(kw[accepted]))
+        totalkw += accepted_kw
+        self._requests += len(kw)
+        self._accepted += len(accepted)
+        self._accepted_kw += accepted_kw
+        self._seconds += _time.perf_counter() - start
+        return accepted, totalkw
+
+    def end_step(self, time, setpoint, measured_kw):
+        '''
+        logs the step (requests and time of the arbitrate calls since the last step)
+            measured_kw : measured load of the devices left in the VB after the step's effects,
+                          the logged load adds the kW of the requests accepted since the last step
+        '''
+        if self.log is not None:
+            load = measured_kw + self._accepted_kw
+            self.log.record(time, self.policy, setpoint, load, load - setpoint, self._requests, self._accepted, self._seconds)
+        self._requests = 0
+        self._accepted = 0
+        self._accepted_kw = 0.0
+        self._seconds = 0.0
@@ -0,0 +1,217 @@
+'''
+Benchmark of one VirtualBattery.next() step on a synthetic island, outside of gridlab-d.
+
+    python3 -m packetized.benchmark [--devices 10000] [--steps 5] [--seed 0] [--arbitration random,lowest_soc] [--fleet drift]
+
+For each device mode and arbitration policy it reports, per step:
+    get_value : gridlabd.get_value calls (split into the per-step refresh and the VirtualBattery.next call)
+    records   : vb_device objects created
+    alloc_kB  : peak memory allocated by python during the step (tracemalloc)
+    ms        : wall-clock time of the step (without tracemalloc)
+    vb_ms     : part of ms spent in the battery (device_updates() and next(), without the snapshot refresh)
+    visited   : devices apply_pem_changes went through (all of them, except in scheduled mode)
+    arb_ms    : time spent arbitrating the step's power requests
+    track_kW  : mean absolute tracking error (VB load - setpoint) after the step
+
+In scheduled mode every step asserts that the visited devices are the active ones (active_devices).
+The setpoint is the mean load of the drifting devices plus the fleet's headroom kW per device, less than the
+power requests of a step add, so the policies accept different requests and their tracking errors must differ.
+
+FLEETS sets the synthetic island:
+    drift : temperatures across the whole PEM bands with a large random walk, 30 s steps; every device of the
+            battery is active at every step (PEM_OFF timers end every step, many devices enter an exit band)
+    held  : temperatures in the lower half of the request bands with a small random walk, 10 s steps; most devices
+            of the battery hold PEM_ON for CONTROL_EPOCH_SEC, their steps need no pem() call in scheduled mode
+'''
+import argparse
+import random
+import time
+import tracemalloc
+
+import numpy as np
+
+import packetized.vb_device as vb
+from packetized.virtual_battery import VirtualBattery
+from packetized.vector_battery import VectorVirtualBattery
+from packetized.device_snapshot import DeviceSnapshot
+from packetized.arbitration import ArbitrationLog, ARBITRATION_POLICIES
+
+
+FLEETS = {
+    'drift': dict(step_sec=30, wh_temperature=(115, 145), house_temperature=(62, 80), wh_drift=2, house_drift=0.5, headroom=0.1),
+    'held':  dict(step_sec=10, wh_temperature=(121, 128), house_temperature=(74.5, 77.5), wh_drift=0.2, house_drift=0.05, headroom=0.3),
+}
+
+class SyntheticGridlabd:
+    '''In-memory stand-in for the gridlabd module API used by the packetized devices, counting get_value/set_value calls'''
+    def __init__(self, n_devices, seed=0, fleet=FLEETS['drift']):
+        rnd = random.Random(seed)
+        self.fleet = fleet
+        self.values = {}
+        self.get_calls = 0
+        self.set_calls = 0
+        self.waterheaters = ['waterheater_{}'.format(i) for i in range(n_devices // 2)]
+        self.houses = ['house_{}'.format(i) for i in range(n_devices - n_devices // 2)]
+        for wh in self.waterheaters:
+            self.values[wh] = {'tank_setpoint': '130 degF', 'temperature': '{:.2f} degF'.format(rnd.uniform(*fleet['wh_temperature'])),
+                               'actual_load': '{} kW'.format(rnd.choice([0.0, 4.5]))}
+        for h in self.houses:
+            self.values[h] = {'cooling_setpoint': '76 degF', 'heating_setpoint': '65 degF', 'thermostat_deadband': '2 degF',
+                              'air_temperature': '{:.2f} degF'.format(rnd.uniform(*fleet['house_temperature'])),
+                              'hvac_load': '{} kW'.format(rnd.choice([0.0, 3.0])), 'outdoor_temperature': '85 degF'}
+        self.rnd = rnd
+
+    def get_value(self, name, prop):
+        self.get_calls += 1
+        return self.values[name][prop]
+
+    def set_value(self, name, prop, value):
+        self.set_calls += 1
+        self.values[name][prop] = value
+
+    def drift(self):
+        '''random walk of device temperatures and loads between steps'''
+        wh_drift, house_drift = self.fleet['wh_drift'], self.fleet['house_drift']
+        for wh in self.waterheaters:
+            T = float(self.values[wh]['temperature'].split(' ')[0]) + self.rnd.uniform(-wh_drift, wh_drift)
+            self.values[wh]['temperature'] = '{:.2f} degF'.format(T)
+            self.values[wh]['actual_load'] = '{} kW'.format(self.rnd.choice([0.0, 4.5]))
+        for h in self.houses:
+            T = float(self.values[h]['air_temperature'].split(' ')[0]) + self.rnd.uniform(-house_drift, house_drift)
+            self.values[h]['air_temperature'] = '{:.2f} degF'.format(T)
+            self.values[h]['hvac_load'] = '{} kW'.format(self.rnd.choice([0.0, 3.0]))
+
+
+def drift_kw(gld):
+    '''mean load [kW] of the synthetic devices, half of them on at any time'''
+    return 0.5 * (4.5 * len(gld.waterheaters) + 3.0 * len(gld.houses))
+
+
+class RecordCounter:
+    '''counts vb_device constructions'''
+    def __init__(self):
+        self.count = 0
+        self._init = vb.vb_device.__init__
+
+    def __enter__(self):
+        counter = self
+        init = self._init
+        def counted_init(dev, *args, **kwargs):
+            counter.count += 1
+            init(dev, *args, **kwargs)
+        vb.vb_device.__init__ = counted_init
+        return self
+
+    def __exit__(self, *exc):
+        vb.vb_device.__init__ = self._init
+
+
+MODES = {
+    'copy':          dict(snapshot=False, in_place=False, engine=VirtualBattery),
+    'copy+snapshot': dict(snapshot=True, in_place=False, engine=VirtualBattery),
+    'in_place':      dict(snapshot=True, in_place=True, engine=VirtualBattery),
+    'vector':        dict(snapshot=True, in_place=False, engine=VectorVirtualBattery),
+    'scheduled':     dict(snapshot=True, in_place=True, engine=VirtualBattery, options={'scheduled': True}),
+}
+
+def build(mode, n_devices, seed, arbitration='random', log=None, fleet=FLEETS['drift']):
+    gld = SyntheticGridlabd(n_devices, seed, fleet)
+    snapshot = DeviceSnapshot(gld, gld.waterheaters, gld.houses).refresh(0) if mode['snapshot'] else None
+    devices = [vb.vb_device(vb.gldWaterHeater(wh, gld, snapshot=snapshot), in_place=mode['in_place']) for wh in gld.waterheaters]
+    devices += [vb.vb_device(vb.gldHVAC(h, gld, snapshot=snapshot), in_place=mode['in_place']) for h in gld.houses]
+    battery = mode['engine'](devices=devices, seed=seed, arbitration=arbitration, arbitration_log=log, **mode.get('options', {}))
+    return gld, snapshot, battery
+
+def active_devices(snapshot, battery, t):
+    '''
+    devices of a scheduled step at t, from their records: timer ended, not PEM_OFF (EXIT states, PEM_ON whose TurnOn
+    takes part in the acceptance) or in an exit band
+    '''
+    snapshot.refresh(t)
+    active = 0
+    for device in battery.devices.values():
+        gld = device.gld_dev.update_from_gld()
+        if ((t >= device.state_ends_at) or (device.pem_state is not vb.PEM_STATE.PEM_OFF)
+                or gld.check_stat('EXIT_ON') or gld.check_stat('EXIT_OFF')):
+            active += 1
+    return active
+
+def check_visits(battery, t, active):
+    '''the devices a scheduled step visits track the active devices, not the size of the battery'''
+    if battery.visited != active:
+        raise AssertionError('scheduled step at {} s visited {} devices, {} are active'.format(t, battery.visited, active))
+
+def visited(battery):
+    '''devices the last step went through, all of them for the vector engine'''
+    return battery.visited if isinstance(battery, VirtualBattery) else battery.n
+
+def step(gld, snapshot, battery, t, setpoint):
+    '''one packetize_island step: per-step refresh then VirtualBattery.next()'''
+    gets = gld.get_calls
+    if snapshot is not None:
+        snapshot.refresh(t)
+    refresh_gets = gld.get_calls - gets
+    t0 = time.perf_counter()
+    battery.next(setpoint=setpoint, device_updates=battery.device_updates(), time=t)
+    return refresh_gets, gld.get_calls - gets - refresh_gets, time.perf_counter() - t0
+
+def run(name, n_devices, steps, seed, arbitration='random', fleet='drift'):
+    mode = MODES[name]
+    fleet = FLEETS[fleet]
+    log = ArbitrationLog()
+    gld, snapshot, battery = build(mode, n_devices, seed, arbitration, log, fleet)
+    scheduled = mode.get('options', {}).get('scheduled', False)
+    rows = []
+    setpoint = drift_kw(gld) + fleet['headroom'] * n_devices
+    step_sec = fleet['step_sec']
+    for k in range(1, steps + 1):
+        gld.drift()
+        t = 2 * k * step_sec
+        if scheduled:
+            active = active_devices(snapshot, battery, t)
+        with RecordCounter() as records:
+            tracemalloc.start()
+            refresh_gets, next_gets, _ = step(gld, snapshot, battery, t, setpoint)
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+        if scheduled:
+            check_visits(battery, t, active)
+        visits = visited(battery)
+        gld.drift()
+        if scheduled:
+            active = active_devices(snapshot, battery, t + step_sec)
+        t0 = time.perf_counter()
+        _, _, vb_sec = step(gld, snapshot, battery, t + step_sec, setpoint)
+        ms = (time.perf_counter() - t0) * 1000
+        if scheduled:
+            check_visits(battery, t + step_sec, active)
+        rows.append((refresh_gets, next_gets, records.count, peak / 1024, ms, vb_sec * 1000, (visits + visited(battery)) / 2))
+    summary = log.summary()
+    return tuple(np.mean(np.array(rows), axis=0)) + (summary['arbitration_sec'] * 1000 / max(summary['steps'], 1), summary['mean_abs_error'])
+
+def check_policies(name, track):
+    '''the policies accept different requests at the benchmark setpoint, equal tracking errors mean one was not applied'''
+    if len(track) > 1 and len(set(track.values())) == 1:
+        raise AssertionError('{}: every arbitration policy gives the same tracking error {:.2f} kW'.format(name, next(iter(track.values()))))
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark VirtualBattery.next() device modes on a synthetic island')
+    parser.add_argument('--devices', type=int, default=10000)
+    parser.add_argument('--steps', type=int, default=5)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--modes', default=','.join(MODES))
+    parser.add_argument('--fleet', default='drift', choices=list(FLEETS), help='synthetic island, see FLEETS')
+    parser.add_argument('--arbitration', default=','.join(ARBITRATION_POLICIES), help='power request arbitration policies: {}'.format(' | '.join(ARBITRATION_POLICIES)))
+    args = parser.parse_args()
+    policies = args.arbitration.split(',')
+    print('{} devices, {} fleet, mean over {} steps'.format(args.devices, args.fleet, args.steps))
+    print('{:<15}{:<12}{:>16}{:>16}{:>10}{:>12}{:>10}{:>10}{:>10}{:>10}{:>10}'.format('mode', 'policy', 'get_value/step', ' (in next())', 'records', 'alloc_kB', 'ms', 'vb_ms', 'visited', 'arb_ms', 'track_kW'))
+    for name in args.modes.split(','):
+        track = {}
+        for policy in policies:
+            refresh_gets, next_gets, records, alloc, ms, vb_ms, visits, arb_ms, track[policy] = run(name, args.devices, args.steps, args.seed, policy, args.fleet)
+            print('{:<15}{:<12}{:>16.0f}{:>16.0f}{:>10.0f}{:>12.0f}{:>10.1f}{:>10.1f}{:>10.0f}{:>10.2f}{:>10.2f}'.format(name, policy, refresh_gets + next_gets, next_gets, records, alloc, ms, vb_ms, visits, arb_ms, track[policy]))
+        check_policies(name, track)
+
+if __name__ == '__main__':
+    main()
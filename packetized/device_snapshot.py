@@ -0,0 +1,77 @@
+import numpy as np
+
+from packetized.vb_device import convert_power_units
+
+WATERHEATER = 0
+HVAC = 1
+
+# gridlabd property read for each device kind: (temperature, load, outdoor temperature)
+SNAPSHOT_PROPERTIES = {
+    WATERHEATER: ('temperature', 'actual_load', None),
+    HVAC: ('air_temperature', 'hvac_load', 'outdoor_temperature'),
+}
+
+def read_float(value):
+    '''parses a gridlabd value string with units ("120.5 degF") into a float'''
+    return float(value.split(' ')[0])
+
+class DeviceSnapshot:
+    '''
+    Per-timestep snapshot of the dynamic state of every controllable device.
+        Every property is read from gridlabd once per refresh() and stored in contiguous arrays indexed by device slot:
+            temperature         : water heater tank temperature | house air_temperature [degF]
+            kw                  : water heater actual_load | house hvac_load [kW]
+            outdoor_temperature : house outdoor_temperature [degF] (nan for water heaters)
+            water_demand        : water heater water_demand [gpm], only read when created with water_demand=True (nan otherwise)
+        With loads_only=True only kw is read (for the flexible load of runs without virtual batteries).
+        gldWaterHeater / gldHVAC objects attached to the snapshot read from these arrays instead of gridlabd.
+    '''
+    def __init__(self, gridlabd, waterheaters=(), houses=(), water_demand=False, loads_only=False):
+        self.gld = gridlabd
+        self.ids = list(waterheaters) + list(houses)
+        self.slot = {dev_id: i for i, dev_id in enumerate(self.ids)}
+        self.kind = np.array([WATERHEATER] * len(waterheaters) + [HVAC] * len(houses), dtype=np.int8)
+        n = len(self.ids)
+        self.temperature = np.zeros(n)
+        self.kw = np.zeros(n)
+        self.outdoor_temperature = np.full(n, np.nan)
+        self.read_water_demand = water_demand
+        self.loads_only = loads_only
+        self.water_demand = np.full(n, np.nan)
+        self.time = None
+        self.reads = 0
+
+    def __len__(self):
+        return len(self.ids)
+
+    def refresh(self, time=None):
+        '''Read every snapshot property of every device from gridlabd (once per commit)'''
+        get_value = self.gld.get_value
+        for i, dev_id in enumerate(self.ids):
+            temp_prop, load_prop, out_prop = SNAPSHOT_PROPERTIES[self.kind[i]]
+            if self.loads_only:
+                self.kw[i] = convert_power_units(get_value(dev_id, load_prop), 'kW', 'kW')
+                self.reads += 1
+                continue
+            self.temperature[i] = read_float(get_value(dev_id, temp_prop))
+            self.kw[i] = convert_power_units(get_value(dev_id, load_prop), 'kW', 'kW')
+            if out_prop:
+                self.outdoor_temperature[i] = read_float(get_value(dev_id, out_prop))
+                self.reads += 3
+            else:
+                self.reads += 2
+                if self.read_water_demand:
+                    self.water_demand[i] = read_float(get_value(dev_id, 'water_demand'))
+                    self.reads += 1
+        self.time = time
+        return self
+
+    def slots(self, device_ids):
+        '''Array of snapshot slots for the given device ids'''
+        return np.array([self.slot[dev_id] for dev_id in device_ids], dtype=np.intp)
+
+    def total_kw(self, device_ids=None):
+        '''Total load [kW] of the given devices (all devices if None)'''
+        if device_ids is None:
+            return float(np.sum(self.kw))
+        return float(np.sum(self.kw[self.slots(device_ids)]))
@@ -0,0 +1,55 @@
+import numpy as np
+
+from packetized.vb_device import COMM_EPOCH_SEC, CONTROL_EPOCH_SEC
+from packetized.device_snapshot import WATERHEATER, HVAC
+
+def request_probability(soc):
+    '''Vector form of the REQ_die_roll probability'''
+    with np.errstate(divide='ignore', invalid='ignore', over='ignore'):
+        u = ((1 - soc) / soc) * (COMM_EPOCH_SEC / CONTROL_EPOCH_SEC)
+        p = 1.0 - np.exp(-u)
+    return np.where(soc <= 0.0, 1.0, np.where(soc >= 1.0, 0.0, p))
+
+def request_band_count(kind, sp_hi, sp_lo, pem_range, T):
+    '''Number of PEM REQUEST bands each device temperature is in (check_stat("REQUEST") rolls once per band)'''
+    in_hi = (sp_hi - pem_range < T) & (T < sp_hi + pem_range)
+    in_lo = (sp_lo - pem_range < T) & (T < sp_lo + pem_range)
+    return np.where(kind == WATERHEATER, in_hi, in_hi.astype(np.int8) + in_lo)
+
+def island_seed(seed, island):
+    '''Seed of an island's generator: the run seed combined with the island's supernode ids (stable across re-islanding)'''
+    return [int(seed)] + sorted(int(sn) for sn in island)
+
+class RequestGenerator:
+    '''
+    Batched, seeded power request die-roll of one virtual battery.
+        Every step the REQ_die_roll probability of all devices is computed as one vector operation and
+        the decisions are drawn from a numpy.random.Generator, then handed to the devices' check_stat("REQUEST").
+        The same generator orders the power requests in handle_power_requests, so a run is reproducible from its seed.
+    '''
+    def __init__(self, seed=None):
+        self.seed = seed
+        self.rng = np.random.default_rng(seed)
+        self.draws = 0
+
+    def decisions(self, soc, bands, eligible=None):
+        '''
+        Request decision per device, for a device whose temperature is in the given number of REQUEST bands.
+        Only the eligible devices in a band are drawn for (in device order), the others are False.
+        '''
+        mask = bands > 0
+        if eligible is not None:
+            mask &= eligible
+        p = 1.0 - (1.0 - request_probability(soc[mask])) ** bands[mask]
+        self.draws += len(p)
+        rolls = np.zeros(len(bands), dtype=bool)
+        rolls[mask] = self.rng.random(len(p)) < p
+        return rolls
+
+    def roll(self, kind, sp_hi, sp_lo, pem_range, T, soc, eligible=None):
+        '''Request decisions of devices given as arrays, rolled once per REQUEST band their temperature is in'''
+        return self.decisions(soc, request_band_count(kind, sp_hi, sp_lo, pem_range, T), eligible)
+
+    def permutation(self, n):
+        '''Arrival order of n power requests'''
+        return self.rng.permutation(n)
@@ -51,6 +51,12 @@ def REQ_die_roll(device):
     #print('soc:{:.02f}, u={:.02f}, p={:.03f}'.format(soc,u,1-np.exp(-u*COMM_EPOCH_SEC)))
     return r_random() < ( 1.0 - np.exp( -u ) )
 
+def request_decision(device):
+    '''decision drawn for this step by the virtual battery's RequestGenerator, or a REQ_die_roll if none was drawn'''
+    if device.request_roll is None:
+        return REQ_die_roll(device)
+    return device.request_roll
+
 
 
 # Effects
@@ -76,6 +82,8 @@ class TurnOn():
 		self.gld = dev.gld_dev
 		self.kw = dev.last_power_draw_kw
 		self.on = True
+	def command(self):
+		return self.gld.command(True)
 	def send(self):
 		self.gld.turn_on()
 
@@ -85,6 +93,8 @@ class TurnOff():
 		self.gld = dev.gld_dev
 		self.kw = 0
 		self.on = False
+	def command(self):
+		return self.gld.command(False)
 	def send(self):
 		self.gld.turn_off()
 
@@ -112,16 +122,19 @@ class Effects():
 class gldWaterHeater:
     '''
     This is the python object version of the gridlab-d water heater objects.
-        vars: id, lower_temp, upper_temp, temperature, kw (retrieved from gld)
-        functions:  update_from_gld : updates current temperature and kw from gridlab simulation
+        vars: id, lower_temp, upper_temp, temperature, kw (retrieved from gld, or from the per-step DeviceSnapshot if one is attached)
+        functions:  update_from_gld : updates current temperature and kw from gridlab simulation (or the snapshot arrays)
                     check_stat : takes in a status to check (REQUEST | EXIT_ON | EXIT_OFF) and checks if temp is in range for that status; for REQUEST it checks if in PEM range and does the REQ_die_roll to see if it should send a power request : returns bool
                     turn_on : turns on waterheater in gld with re_override
                     turn_off : turns off waterheater in gld with re_override
     '''
-    def __init__(self,wh_id,gridlabd):
+    def __init__(self,wh_id,gridlabd,snapshot=None):
         # static vars
         self.id = wh_id
         self.gld = gridlabd
+        self.snapshot = snapshot
+        self.slot = snapshot.slot[wh_id] if snapshot is not None else None
+        self.request_roll = None # batched REQUEST decision set by the VB each step (None: roll in check_stat)
         self.setpoint = float(self.gld.get_value(wh_id,'tank_setpoint').split(' ')[0]) #degF
         self.pem_range = 10
         # pem_range = float(self.gld.get_value(wh_id,'thermostat_deadband').split(' ')[0]) # uncomment if we want to use deadband from gld
@@ -129,18 +142,22 @@ class gldWaterHeater:
         self.lower_temp = self.setpoint - self.pem_range
 
         # not static
-        self.temperature = float(self.gld.get_value(wh_id,'temperature').split(' ')[0]) #degF
-        self.kw = convert_power_units(self.gld.get_value(self.id,'actual_load'),'kW','kW') # actual load in kW in gld
-        self.soc = (self.temperature - self.lower_temp) / (self.upper_temp - self.lower_temp)
+        self.update_from_gld()
 
     def update_from_gld(self):
-        self.temperature = float(self.gld.get_value(self.id,'temperature').split(' ')[0]) #degF
-        self.kw = convert_power_units(self.gld.get_value(self.id,'actual_load'),'kW','kW') # actual load in kW in gld
+        if self.snapshot is not None:
+            self.temperature = self.snapshot.temperature[self.slot] #degF
+            self.kw = self.snapshot.kw[self.slot] # actual load in kW in gld
+        else:
+            self.temperature = float(self.gld.get_value(self.id,'temperature').split(' ')[0]) #degF
+            self.kw = convert_power_units(self.gld.get_value(self.id,'actual_load'),'kW','kW') # actual load in kW in gld
         self.soc = (self.temperature - self.lower_temp) / (self.upper_temp - self.lower_temp)
         return self
 
-    def soc_kWh(self,kWh=2,deltaT=20):#degreesF
-        self = self.update_from_gld()
+    def soc_kWh(self,kWh=2,deltaT=20,update=True):#degreesF
+        '''soc in kWh, update=False uses the state read by the last update_from_gld()'''
+        if update:
+            self = self.update_from_gld()
         return kWh/deltaT * self.soc * (self.upper_temp - self.lower_temp)
 
     def check_stat(self,stat,hysteresis=0):
@@ -153,7 +170,7 @@ class gldWaterHeater:
         T = self.temperature
         # checking temp if in PEM REQUEST range
         if ((setpoint - (pem_range + hysteresis) < T < setpoint + (pem_range + hysteresis)) and (stat == "REQUEST")):
-            if REQ_die_roll(self):
+            if request_decision(self):
                 return True
         # checking temp if in EXIT_ON range
         elif ((T < setpoint - (pem_range + hysteresis)) and (stat == "EXIT_ON")):
@@ -164,6 +181,10 @@ class gldWaterHeater:
         else: # temp not in stat range or request denied
             return False
 
+    def command(self, on):
+        '''state a turn_on / turn_off call leaves the gld device in'''
+        return 'ON' if on else 'OFF'
+
     def turn_on(self):
         self.gld.set_value(self.id, "tank_setpoint", f'{self.upper_temp+1} degF')
         #print("GLD setpoint =",self.gld.get_value(self.id, "tank_setpoint"))
@@ -177,16 +198,19 @@ class gldWaterHeater:
 class gldHVAC:
 	'''
     This is the python object version of the gridlab-d house objects (for manipulating the hvac system).
-        vars: id, setpoint_cool, setpoint_heat, temperature, kw (retrieved from gld)
-        functions:  update_from_gld : updates current temperature and kw from gridlab simulation
+        vars: id, setpoint_cool, setpoint_heat, temperature, kw (retrieved from gld, or from the per-step DeviceSnapshot if one is attached)
+        functions:  update_from_gld : updates current temperature and kw from gridlab simulation (or the snapshot arrays)
                     check_stat : takes in a status to check (REQUEST | EXIT_ON | EXIT_OFF) and checks if temp is in range for that status; for REQUEST it checks if in PEM range and does the die_roll to see if it should send a power request : returns bool
                     turn_on : turns on hvac in gld with system_mode
                     turn_off : turns off hvac in gld with system_mode
     '''
-	def __init__(self,house_id,gridlabd):
+	def __init__(self,house_id,gridlabd,snapshot=None):
 		# static vars
 		self.id = house_id
 		self.gld = gridlabd
+		self.snapshot = snapshot
+		self.slot = snapshot.slot[house_id] if snapshot is not None else None
+		self.request_roll = None # batched REQUEST decision set by the VB each step (None: roll in check_stat)
 		# disables internal controls
 		self.setpoint_upp = float(self.gld.get_value(house_id,"cooling_setpoint").split(' ')[0])
 		self.setpoint_low = float(self.gld.get_value(house_id,"heating_setpoint").split(' ')[0])
@@ -194,20 +218,17 @@ class gldHVAC:
 		self.pem_range =  float(self.gld.get_value(house_id,'thermostat_deadband').split(' ')[0])
 
 		# not static
-		self.temperature = T =  float(self.gld.get_value(house_id,'air_temperature').split(' ')[0]) #degF
-		self.kw = convert_power_units(self.gld.get_value(self.id,'hvac_load'),'kW','kW') # actual load in kW in gld
-		self.outsideT = float(self.gld.get_value(house_id,'outdoor_temperature').split(' ')[0])
-		middleT = self.setpoint_low + (self.setpoint_upp - self.setpoint_low)/2
-		if (self.outsideT <= middleT): # heating mode
-			self.soc = (self.temperature - (self.setpoint_low - self.pem_range)) / (self.pem_range * 2)
-		else: # cooling mode
-			self.soc = ((self.setpoint_upp + self.pem_range) - self.temperature) / (self.pem_range * 2)
-			pass
+		self.update_from_gld()
 
 	def update_from_gld(self):
-		self.temperature = T = float(self.gld.get_value(self.id,'air_temperature').split(' ')[0]) #degF
-		self.kw = convert_power_units(self.gld.get_value(self.id,'hvac_load'),'kW','kW') # actual load in kW in gld
-		self.outsideT = float(self.gld.get_value(self.id,'outdoor_temperature').split(' ')[0])
+		if self.snapshot is not None:
+			self.temperature = self.snapshot.temperature[self.slot] #degF
+			self.kw = self.snapshot.kw[self.slot] # actual load in kW in gld
+			self.outsideT = self.snapshot.outdoor_temperature[self.slot]
+		else:
+			self.temperature = float(self.gld.get_value(self.id,'air_temperature').split(' ')[0]) #degF
+			self.kw = convert_power_units(self.gld.get_value(self.id,'hvac_load'),'kW','kW') # actual load in kW in gld
+			self.outsideT = float(self.gld.get_value(self.id,'outdoor_temperature').split(' ')[0])
 		middleT = self.setpoint_low + (self.setpoint_upp - self.setpoint_low)/2
 		if (self.outsideT <= middleT): # heating mode
 			self.soc = (self.temperature - (self.setpoint_low - self.pem_range)) / (self.pem_range * 2)
@@ -215,8 +236,10 @@ class gldHVAC:
 			self.soc = ((self.setpoint_upp + self.pem_range) - self.temperature) / (self.pem_range * 2)
 		return self
 
-	def soc_kWh(self,kWh=2,deltaT=4):#degreesF
-		self = self.update_from_gld()
+	def soc_kWh(self,kWh=2,deltaT=4,update=True):#degreesF
+		'''soc in kWh, update=False uses the state read by the last update_from_gld()'''
+		if update:
+			self = self.update_from_gld()
 		return kWh/deltaT * self.soc * (self.pem_range*2)
 
 	def check_stat(self,stat,hysteresis=0):
@@ -231,7 +254,7 @@ class gldHVAC:
 		for setpoint in [self.setpoint_upp, self.setpoint_low]:
 			if (setpoint - (pem_range + hysteresis) < T < setpoint + (pem_range + hysteresis)):
 				exitoff = False
-				if ((stat == "REQUEST") and (REQ_die_roll(self))):
+				if ((stat == "REQUEST") and (request_decision(self))):
 					return True
 		# checking temp if in EXIT_ON range
 		for setpoint,dir in [(self.setpoint_upp,+1), (self.setpoint_low,-1)]:
@@ -244,12 +267,23 @@ class gldHVAC:
 			return True
 		return False
 
-	def turn_on(self):
-		self.gld.set_value(self.id,"thermostat_control","NONE")
+	def on_mode(self):
+		'''system_mode turn_on sets for the current temperature (None: system_mode is left as it is)'''
 		if (self.temperature > self.setpoint_upp-2):
-			self.gld.set_value(self.id, "system_mode", "COOL")
+			return "COOL"
 		elif (self.temperature < self.setpoint_low+2):
-			self.gld.set_value(self.id, "system_mode", "HEAT")
+			return "HEAT"
+		return None
+
+	def command(self,on):
+		'''state a turn_on / turn_off call leaves the gld device in'''
+		return ('ON',self.on_mode()) if on else 'OFF'
+
+	def turn_on(self):
+		self.gld.set_value(self.id,"thermostat_control","NONE")
+		mode = self.on_mode()
+		if mode:
+			self.gld.set_value(self.id, "system_mode", mode)
 
 	def turn_off(self):
 		self.gld.set_value(self.id,"thermostat_control","NONE")
@@ -257,14 +291,22 @@ class gldHVAC:
 
 
 class vb_device():
-	'''Packetization state of an individual device'''
-	def __init__(self, gld_dev, pem_state=PEM_STATE.PEM_OFF, state_ends_at=0, last_power_draw_kw=4.5):
+	'''
+	Packetization state of an individual device
+		in_place=False : every update() returns a new vb_device and re-reads the gld device
+		in_place=True  : update() changes the record in place without touching gridlabd,
+						 the gld device is only re-read by the single per-step refresh()
+	'''
+	__slots__ = ('gld_dev', 'device_id', 'pem_state', 'state_ends_at', 'last_power_draw_kw', 'kw', 'in_place')
+
+	def __init__(self, gld_dev, pem_state=PEM_STATE.PEM_OFF, state_ends_at=0, last_power_draw_kw=4.5, in_place=False):
 		self.gld_dev = gld_dev
 		self.device_id = gld_dev.id
 		self.pem_state = pem_state
 		self.state_ends_at = state_ends_at
 		self.last_power_draw_kw = last_power_draw_kw
 		self.kw = gld_dev.kw
+		self.in_place = in_place
 
 	def update(self, pem_state=None, state_ends_at=None, last_power_draw_kw=None):
 		if not pem_state:
@@ -276,10 +318,24 @@ class vb_device():
 				last_power_draw_kw = self.kw
 			else:
 				last_power_draw_kw = self.last_power_draw_kw
+		if self.in_place:
+			self.pem_state = pem_state
+			self.state_ends_at = state_ends_at
+			self.last_power_draw_kw = last_power_draw_kw
+			return self
 		gld = self.gld_dev.update_from_gld()
 		next = vb_device(gld_dev=gld, pem_state=pem_state, state_ends_at=state_ends_at, last_power_draw_kw=last_power_draw_kw)
 		return next
 
+	def refresh(self):
+		'''Per-step refresh: re-reads the gld device (in place records only touch gridlabd here)'''
+		if not self.in_place:
+			return self.update()
+		if self.kw > 0:
+			self.last_power_draw_kw = self.kw
+		self.kw = self.gld_dev.update_from_gld().kw
+		return self
+
 	def pem(self, time_sec):
 		effect = None
 		if self.pem_state is PEM_STATE.PEM_OFF:
@@ -299,9 +355,9 @@ class vb_device():
 		if time_sec < self.state_ends_at: return self, None
 		if self.gld_dev.check_stat("REQUEST",):
 			effect = PowerRequest(self.device_id, self.last_power_draw_kw, sec=CONTROL_EPOCH_SEC)
-			return self.update(state_ends_at=time_sec + COMM_EPOCH_SEC), effect
 		else:
-			return self.update(state_ends_at=time_sec + COMM_EPOCH_SEC), TurnOff(self)
+			effect = TurnOff(self)
+		return self.update(state_ends_at=time_sec + COMM_EPOCH_SEC), effect
 
 	def pem_on(self, time_sec):
 		if time_sec < self.state_ends_at:
@@ -326,21 +382,25 @@ class vb_device():
 			return self, None
 
 	def check_exits(self):
+		# effects are built before update() so they carry the pre-transition packet size in both modes
 		if self.gld_dev.check_stat("EXIT_ON"):
+			effect = TurnOn(self)
 			return self.update(
                 pem_state=PEM_STATE.EXIT_ON,
                 state_ends_at=0,
-            ), TurnOn(self)
+            ), effect
 		if self.gld_dev.check_stat("EXIT_OFF"):
+			effect = TurnOff(self)
 			return self.update(
                 pem_state=PEM_STATE.EXIT_OFF,
-                state_ends_at=0), TurnOff(self)
+                state_ends_at=0), effect
 		return self, None
 
 	def request_accepted(self,time):
 		if self.pem_state is not PEM_STATE.PEM_OFF:
 			return self, TurnOn(self)
+		effect = TurnOn(self)
 		return self.update(
             pem_state=PEM_STATE.PEM_ON,
 			state_ends_at=time+CONTROL_EPOCH_SEC
-        ), TurnOn(self)
+        ), effect
@@ -0,0 +1,139 @@
+import csv
+import os
+
+import numpy as np
+
+from packetized.device_snapshot import WATERHEATER, HVAC
+from packetized.vector_battery import vector_soc
+
+COLUMNS = ['timestamp', 'VB_soc', 'VB_avgsoc', 'VB_load', 'VB_setpoint', 'hvac_avgsoc', 'wh_avgsoc',
+           'avg_hvac_temp', 'avg_wh_temp', 'avg_out_temp', 'hvac_load', 'wh_load', 'wh_wdemand', 'nf_shed']
+FORMATS = ('csv', 'parquet', 'npz')
+
+
+class VBRecorder:
+    '''
+    Records the virtual battery time series (one row per island per call, COLUMNS) from the DeviceSnapshot arrays.
+        The aggregates of a row are computed in one vectorized pass over the island's snapshot slots
+        (device soc from the snapshot temperatures, sums split by device kind with bincount), the water demand
+        comes from the snapshot's water_demand array (create it with water_demand=True).
+        Rows go to a fixed-size buffer of capacity rows that is flushed to the output file when full:
+            csv     : rows appended to the file (same columns as the previous per-call csv writer)
+            parquet : row groups appended with pyarrow (csv if pyarrow is not installed)
+            npz     : flushed chunks are concatenated and saved as one column per array on close()
+    '''
+    def __init__(self, snapshot, devices=(), filename='virtual_battery_timeseries.csv', capacity=1024):
+        self.snapshot = snapshot
+        self.format = os.path.splitext(filename)[1].lstrip('.').lower()
+        if self.format not in FORMATS:
+            self.format = 'csv'
+        if self.format == 'parquet':
+            try:
+                import pyarrow.parquet
+            except ImportError:
+                filename = os.path.splitext(filename)[0] + '.csv'
+                self.format = 'csv'
+                print('pyarrow not found, writing the virtual battery time series to {}'.format(filename))
+        self.filename = filename
+        self.capacity = capacity
+        self.timestamps = [None] * capacity
+        self.values = np.zeros((capacity, len(COLUMNS) - 1))
+        self.count = 0 # rows in the buffer
+        self.rows = 0 # rows recorded
+        n = len(snapshot)
+        self.kind = snapshot.kind.copy()
+        self.sp_hi = np.zeros(n)
+        self.sp_lo = np.zeros(n)
+        self.pem_range = np.ones(n)
+        self.add_devices(devices)
+        self._parquet_writer = None
+        self._chunks = []
+        if os.path.exists(self.filename):
+            os.remove(self.filename)
+
+    def add_devices(self, devices):
+        '''stores the setpoints of vb_device records (or gld devices) attached to the snapshot, needed for their soc'''
+        for device in devices:
+            gld = getattr(device, 'gld_dev', device)
+            slot = self.snapshot.slot[gld.id]
+            if hasattr(gld, 'setpoint_upp'):
+                self.sp_hi[slot], self.sp_lo[slot] = gld.setpoint_upp, gld.setpoint_low
+            else:
+                self.sp_hi[slot] = self.sp_lo[slot] = gld.setpoint
+            self.pem_range[slot] = gld.pem_range
+
+    def slots(self, vb):
+        '''snapshot slots of the devices of a VirtualBattery or VectorVirtualBattery'''
+        if hasattr(vb, 'snap'):
+            return vb.snap[:vb.n]
+        return self.snapshot.slots(vb.devices.keys())
+
+    def aggregates(self, slots):
+        '''soc / temperature means and load / water demand sums of the devices in slots, split by kind'''
+        snapshot = self.snapshot
+        kind = self.kind[slots]
+        T = snapshot.temperature[slots]
+        outsideT = snapshot.outdoor_temperature[slots]
+        soc = vector_soc(kind, self.sp_hi[slots], self.sp_lo[slots], self.pem_range[slots], T, outsideT)
+        count = np.bincount(kind, minlength=2).astype(float)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            mean = lambda x: np.bincount(kind, weights=x, minlength=2) / count
+            soc_mean = mean(soc)
+            temp_mean = mean(T)
+            out_mean = mean(np.where(kind == HVAC, outsideT, 0))
+            avg_soc = float(np.sum(soc) / len(slots)) if len(slots) else np.nan
+        load = np.bincount(kind, weights=snapshot.kw[slots], minlength=2)
+        wdemand = np.bincount(kind, weights=np.where(kind == WATERHEATER, snapshot.water_demand[slots], 0), minlength=2)
+        return {'VB_avgsoc': avg_soc,
+                'hvac_avgsoc': soc_mean[HVAC], 'wh_avgsoc': soc_mean[WATERHEATER],
+                'avg_hvac_temp': temp_mean[HVAC], 'avg_wh_temp': temp_mean[WATERHEATER], 'avg_out_temp': out_mean[HVAC],
+                'hvac_load': load[HVAC], 'wh_load': load[WATERHEATER], 'wh_wdemand': wdemand[WATERHEATER]}
+
+    def record(self, timestamp, vb, vb_load, nf_load):
+        '''adds the row of one island's virtual battery'''
+        row = self.aggregates(self.slots(vb))
+        row.update({'VB_soc': vb.soc, 'VB_load': vb_load, 'VB_setpoint': vb.setpoint, 'nf_shed': round(nf_load, 2)})
+        self.timestamps[self.count] = timestamp
+        self.values[self.count] = [row[c] for c in COLUMNS[1:]]
+        self.count += 1
+        self.rows += 1
+        if self.count == self.capacity:
+            self.flush()
+
+    def flush(self):
+        '''writes the buffered rows and empties the buffer'''
+        if not self.count:
+            return
+        timestamps = self.timestamps[:self.count]
+        values = self.values[:self.count]
+        if self.format == 'csv':
+            new_file = not os.path.exists(self.filename)
+            with open(self.filename, 'a', newline='') as file:
+                writer = csv.writer(file)
+                if new_file:
+                    writer.writerow(COLUMNS)
+                writer.writerows([timestamp] + row for timestamp, row in zip(timestamps, values.tolist()))
+        elif self.format == 'parquet':
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+            columns = {'timestamp': [str(timestamp) for timestamp in timestamps]}
+            columns.update({c: values[:, k] for k, c in enumerate(COLUMNS[1:])})
+            table = pa.table(columns)
+            if self._parquet_writer is None:
+                self._parquet_writer = pq.ParquetWriter(self.filename, table.schema)
+            self._parquet_writer.write_table(table)
+        else:
+            self._chunks.append((list(timestamps), values.copy()))
+        self.count = 0
+
+    def close(self):
+        '''flushes the remaining rows and finishes the output file'''
+        self.flush()
+        if self._parquet_writer is not None:
+            self._parquet_writer.close()
+            self._parquet_writer = None
+        if (self.format == 'npz') and self._chunks:
+            values = np.concatenate([chunk[1] for chunk in self._chunks])
+            columns = {c: values[:, k] for k, c in enumerate(COLUMNS[1:])}
+            np.savez(self.filename, timestamp=np.array([t for chunk in self._chunks for t in chunk[0]], dtype=str), **columns)
+            self._chunks = []
@@ -0,0 +1,357 @@
+import numpy as np
+
+from packetized.vb_device import *
+from packetized.device_snapshot import WATERHEATER, HVAC
+from packetized.request_generator import RequestGenerator, request_probability
+from packetized.arbitration import Arbiter
+
+# integer codes of the PEM states held in the state array
+PEM_OFF, PEM_ON, EXIT_OFF, EXIT_ON = 0, 1, 2, 3
+STATE_CODES = {
+    PEM_STATE.PEM_OFF: PEM_OFF,
+    PEM_STATE.PEM_ON: PEM_ON,
+    PEM_STATE.EXIT_OFF: EXIT_OFF,
+    PEM_STATE.EXIT_ON: EXIT_ON,
+}
+STATES = {code: state for state, code in STATE_CODES.items()}
+
+# integer codes of the effect each device emits in a step
+NO_EFFECT, TURN_ON, TURN_OFF, REQUEST = 0, 1, 2, 3
+
+# soc_kWh() constants of gldWaterHeater and gldHVAC (kWh per deltaT degF)
+SOC_KWH_PER_DEGF = {WATERHEATER: 2 / 20, HVAC: 2 / 4}
+
+def vector_soc(kind, sp_hi, sp_lo, pem_range, T, outsideT):
+    '''State of charge of every device, same formulas as gldWaterHeater / gldHVAC update_from_gld'''
+    wh_soc = (T - (sp_lo - pem_range)) / (pem_range * 2)
+    heating = outsideT <= sp_lo + (sp_hi - sp_lo) / 2
+    hvac_soc = np.where(heating, (T - (sp_lo - pem_range)) / (pem_range * 2), ((sp_hi + pem_range) - T) / (pem_range * 2))
+    return np.where(kind == WATERHEATER, wh_soc, hvac_soc)
+
+def exit_on_mask(kind, sp_hi, sp_lo, pem_range, T, hysteresis=0):
+    '''Vector form of check_stat("EXIT_ON",hysteresis)'''
+    below = T < sp_lo - (pem_range + hysteresis)
+    above = T > sp_hi + (pem_range + hysteresis)
+    return np.where(kind == WATERHEATER, below, below | above)
+
+def exit_off_mask(kind, sp_hi, sp_lo, pem_range, T, hysteresis=0):
+    '''Vector form of check_stat("EXIT_OFF",hysteresis)'''
+    wh_exit = T > sp_hi + (pem_range + hysteresis)
+    in_hi = (sp_hi - (pem_range + hysteresis) < T) & (T < sp_hi + (pem_range + hysteresis))
+    in_lo = (sp_lo - (pem_range + hysteresis) < T) & (T < sp_lo + (pem_range + hysteresis))
+    hvac_exit = ~(in_hi | in_lo | exit_on_mask(kind, sp_hi, sp_lo, pem_range, T, hysteresis))
+    return np.where(kind == WATERHEATER, wh_exit, hvac_exit)
+
+class VectorEffects():
+    '''Effects of one VectorVirtualBattery step, kept as slot arrays and turned into TurnOn / TurnOff objects only when read'''
+    def __init__(self, vb, on_slots, off_slots, request_slots):
+        self.vb = vb
+        self.on_slots = on_slots
+        self.off_slots = off_slots
+        self.request_slots = request_slots
+
+    @property
+    def turn_on(self):
+        return [TurnOn(self.vb.record(i)) for i in self.on_slots]
+
+    @property
+    def turn_off(self):
+        return [TurnOff(self.vb.record(i)) for i in self.off_slots]
+
+    @property
+    def power_requests(self):
+        return [PowerRequest(self.vb.ids[i], kw, sec=CONTROL_EPOCH_SEC) for i, kw in zip(self.request_slots, self.vb.request_kw)]
+
+
+class DeviceView():
+    '''dict-like view of the devices of a VectorVirtualBattery (materializes vb_device records on access)'''
+    def __init__(self, vb):
+        self.vb = vb
+
+    def __len__(self):
+        return self.vb.n
+
+    def __contains__(self, device_id):
+        return device_id in self.vb.index
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __getitem__(self, device_id):
+        return self.vb.record(self.vb.index[device_id])
+
+    def get(self, device_id, default=None):
+        if device_id not in self.vb.index:
+            return default
+        return self[device_id]
+
+    def keys(self):
+        return list(self.vb.ids[:self.vb.n])
+
+    def values(self):
+        return [self.vb.record(i) for i in range(self.vb.n)]
+
+    def items(self):
+        return [(self.vb.ids[i], self.vb.record(i)) for i in range(self.vb.n)]
+
+    def pop(self, device_id, *default):
+        if (device_id not in self.vb.index) and default:
+            return default[0]
+        return self.vb.remove_device(device_id)
+
+
+class VectorVirtualBattery:
+    '''
+    Struct-of-arrays virtual battery with the same PEM semantics as packetized.virtual_battery.VirtualBattery.
+        PEM state, state_ends_at, last_power_draw_kw, kW and SoC of every device are NumPy arrays and the
+        PEM_OFF / PEM_ON / EXIT_ON / EXIT_OFF transitions of a step are computed as masked vector operations.
+        Device temperatures and loads are read from the shared DeviceSnapshot, so all devices must be attached to one.
+    '''
+    FIELDS = ('snap', 'kind', 'sp_hi', 'sp_lo', 'pem_range', 'state', 'ends', 'last_kw', 'kw', 'dev_soc', 'dev_soc_kwh')
+    DTYPES = {'snap': np.intp, 'kind': np.int8, 'state': np.int8}
+
+    def __init__(self, devices=None, setpoint=100, snapshot=None, seed=None, arbitration='random', arbitration_log=None):
+        self.snapshot = snapshot
+        self.requests = RequestGenerator(seed)
+        self.arbiter = Arbiter(arbitration, self.requests, arbitration_log)
+        self.ids = []
+        self.records = []
+        self.index = {}
+        self.n = 0
+        for field in self.FIELDS:
+            setattr(self, field, np.zeros(0, dtype=self.DTYPES.get(field, float)))
+        self.devices = DeviceView(self)
+        self.soc_by_kind = np.zeros(2) # soc [kWh] and load [kW] sums indexed by WATERHEATER / HVAC, as in VirtualBattery
+        self.kw_by_kind = np.zeros(2)
+        for device in (devices or []):
+            self.add_device(device)
+        self.setpoint = setpoint #kW
+        self.time_sec = 0
+
+    @property
+    def soc(self):
+        '''aggregate soc [kWh]'''
+        return float(np.sum(self.soc_by_kind))
+
+    @property
+    def total_kw(self):
+        '''aggregate load [kW] at the last update'''
+        return float(np.sum(self.kw_by_kind))
+
+    def measured_kw(self):
+        '''load [kW] at the last update of the devices still in the battery'''
+        return float(np.sum(self.kw[:self.n]))
+
+    def _reserve(self, n):
+        '''grows the arrays (by doubling) to hold at least n devices'''
+        capacity = len(self.kind)
+        if n <= capacity:
+            return
+        capacity = max(n, 2 * capacity, 16)
+        for field in self.FIELDS:
+            old = getattr(self, field)
+            new = np.zeros(capacity, dtype=old.dtype)
+            new[:len(old)] = old
+            setattr(self, field, new)
+
+    def add_device(self, device):
+        gld = device.gld_dev
+        if gld.snapshot is None:
+            raise ValueError('VectorVirtualBattery: device {} is not attached to a DeviceSnapshot'.format(device.device_id))
+        if self.snapshot is None:
+            self.snapshot = gld.snapshot
+        if device.device_id in self.index:
+            self.remove_device(device.device_id)
+        self._reserve(self.n + 1)
+        i = self.n
+        self.ids.append(device.device_id)
+        self.records.append(device)
+        self.index[device.device_id] = i
+        self.snap[i] = gld.slot
+        if hasattr(gld, 'setpoint_upp'):
+            self.kind[i] = HVAC
+            self.sp_hi[i], self.sp_lo[i] = gld.setpoint_upp, gld.setpoint_low
+        else:
+            self.kind[i] = WATERHEATER
+            self.sp_hi[i] = self.sp_lo[i] = gld.setpoint
+        self.pem_range[i] = gld.pem_range
+        self.state[i] = STATE_CODES.get(device.pem_state, PEM_OFF)
+        self.ends[i] = device.state_ends_at
+        self.last_kw[i] = device.last_power_draw_kw
+        self.kw[i] = device.kw
+        self.n += 1
+        self._refresh_soc(slice(i, i + 1))
+        self.soc_by_kind[self.kind[i]] += self.dev_soc_kwh[i]
+        self.kw_by_kind[self.kind[i]] += self.kw[i]
+
+    def remove_device(self, device_id):
+        '''removes a device (swapping the last slot into its place) and returns its up to date vb_device record'''
+        i = self.index.pop(device_id)
+        record = self.record(i)
+        self.soc_by_kind[self.kind[i]] -= self.dev_soc_kwh[i]
+        self.kw_by_kind[self.kind[i]] -= self.kw[i]
+        last = self.n - 1
+        if i != last:
+            for field in self.FIELDS:
+                array = getattr(self, field)
+                array[i] = array[last]
+            self.ids[i] = self.ids[last]
+            self.records[i] = self.records[last]
+            self.index[self.ids[i]] = i
+        self.ids.pop()
+        self.records.pop()
+        self.n = last
+        return record
+
+    def _compact(self, keep):
+        '''
+        drops the devices whose keep flag is False, keeping the order of the others (as the VirtualBattery device dict does)
+        returns the new slot of every old slot (-1 for dropped devices)
+        '''
+        n = self.n
+        for i in np.flatnonzero(~keep):
+            self.record(i)
+        for field in self.FIELDS:
+            array = getattr(self, field)
+            m = int(np.count_nonzero(keep))
+            array[:m] = array[:n][keep]
+        self.ids = [dev_id for dev_id, k in zip(self.ids, keep.tolist()) if k]
+        self.records = [record for record, k in zip(self.records, keep.tolist()) if k]
+        self.index = {dev_id: i for i, dev_id in enumerate(self.ids)}
+        self.n = len(self.ids)
+        return np.where(keep, np.cumsum(keep) - 1, -1)
+
+    def record(self, i):
+        '''syncs and returns the vb_device record held in slot i'''
+        device = self.records[i]
+        device.pem_state = STATES[int(self.state[i])]
+        device.state_ends_at = float(self.ends[i])
+        device.last_power_draw_kw = float(self.last_kw[i])
+        device.kw = float(self.kw[i])
+        device.gld_dev.update_from_gld()
+        return device
+
+    def device_updates(self):
+        '''the vector engine reads device state straight from the snapshot, no per-device updates are needed'''
+        return None
+
+    def _refresh_soc(self, s=slice(None)):
+        snapshot = self.snapshot
+        snap = self.snap[s]
+        T = snapshot.temperature[snap]
+        self.dev_soc[s] = vector_soc(self.kind[s], self.sp_hi[s], self.sp_lo[s], self.pem_range[s], T, snapshot.outdoor_temperature[snap])
+        coef = np.where(self.kind[s] == WATERHEATER, SOC_KWH_PER_DEGF[WATERHEATER], SOC_KWH_PER_DEGF[HVAC])
+        self.dev_soc_kwh[s] = coef * self.dev_soc[s] * (self.pem_range[s] * 2)
+
+    def next(self, setpoint=None, device_updates=None, time=None):
+        '''Iterate VB given a set of updated device states'''
+        if setpoint:
+            self.setpoint = setpoint
+        if time:
+            self.time_sec = time
+        self.apply_updates(device_updates)
+        effects, totalload = self.apply_pem_changes()
+        if len(effects.request_slots):
+            accepted, totalload = self.handle_power_requests(effects.request_slots)
+            effects.on_slots = np.concatenate([effects.on_slots, accepted])
+        self.arbiter.end_step(self.time_sec, self.setpoint, self.measured_kw())
+        return effects, totalload
+
+    def apply_updates(self, device_updates=None):
+        '''Refresh every device from the snapshot (and from explicit vb_device updates if any are given)'''
+        for next_state in (device_updates or []):
+            i = self.index.get(next_state.device_id, None)
+            if i is None:
+                continue
+            self.state[i] = STATE_CODES.get(next_state.pem_state, PEM_OFF)
+            self.ends[i] = next_state.state_ends_at
+        n = self.n
+        # vb_device.update(): the last positive load seen becomes the packet size
+        self.last_kw[:n] = np.where(self.kw[:n] > 0, self.kw[:n], self.last_kw[:n])
+        self.kw[:n] = self.snapshot.kw[self.snap[:n]]
+        self._refresh_soc(slice(0, n))
+        self.soc_by_kind = np.bincount(self.kind[:n], weights=self.dev_soc_kwh[:n], minlength=2)
+        self.kw_by_kind = np.bincount(self.kind[:n], weights=self.kw[:n], minlength=2)
+
+    def apply_pem_changes(self):
+        '''Do PEM logic for all devices in VB as masked vector operations'''
+        n = self.n
+        t = self.time_sec
+        kind, sp_hi, sp_lo, pr = self.kind[:n], self.sp_hi[:n], self.sp_lo[:n], self.pem_range[:n]
+        T = self.snapshot.temperature[self.snap[:n]]
+        state, ends, last_kw = self.state[:n], self.ends[:n], self.last_kw[:n]
+        old_state, old_ends, old_kw = state.copy(), ends.copy(), last_kw.copy()
+
+        exit_on0 = exit_on_mask(kind, sp_hi, sp_lo, pr, T)
+        exit_off0 = exit_off_mask(kind, sp_hi, sp_lo, pr, T)
+        exit_on2 = exit_on_mask(kind, sp_hi, sp_lo, pr, T, hysteresis=2)
+        exit_off2 = exit_off_mask(kind, sp_hi, sp_lo, pr, T, hysteresis=2)
+
+        held_on = (state == PEM_ON) & (t < ends)
+        expired = (((state == PEM_OFF) | (state == PEM_ON)) & (t >= ends)) \
+            | ((state == EXIT_OFF) & ~exit_off2) \
+            | ((state == EXIT_ON) & ~exit_on2)
+
+        # expired timers and devices leaving an exit band go back to PEM_OFF and roll for a power request
+        effect = np.zeros(n, dtype=np.int8)
+        effect[held_on] = TURN_ON
+        roll = self.request_rolls(T)
+        state[expired] = PEM_OFF
+        ends[expired] = t + COMM_EPOCH_SEC
+        last_kw[expired] = np.where(self.kw[:n][expired] > 0, self.kw[:n][expired], last_kw[expired])
+        effect[expired] = np.where(roll[expired], REQUEST, TURN_OFF)
+
+        # check_exits() overrides everything else
+        to_exit_on = exit_on0
+        to_exit_off = ~exit_on0 & exit_off0
+        state[to_exit_on] = EXIT_ON
+        effect[to_exit_on] = TURN_ON
+        state[to_exit_off] = EXIT_OFF
+        effect[to_exit_off] = TURN_OFF
+
+        # turn-on effects are accepted in device order until the load reaches the setpoint
+        on = effect == TURN_ON
+        on_kw = np.where(on, last_kw, 0.0)
+        accepted = on & ((np.cumsum(on_kw) - on_kw) < round(self.setpoint))
+        rejected = on & ~accepted
+        state[rejected] = PEM_OFF
+        ends[rejected] = old_ends[rejected]
+        effect[rejected] = TURN_OFF
+        totalload = float(np.sum(on_kw[accepted]))
+        # every device that changed state went through vb_device.update(), which takes its current load as packet size
+        changed = expired | to_exit_on | to_exit_off | rejected
+        last_kw[changed] = np.where(self.kw[:n][changed] > 0, self.kw[:n][changed], last_kw[changed])
+
+        # a PEM_OFF device requests its packet size from before this step's update, the others after it (as in vb_device.pem_off)
+        request_slots = np.flatnonzero(effect == REQUEST)
+        self.request_kw = np.where(old_state[request_slots] == PEM_OFF, old_kw[request_slots], last_kw[request_slots])
+        on_slots = np.flatnonzero(effect == TURN_ON)
+        off_slots = np.flatnonzero(effect == TURN_OFF)
+
+        # like VirtualBattery.apply_pem_changes, a device without an effect this step leaves the battery
+        keep = effect != NO_EFFECT
+        if not keep.all():
+            new_slot = self._compact(keep)
+            request_slots, on_slots, off_slots = new_slot[request_slots], new_slot[on_slots], new_slot[off_slots]
+
+        effects = VectorEffects(self, on_slots=on_slots, off_slots=off_slots, request_slots=request_slots)
+        return effects, totalload
+
+    def request_rolls(self, T):
+        '''
+        REQ_die_roll of the devices that reach pem_off's check this step (timer ended or EXIT state),
+        rolled once per REQUEST band the device is in; the other devices are False without a draw
+        '''
+        n = self.n
+        state = self.state[:n]
+        eligible = (state == EXIT_OFF) | (state == EXIT_ON) | (self.time_sec >= self.ends[:n])
+        return self.requests.roll(self.kind[:n], self.sp_hi[:n], self.sp_lo[:n], self.pem_range[:n], T, self.dev_soc[:n], eligible)
+
+    def handle_power_requests(self, request_slots):
+        '''Respond to power requests (in the order of the arbitration policy), returns the accepted slots and the new total kW'''
+        totalkw = self.measured_kw()
+        accept, totalkw = self.arbiter.arbitrate(self.request_kw, self.dev_soc[request_slots], self.setpoint, totalkw)
+        accepted = request_slots[accept]
+        self.state[accepted] = PEM_ON
+        self.ends[accepted] = self.time_sec + CONTROL_EPOCH_SEC
+        return accepted, totalkw
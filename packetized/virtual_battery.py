@@ -1,5 +1,6 @@
 from enum import Enum
 from copy import deepcopy
+import math
 import numpy as np
 from random import (
     random as r_random,
@@ -10,19 +11,230 @@ from random import (
 prints = False
 
 from packetized.vb_device import *
+from packetized.request_generator import RequestGenerator
+from packetized.device_snapshot import WATERHEATER, HVAC
+from packetized.arbitration import Arbiter
+from packetized.vector_battery import exit_on_mask, exit_off_mask, vector_soc, STATE_CODES, PEM_OFF, PEM_ON, EXIT_OFF, EXIT_ON
 
-class VirtualBattery:
-    def __init__(self, devices=None, setpoint=100):
-        if devices:
-            self.devices = {device.device_id: device for device in devices}
+class DeviceArrays:
+    '''
+    Arrays of the devices of one virtual battery by row, in the order of the battery's device dict (a removed device's
+    row is dropped by the next compact(), keeping the order of the others, so the request rolls are drawn in device
+    order as before): snapshot slot, kind, setpoints and pem_range (set when the device is added), PEM state code and state_ends_at
+    (set by update() whenever the battery changes the device record). The request rolls and exit bands of a step are
+    vector operations over these rows and the snapshot temperatures; devices without a DeviceSnapshot read their
+    temperature and soc from the gld device.
+    '''
+    FIELDS = ('slot', 'kind', 'sp_hi', 'sp_lo', 'pem_range', 'state', 'ends', 'live')
+
+    def __init__(self):
+        self.snapshot = None
+        self.ids = [] # device_id of each row
+        self.glds = [] # gld device of each row
+        self.row = {}
+        self.slot = np.zeros(0, dtype=np.int64)
+        self.kind = np.zeros(0, dtype=np.int8)
+        self.sp_hi = np.zeros(0)
+        self.sp_lo = np.zeros(0)
+        self.pem_range = np.zeros(0)
+        self.state = np.zeros(0, dtype=np.int8)
+        self.ends = np.zeros(0)
+        self.live = np.zeros(0, dtype=bool)
+        self.removed = 0 # rows of removed devices, dropped by compact()
+
+    def add(self, device):
+        '''stores the thresholds and PEM state of a device record (replacing those it had)'''
+        gld = device.gld_dev
+        if not self.row:
+            self.snapshot = gld.snapshot
+        elif gld.snapshot is not self.snapshot:
+            raise ValueError('VirtualBattery: device {} is not attached to the DeviceSnapshot of the other devices'.format(gld.id))
+        k = self.row.get(gld.id)
+        if k is None:
+            k = len(self.ids)
+            if k == len(self.slot):
+                for field in self.FIELDS:
+                    old = getattr(self, field)
+                    new = np.zeros(max(2 * k, 16), dtype=old.dtype)
+                    new[:k] = old
+                    setattr(self, field, new)
+            self.row[gld.id] = k
+            self.ids.append(gld.id)
+            self.glds.append(gld)
+            self.live[k] = True
+        self.glds[k] = gld
+        self.slot[k] = gld.slot if gld.slot is not None else -1
+        if hasattr(gld, 'setpoint_upp'):
+            self.kind[k] = HVAC
+            self.sp_hi[k], self.sp_lo[k] = gld.setpoint_upp, gld.setpoint_low
         else:
-            self.devices = {}
+            self.kind[k] = WATERHEATER
+            self.sp_hi[k] = self.sp_lo[k] = gld.setpoint
+        self.pem_range[k] = gld.pem_range
+        self.update(device)
+
+    def update(self, device):
+        '''stores the pem_state and state_ends_at of a device record'''
+        k = self.row[device.device_id]
+        self.state[k] = STATE_CODES[device.pem_state]
+        self.ends[k] = device.state_ends_at
+
+    def remove(self, device_id):
+        '''marks the row of a device as removed (no-op if it has none)'''
+        k = self.row.pop(device_id, None)
+        if k is None:
+            return
+        self.live[k] = False
+        self.glds[k] = None
+        self.removed += 1
+
+    def compact(self):
+        '''drops the rows of removed devices, keeping the order of the others'''
+        if not self.removed:
+            return
+        n = len(self.ids)
+        keep = self.live[:n].copy()
+        m = int(np.count_nonzero(keep))
+        for field in self.FIELDS:
+            array = getattr(self, field)
+            array[:m] = array[:n][keep]
+        first = int(np.argmin(keep)) # rows before the first removed one keep their place
+        kept = np.flatnonzero(keep[first:]).tolist()
+        self.ids[first:] = [self.ids[first + k] for k in kept]
+        self.glds[first:] = [self.glds[first + k] for k in kept]
+        for k in range(first, m):
+            self.row[self.ids[k]] = k
+        self.removed = 0
+
+    def _glds(self, rows):
+        return self.glds if rows is None else [self.glds[k] for k in rows.tolist()]
+
+    def temperature(self, rows=None):
+        '''temperature of the devices of the given rows (all by default)'''
+        self.compact()
+        if self.snapshot is None:
+            return np.array([gld.temperature for gld in self._glds(rows)], dtype=float)
+        rows = slice(0, len(self.ids)) if rows is None else rows
+        return self.snapshot.temperature[self.slot[rows]]
+
+    def soc(self, T, rows=None):
+        '''soc of the devices of the given rows at their temperature T'''
+        if self.snapshot is None:
+            return np.array([gld.soc for gld in self._glds(rows)], dtype=float)
+        rows = slice(0, len(self.ids)) if rows is None else rows
+        outsideT = self.snapshot.outdoor_temperature[self.slot[rows]]
+        return vector_soc(self.kind[rows], self.sp_hi[rows], self.sp_lo[rows], self.pem_range[rows], T, outsideT)
+
+    def roll(self, generator, time_sec):
+        '''
+        draws this step's request decisions with the RequestGenerator for the eligible rows only and attaches them
+        to their gld devices: a device reads its decision only when its pem() reaches pem_off's check this step
+        (timer ended, or an EXIT state which may fall back to PEM_OFF)
+        '''
+        self.compact()
+        n = len(self.ids)
+        state = self.state[:n]
+        rows = np.flatnonzero((state == EXIT_OFF) | (state == EXIT_ON) | (time_sec >= self.ends[:n]))
+        T = self.temperature(rows)
+        rolls = generator.roll(self.kind[rows], self.sp_hi[rows], self.sp_lo[rows], self.pem_range[rows], T, self.soc(T, rows))
+        for k, decision in zip(rows.tolist(), rolls.tolist()):
+            self.glds[k].request_roll = decision
+
+    def schedule(self, time_sec):
+        '''
+        device_ids of a scheduled step in device order, from the state, timer and exit band of every row:
+            active : devices whose pem() must run or whose TurnOn takes part in the acceptance, with a held flag
+                     for the PEM_ON ones whose timer runs outside an exit band (pem() would only repeat their TurnOn)
+            idle   : PEM_OFF devices whose timer runs outside an exit band (pem() would have no effect)
+        '''
+        self.compact()
+        n = len(self.ids)
+        args = (self.kind[:n], self.sp_hi[:n], self.sp_lo[:n], self.pem_range[:n], self.temperature())
+        hold = (time_sec < self.ends[:n]) & ~(exit_on_mask(*args) | exit_off_mask(*args))
+        state = self.state[:n]
+        idle = hold & (state == PEM_OFF)
+        active = np.flatnonzero(~idle)
+        ids = self.ids
+        held = (hold & (state == PEM_ON))[active].tolist()
+        return [ids[k] for k in active.tolist()], held, [ids[k] for k in np.flatnonzero(idle).tolist()]
+
+class VirtualBattery:
+    '''
+    soc_by_kind, kw_by_kind : running sums of the device soc [kWh] and load [kW] indexed by WATERHEATER / HVAC,
+        updated when a device is added, removed or updated (apply_updates) instead of re-reading every device.
+        Devices that leave the battery in apply_pem_changes stay in the sums until the next apply_updates,
+        so soc covers the devices the step started with.
+    scheduled=True : apply_pem_changes only visits, in device order, the devices whose timer ended, in an EXIT state,
+        in an exit band or in PEM_ON (their TurnOn takes part in the in-order acceptance, a held one repeats it
+        without a pem() call), found by DeviceArrays.schedule() with vector tests over the battery's rows.
+        The idle PEM_OFF devices would have no effect and leave the battery without a visit, so the python work
+        of a step follows the active devices and the devices that leave, not the size of the battery.
+    visited, evaluated : devices visited and pem() calls of the last step
+    '''
+    def __init__(self, devices=None, setpoint=100, seed=None, arbitration='random', arbitration_log=None, scheduled=False):
+        self.devices = {}
+        self.totals = {} # device_id : (kind, soc kWh, kW) included in the sums
+        self.dropped = [] # devices that left the battery in the last apply_pem_changes
+        self.soc_by_kind = np.zeros(2)
+        self.kw_by_kind = np.zeros(2)
+        self.scheduled = scheduled
+        self.arrays = DeviceArrays()
+        self.visited = 0
+        self.evaluated = 0
+        for device in (devices or []):
+            self.add_device(device)
         self.setpoint = setpoint #kW
         self.time_sec = 0
-        self.soc = np.sum([d.gld_dev.soc_kWh() for d in self.devices.values()])
+        self.requests = RequestGenerator(seed)
+        self.arbiter = Arbiter(arbitration, self.requests, arbitration_log)
+
+    @property
+    def soc(self):
+        '''aggregate soc [kWh]'''
+        return float(np.sum(self.soc_by_kind))
+
+    @property
+    def total_kw(self):
+        '''aggregate load [kW] at the last update'''
+        return float(np.sum(self.kw_by_kind))
+
+    def measured_kw(self):
+        '''load [kW] at the last update of the devices still in the battery (less those that left it this step)'''
+        return self.total_kw - math.fsum(self.totals[device_id][2] for device_id in self.dropped if device_id in self.totals)
+
+    def _track(self, device, update=True):
+        '''puts the soc and load of a device record in the running sums (replacing its previous values)'''
+        self._untrack(device.device_id)
+        gld = device.gld_dev
+        kind = HVAC if hasattr(gld, 'setpoint_upp') else WATERHEATER
+        soc_kwh = gld.soc_kWh(update=update)
+        self.totals[device.device_id] = (kind, soc_kwh, device.kw)
+        self.soc_by_kind[kind] += soc_kwh
+        self.kw_by_kind[kind] += device.kw
+
+    def _untrack(self, device_id):
+        total = self.totals.pop(device_id, None)
+        if total:
+            kind, soc_kwh, kw = total
+            self.soc_by_kind[kind] -= soc_kwh
+            self.kw_by_kind[kind] -= kw
 
     def add_device(self, device):
+        '''adds a device record, its soc and load are added to the VB sums'''
+        self.arrays.add(device)
         self.devices[device.device_id] = device
+        self._track(device)
+
+    def remove_device(self, device_id):
+        '''removes a device, its soc and load are taken off the VB sums, returns its vb_device record'''
+        device = self.devices.pop(device_id)
+        self._untrack(device_id)
+        self.arrays.remove(device_id)
+        return device
+
+    def device_updates(self):
+        '''Updated state of each device, to pass to next()'''
+        return [d.refresh() for d in self.devices.values()]
 
     def next(self, setpoint=None, device_updates=None, time=None):
         '''Iterate VB given a set of updated device states'''
@@ -33,21 +245,29 @@ class VirtualBattery:
         if time:
             self.time_sec = time
         self.apply_updates(device_updates)
+        self.arrays.roll(self.requests, self.time_sec)
         effects, totalload = self.apply_pem_changes()
         if effects.power_requests:
             additional_turn_on_effects, totalload = self.handle_power_requests(effects.power_requests)
             effects.append(*additional_turn_on_effects)
+        self.arbiter.end_step(self.time_sec, self.setpoint, self.measured_kw())
         return effects, totalload
 
 
     def apply_updates(self, device_updates):
-        '''Update each device in the virtual battery with new state'''
+        '''Update each device in the virtual battery with new state (already read from gld by refresh())'''
+        for device_id in self.dropped:
+            if device_id not in self.devices:
+                self._untrack(device_id)
+        self.dropped = []
         for next_state in device_updates:
             device = self.devices.get(next_state.device_id, None)
             if not device:
                 continue
             self.devices[device.device_id] = next_state
-        self.soc = np.sum([d.gld_dev.soc_kWh() for d in self.devices.values()])
+            self._track(next_state, update=False)
+            if next_state is not device:
+                self.arrays.update(next_state)
 
     def apply_pem_changes(self):
         '''Do PEM logic for each device in VB'''
@@ -61,8 +281,24 @@ class VirtualBattery:
             print("Total number of pem_off devices = {:.0f} ; avg SOC = {:.02f}".format(len([device for device in self.devices.values() if device.pem_state == PEM_STATE.PEM_OFF]),np.mean([device.gld_dev.soc for device in self.devices.values() if device.pem_state == PEM_STATE.PEM_OFF])))
             print("Total number of on hvac devices = {} out of {} ; avg SOC = {:.02f}".format(len([device for device in self.devices.values() if (((device.pem_state == PEM_STATE.PEM_ON) or (device.pem_state == PEM_STATE.EXIT_ON)) and ('house' in device.device_id))]),len([device for device in self.devices.values() if ('house' in device.device_id)]),np.mean([device.gld_dev.soc for device in self.devices.values() if (((device.pem_state == PEM_STATE.PEM_ON) or (device.pem_state == PEM_STATE.EXIT_ON)) and ('house' in device.device_id))])))
             print("Total number of pem off hvac devices = {} out of {} ; avg SOC = {:.02f}".format(len([device for device in self.devices.values() if ((device.pem_state == PEM_STATE.PEM_OFF) and ('house' in device.device_id))]),len([device for device in self.devices.values() if ('house' in device.device_id)]),np.mean([device.gld_dev.soc for device in self.devices.values() if ((device.pem_state == PEM_STATE.PEM_OFF) and ('house' in device.device_id))])))
-        for device in list(self.devices.values()):
-            newdevice, effect = device.pem(self.time_sec)
+        if self.scheduled:
+            # the battery's dict is updated in place, which keeps the device order of the devices that stay
+            visits, held, idle = self.arrays.schedule(self.time_sec)
+            devices = self.devices
+        else:
+            visits, held, idle = list(self.devices), [False] * len(self.devices), ()
+        self.visited = len(visits)
+        self.evaluated = 0
+        changed = [] # devices whose pem_state or state_ends_at may have changed, for DeviceArrays
+        for device_id, hold in zip(visits, held):
+            device = self.devices[device_id]
+            state_ends_at = device.state_ends_at # in place records are changed by pem(), keep what a rejected turn on reverts to
+            if hold:
+                newdevice, effect = device, TurnOn(device)
+            else:
+                newdevice, effect = device.pem(self.time_sec)
+                self.evaluated += 1
+                changed.append(device_id)
             if effect:
                 if effect.on:
                     if totalload < round(self.setpoint):
@@ -71,35 +307,45 @@ class VirtualBattery:
                         effects.append(effect)
                     else:
                         devices[device.device_id] = device.update(pem_state=PEM_STATE.PEM_OFF)
+                        devices[device.device_id].state_ends_at = state_ends_at
                         effects.append(TurnOff(device))
+                        changed.append(device_id)
                 else:
                     effects.append(effect)
                     devices[device.device_id] = newdevice
+            else:
+                self.dropped.append(device.device_id)
+                self.arrays.remove(device_id)
+                if self.scheduled:
+                    devices.pop(device_id)
+        for device_id in idle:
+            self.dropped.append(device_id)
+            self.arrays.remove(device_id)
+            devices.pop(device_id)
         self.devices = devices
+        for device_id in changed:
+            if device_id in devices:
+                self.arrays.update(devices[device_id])
 
         return effects, totalload
 
     def handle_power_requests(self, power_requests):
-        '''Respond to power requests'''
-        r_shuffle(power_requests) # shuffle power requests to simulate having received them one at a time
-        totalkw = sum(map(lambda d: d.kw, self.devices.values()))
-        accepted_requests = []
+        '''Respond to power requests, in the order of the arbitration policy'''
+        power_requests = [power_request for power_request in power_requests if power_request.device_id in self.devices]
+        totalkw = self.measured_kw()
         if prints:
             print('there are {} power requests; starting load = {}'.format(len(power_requests),totalkw))
-        for power_request in power_requests:
-            if abs(totalkw + power_request.kw - self.setpoint) <= abs(totalkw - self.setpoint):
-                device = self.devices.get(power_request.device_id, None)
-                if not device:
-                    continue
-                device, request_accepted = self.devices[power_request.device_id].request_accepted(self.time_sec)
-                self.devices[device.device_id] = device
-                if request_accepted:
-                    #print('\r  power req accepted',totalkw,end='')
-                    totalkw += power_request.kw
-                    accepted_requests.append(request_accepted)
+        accept, totalkw = self.arbiter.arbitrate([power_request.kw for power_request in power_requests],
+                                                 [self.devices[power_request.device_id].gld_dev.soc for power_request in power_requests],
+                                                 self.setpoint, totalkw)
+        accepted_requests = []
+        for k in accept.tolist():
+            device, request_accepted = self.devices[power_requests[k].device_id].request_accepted(self.time_sec)
+            self.devices[device.device_id] = device
+            self.arrays.update(device)
+            accepted_requests.append(request_accepted)
         if prints:
             print('VB setpoint:',round(self.setpoint,2))
             print("Total kw for all device effects = {:.02f}".format(totalkw))
             print('accepted requests:',len(accepted_requests))
-            print(abs(totalkw + power_request.kw - self.setpoint),'<=',abs(totalkw - self.setpoint))
         return accepted_requests, totalkw
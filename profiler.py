@@ -0,0 +1,135 @@
+'''
+PhaseProfiler times the phases of each on_commit (the functions decorated with profiler.phase(name), times include
+the phases they call) and counts the Julia requests and bytes of the commit, one row per commit is streamed
+to a csv file and report() gives the p50 / p95 / max of every phase at the end of the run
+	disabled (the default) a decorated function costs one attribute test per call
+'''
+import csv
+import functools
+import os
+import time
+
+import numpy as np
+
+RPC_COUNTERS = ['requests','bytes_sent','bytes_received'] # JuliaClient counters, written as rpc_<counter>
+
+class PhaseProfiler:
+	'''
+	enabled		: phases are timed (start() enables the profiler)
+	filename	: per-commit csv, columns t, on_commit_ms, <phase>_ms and <phase>_n (calls) for every phase, rpc_<counter>
+	client		: JuliaClient whose RPC counters are recorded (None: no RPC columns)
+	'''
+	def __init__(self):
+		self.enabled = False
+		self.filename = None
+		self.client = None
+		self.phases = [] # phase names in decoration order
+		self.samples = {} # phase : per-commit times [s] of the commits that ran it
+		self.calls = {}
+		self._file = None
+		self._writer = None
+		self._row = None
+		self._rpc = None
+
+	def phase(self,name):
+		'''
+		decorator timing every call of the function as phase name
+		'''
+		if name not in self.phases:
+			self.phases.append(name)
+		def decorator(function):
+			@functools.wraps(function)
+			def timed(*args,**kwargs):
+				if (not self.enabled) or (self._row is None):
+					return function(*args,**kwargs)
+				start = time.perf_counter()
+				try:
+					return function(*args,**kwargs)
+				finally:
+					elapsed = time.perf_counter()-start
+					self._row[name][0] += elapsed
+					self._row[name][1] += 1
+			return timed
+		return decorator
+
+	def commit(self,function):
+		'''
+		decorator of on_commit(t), each call is one row of the csv file
+		'''
+		@functools.wraps(function)
+		def timed(t,*args,**kwargs):
+			if not self.enabled:
+				return function(t,*args,**kwargs)
+			self._row = {name:[0.0,0] for name in self.phases}
+			self._rpc = self._rpc_counters()
+			start = time.perf_counter()
+			try:
+				return function(t,*args,**kwargs)
+			finally:
+				self._write(t,time.perf_counter()-start)
+		return timed
+
+	def start(self,filename='phase_profile.csv',client=None):
+		'''
+		enables the profiler and starts a new csv file
+		'''
+		self.filename = filename
+		self.client = client
+		self.samples = {name:[] for name in ['on_commit']+self.phases}
+		self.calls = {name:0 for name in ['on_commit']+self.phases}
+		if os.path.exists(filename):
+			os.remove(filename)
+		self._file = open(filename,mode='w',newline='')
+		self._writer = csv.writer(self._file)
+		header = ['t','on_commit_ms']
+		for name in self.phases:
+			header += ['{}_ms'.format(name),'{}_n'.format(name)]
+		if client is not None:
+			header += ['rpc_{}'.format(counter) for counter in RPC_COUNTERS]
+		self._writer.writerow(header)
+		self.enabled = True
+		return self
+
+	def _rpc_counters(self):
+		if self.client is None:
+			return None
+		return [getattr(self.client,counter,0) for counter in RPC_COUNTERS]
+
+	def _write(self,t,elapsed):
+		row = [t,round(elapsed*1000,3)]
+		self.samples['on_commit'].append(elapsed)
+		self.calls['on_commit'] += 1
+		for name in self.phases:
+			seconds,calls = self._row[name]
+			row += [round(seconds*1000,3),calls]
+			if calls:
+				self.samples[name].append(seconds)
+				self.calls[name] += calls
+		if self._rpc is not None:
+			row += [now-before for now,before in zip(self._rpc_counters(),self._rpc)]
+		self._writer.writerow(row)
+		self._row = None
+
+	def close(self):
+		'''
+		closes the csv file, the profiler is disabled
+		'''
+		self.enabled = False
+		if self._file is not None:
+			self._file.close()
+			self._file = None
+
+	def report(self):
+		'''
+		returns the summary table lines: commits that ran each phase, calls, p50 / p95 / max per commit [ms] and total [s]
+		'''
+		lines = ['{:<26}{:>8}{:>8}{:>10}{:>10}{:>10}{:>10}'.format('phase','commits','calls','p50 ms','p95 ms','max ms','total s')]
+		for name in ['on_commit']+self.phases:
+			samples = np.array(self.samples.get(name,[]))
+			if not len(samples):
+				continue
+			p50,p95 = np.percentile(samples,[50,95])*1000
+			lines.append('{:<26}{:>8}{:>8}{:>10.2f}{:>10.2f}{:>10.2f}{:>10.2f}'.format(name,len(samples),self.calls[name],p50,p95,samples.max()*1000,samples.sum()))
+		return lines
+
+profiler = PhaseProfiler()
@@ -0,0 +1,113 @@
+'''
+Memoization of Julia optimization results.
+    ResultCache is a bounded LRU map {payload key : raw response} that can be saved to / loaded from a pickle file
+    so the results of one run are reused by the next ones.
+    payload_key() is the canonical hash of a payload dict: every column is hashed as the array julia_payload sends
+    (so [1,2] and np.array([1,2]) give the same key) and the columns listed in quanta are rounded to multiples of
+    their quantum first, so payloads that only differ by small load fluctuations share a key.
+The islanding results cache is enabled in the GLM with `global char1024 ISLANDING_CACHE islanding_cache.pkl;`.
+'''
+from collections import OrderedDict
+import hashlib
+import os
+import pickle
+import numpy as np
+
+from julia_payload import is_column, column_array
+
+# fields added by julia_client to every request, they don't change the result
+REQUEST_FIELDS = ('message', 'at', 'request_id')
+
+def payload_key(payload, quanta=None):
+    '''
+    returns the hex sha256 of the payload, with the columns in quanta {column : quantum} rounded to multiples of the quantum
+    '''
+    quanta = quanta or {}
+    digest = hashlib.sha256()
+    for name, quantum in sorted(quanta.items()):
+        digest.update('{}~{!r};'.format(name, float(quantum)).encode('utf-8'))
+    for key in sorted(payload):
+        if key in REQUEST_FIELDS:
+            continue
+        value = payload[key]
+        digest.update(key.encode('utf-8') + b'\0')
+        if is_column(value):
+            if (key in quanta) and len(value):
+                value = np.round(np.asarray(value, dtype=float) / quanta[key]).astype(np.int64)
+            dtype, data = column_array(value)
+            digest.update('{}:{}:'.format(dtype, len(value)).encode('utf-8'))
+            digest.update(data if isinstance(data, bytes) else data.tobytes())
+        else:
+            digest.update(repr(value).encode('utf-8'))
+        digest.update(b'\0')
+    return digest.hexdigest()
+
+class ResultCache:
+    '''
+    LRU cache of optimization results.
+        max_entries : entries kept, the least recently used one is evicted when a new result doesn't fit
+        quanta      : {column : quantum} rounding applied by key()
+        hits / misses / evictions count the lookups and evictions since the cache was created
+    '''
+    def __init__(self, max_entries=128, quanta=None):
+        self.max_entries = max_entries
+        self.quanta = dict(quanta or {})
+        self._entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def key(self, payload):
+        return payload_key(payload, self.quanta)
+
+    def get(self, key, default=None):
+        '''returns the result of key and marks it as most recently used, default (a miss) if it isn't cached'''
+        if key not in self._entries:
+            self.misses += 1
+            return default
+        self.hits += 1
+        self._entries.move_to_end(key)
+        return self._entries[key]
+
+    def put(self, key, result):
+        self._entries[key] = result
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def clear(self):
+        self._entries.clear()
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {'entries': len(self._entries),
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'hit_rate': self.hits / lookups if lookups else 0.0}
+
+    def save(self, filename):
+        '''writes the entries, least recently used first, to a pickle file (atomically replaced)'''
+        tmpname = '{}.tmp'.format(filename)
+        with open(tmpname, 'wb') as file:
+            pickle.dump({'version': 1, 'entries': list(self._entries.items())}, file, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmpname, filename)
+
+    def load(self, filename):
+        '''adds the entries of a pickle file written by save(), returns the number of entries read (0 if there is no file)'''
+        if not os.path.exists(filename):
+            return 0
+        with open(filename, 'rb') as file:
+            data = pickle.load(file)
+        if not (isinstance(data, dict) and data.get('version') == 1):
+            raise ValueError("ResultCache: '{}' is not a result cache file".format(filename))
+        for key, result in data['entries']:
+            self.put(key, result)
+        return len(data['entries'])
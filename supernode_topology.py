@@ -0,0 +1,207 @@
+'''
+SupernodeTopology caches the static supernode structure of the GridLAB-D model (supernode list, ids, swing bus,
+branch endpoints and the devices connected to each supernode) so timestep and fault handlers don't re-query GLD for it
+'''
+import re
+import numpy as np
+
+BRANCHKIND = {'switch':'switch',
+			  'overhead_line':'fixed',
+			  'underground_line':'fixed'}
+
+DEVICE_CLASSES = {'houses':'house',
+				  'waterheaters':'waterheater',
+				  'meters':'triplex_meter',
+				  'inverters':'inverter',
+				  'solar':'solar',
+				  'batteries':'battery'}
+
+def parse_node_group(nodestr):
+	'''
+	parses the supernode_list node_group string "['supernode_001', 'supernode_002', ...]" into a list of supernode names
+	'''
+	nodestr = nodestr.replace("'",'').replace('"','').replace(" ","").strip('[]')
+	return [sn for sn in nodestr.split(',') if sn]
+
+def node_id(name):
+	'''
+	returns the integer id in a node name (supernode_101 -> 101)
+	'''
+	return int(re.search(r'\d+',name).group())
+
+def connected_components(f,t,nodes=()):
+	'''
+	vectorized union-find over the branches f[k]--t[k] (integer node ids), nodes lists extra (possibly isolated) nodes
+	hooks the larger root of every branch onto the smaller one and compresses paths until every branch joins one root
+	returns the list of components, each a sorted list of node ids, ordered by their smallest node
+	'''
+	f = np.asarray(f,dtype=np.int64)
+	t = np.asarray(t,dtype=np.int64)
+	ids = np.unique(np.concatenate([f,t,np.asarray(list(nodes),dtype=np.int64)]))
+	if len(ids) == 0:
+		return []
+	fi = np.searchsorted(ids,f)
+	ti = np.searchsorted(ids,t)
+	root = np.arange(len(ids))
+	while True:
+		rf = root[fi]
+		rt = root[ti]
+		if np.array_equal(rf,rt):
+			break
+		np.minimum.at(root,np.maximum(rf,rt),np.minimum(rf,rt))
+		while True:
+			compressed = root[root]
+			if np.array_equal(compressed,root):
+				break
+			root = compressed
+	order = np.argsort(root,kind='stable')
+	labels,starts = np.unique(root[order],return_index=True)
+	return [ids[group].tolist() for group in np.split(order,starts[1:])]
+
+class SupernodeTopology:
+	'''
+	cached supernode topology of the GLD model:
+		supernodes : list of supernode names (from supernode_list.node_group)
+		ids        : {supernode name : integer id}
+		names      : {integer id : supernode name}
+		swing      : name of the SWING supernode (swing_id is its integer id)
+		branches   : {branch name : {'from','to','f','t','kind'}} static endpoints of switches and lines ('f'/'t' are integer ids)
+		downstream : {node name : [branches leaving the node]} directed adjacency of the branches
+		incident   : {node name : [branches from or to the node]}
+		closed     : {branch name : True if CLOSED} cached branch status, kept current by toggle() when switches are toggled
+		device_map : {supernode name : {'houses','waterheaters','meters','inverters','solar','batteries' : set of object names}}
+		inverter_node : {inverter name : integer id of the supernode in its name} (node_inverters is the reverse map)
+	refresh hooks rebuild each part if the model changes: refresh_supernodes(), refresh_branches(), refresh_devices() or refresh() for all
+	'''
+	def __init__(self,gridlabd,catalog,node_list="supernode_list"):
+		self.gld = gridlabd
+		self.catalog = catalog
+		self.node_list = node_list
+		self.supernodes = []
+		self.ids = {}
+		self.names = {}
+		self.swing = None
+		self.swing_id = None
+		self.branches = {}
+		self.downstream = {}
+		self.incident = {}
+		self.closed = {}
+		self.device_map = {}
+		self.inverter_node = {}
+		self.node_inverters = {}
+
+	def build(self):
+		'''
+		builds all cached structures
+		'''
+		self.refresh()
+		return self
+
+	def refresh(self):
+		self.refresh_supernodes()
+		self.refresh_branches()
+		self.refresh_devices()
+
+	def refresh_supernodes(self):
+		'''
+		re-reads the supernode list, supernode ids and the swing bus
+		'''
+		self.supernodes = parse_node_group(self.gld.get_value(self.node_list,"node_group"))
+		self.ids = {sn:node_id(sn) for sn in self.supernodes}
+		self.names = {self.ids[sn]:sn for sn in self.supernodes}
+		swing = [sn for sn in self.supernodes if self.gld.get_value(sn,'bustype')=='SWING']
+		self.swing = swing[0] if swing else None
+		self.swing_id = self.ids[self.swing] if self.swing else None
+
+	def refresh_branches(self):
+		'''
+		re-reads the from/to endpoints of all switches and lines, rebuilds their adjacency and reads their status
+		'''
+		self.branches = {}
+		self.downstream = {}
+		self.incident = {}
+		for cl in BRANCHKIND:
+			for br in self.catalog.find('class',cl):
+				fnode = self.gld.get_value(br,'from')
+				tnode = self.gld.get_value(br,'to')
+				self.branches[br] = {'from':fnode,
+									 'to':tnode,
+									 'f':node_id(fnode),
+									 't':node_id(tnode),
+									 'kind':BRANCHKIND[cl]}
+				self.downstream.setdefault(fnode,[]).append(br)
+				self.incident.setdefault(fnode,[]).append(br)
+				if tnode != fnode:
+					self.incident.setdefault(tnode,[]).append(br)
+		self.closed = {}
+		self.refresh_status()
+
+	def refresh_status(self,kind=None):
+		'''
+		re-reads the OPEN/CLOSED status of all branches, or only of the branches of the given kind (e.g. 'switch')
+		'''
+		for br,branch in self.branches.items():
+			if (kind is None) or (branch['kind'] == kind):
+				self.closed[br] = self.gld.get_value(br,'status')=='CLOSED'
+
+	def toggle(self,switches):
+		'''
+		records that the given switches were toggled (OPEN -> CLOSED & CLOSED -> OPEN)
+		'''
+		for br in switches:
+			if br in self.closed:
+				self.closed[br] = not self.closed[br]
+
+	def downstream_nodes(self,node):
+		'''
+		returns node and every node reachable from it through closed branches in the from -> to direction (breadth first)
+		'''
+		seen = {node}
+		result = [node]
+		k = 0
+		while k < len(result):
+			for br in self.downstream.get(result[k],[]):
+				tnode = self.branches[br]['to']
+				if self.closed[br] and tnode not in seen:
+					seen.add(tnode)
+					result.append(tnode)
+			k += 1
+		return result
+
+	def refresh_devices(self):
+		'''
+		re-collects the sets of devices connected to each supernode
+		'''
+		self.device_map = {sn:{key:set() for key in DEVICE_CLASSES} for sn in self.supernodes}
+		for sn in self.supernodes:
+			for key,cl in DEVICE_CLASSES.items():
+				self.device_map[sn][key].update(self.catalog.members(cl,'supernode_name',sn))
+		self.inverter_node = {}
+		self.node_inverters = {}
+		for inv in self.catalog.find('class','inverter'):
+			if re.search(r'\d+',inv):
+				self.inverter_node[inv] = node_id(inv)
+				self.node_inverters.setdefault(self.inverter_node[inv],[]).append(inv)
+
+	def inverters(self,nodes):
+		'''
+		returns the inverters whose name refers to one of the given integer supernode ids
+		'''
+		return [inv for n in nodes for inv in self.node_inverters.get(n,[])]
+
+	def name(self,sn_id):
+		'''
+		returns the supernode name for an integer supernode id
+		'''
+		return self.names.get(sn_id,"supernode_{:03d}".format(sn_id))
+
+	def devices(self,nodes,key):
+		'''
+		returns the union of device set key (e.g. 'houses') over the given supernode names or ids
+		'''
+		result = set()
+		for n in nodes:
+			sn = n if isinstance(n,str) else self.name(int(n))
+			if sn in self.device_map:
+				result.update(self.device_map[sn][key])
+		return result
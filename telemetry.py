@@ -0,0 +1,107 @@
+'''
+TelemetryWriter buffers the (clock, inverter, kW) rows of the P_Out setpoints written during the simulation and
+appends them in batches to one long-format file (csv, or parquet when pyarrow is installed),
+export() then writes the per-inverter <inverter>-P_Out.csv files the post processing expects
+'''
+import csv
+import os
+
+COLUMNS = ['clock','inverter','kW']
+
+class TelemetryWriter:
+	'''
+	filename	: output file, .parquet writes a parquet file (requires pyarrow), anything else a csv file
+	flush_rows	: rows buffered before they are written
+	'''
+	def __init__(self,filename='inverter_P_Out.csv',flush_rows=10000):
+		self.filename = filename
+		self.flush_rows = flush_rows
+		self.parquet = filename.endswith('.parquet')
+		if self.parquet:
+			try:
+				import pyarrow.parquet
+			except ImportError:
+				self.filename = os.path.splitext(filename)[0]+'.csv'
+				self.parquet = False
+				print('pyarrow not found, writing the telemetry to {}'.format(self.filename))
+		self.rows = 0
+		self._buffer = {c:[] for c in COLUMNS}
+		self._parquet_writer = None
+		self._started = False
+
+	def record(self,clock,inverter,kW):
+		'''
+		buffers one setpoint, flushes the buffer when it holds flush_rows rows
+		'''
+		self._buffer['clock'].append(clock)
+		self._buffer['inverter'].append(inverter)
+		self._buffer['kW'].append(kW)
+		self.rows += 1
+		if len(self._buffer['clock']) >= self.flush_rows:
+			self.flush()
+
+	def flush(self):
+		'''
+		appends the buffered rows to the output file
+		'''
+		if not self._started:
+			if os.path.exists(self.filename):
+				os.remove(self.filename)
+			self._started = True
+		if not self._buffer['clock']:
+			return
+		if self.parquet:
+			import pyarrow as pa
+			import pyarrow.parquet as pq
+			table = pa.table({'clock':[str(c) for c in self._buffer['clock']],
+							  'inverter':[str(i) for i in self._buffer['inverter']],
+							  'kW':[float(k) for k in self._buffer['kW']]})
+			if self._parquet_writer is None:
+				self._parquet_writer = pq.ParquetWriter(self.filename,table.schema)
+			self._parquet_writer.write_table(table)
+		else:
+			new_file = not os.path.exists(self.filename)
+			with open(self.filename,'a',newline='') as file:
+				writer = csv.writer(file)
+				if new_file:
+					writer.writerow(COLUMNS)
+				writer.writerows(zip(*(self._buffer[c] for c in COLUMNS)))
+		self._buffer = {c:[] for c in COLUMNS}
+
+	def close(self):
+		'''
+		flushes the remaining rows and closes the output file
+		'''
+		self.flush()
+		if self._parquet_writer is not None:
+			self._parquet_writer.close()
+			self._parquet_writer = None
+
+	def read(self):
+		'''
+		returns the rows written so far as a list of (clock, inverter, kW) string tuples, in order
+		'''
+		if not os.path.exists(self.filename):
+			return []
+		if self.parquet:
+			import pyarrow.parquet as pq
+			table = pq.read_table(self.filename).to_pydict()
+			return list(zip(table['clock'],table['inverter'],[repr(k) for k in table['kW']]))
+		with open(self.filename,newline='') as file:
+			reader = csv.reader(file)
+			next(reader,None)
+			return [tuple(row) for row in reader]
+
+	def export(self,pattern='{}-P_Out.csv'):
+		'''
+		appends the rows of each inverter to its own "clock, kW" file (the format written before the telemetry file existed)
+		returns the number of files written
+		'''
+		self.close()
+		per_inverter = {}
+		for clock,inverter,kW in self.read():
+			per_inverter.setdefault(inverter,[]).append('{}, {}\n'.format(clock,kW))
+		for inverter,lines in per_inverter.items():
+			with open(pattern.format(inverter),'a+') as file:
+				file.writelines(lines)
+		return len(per_inverter)